@@ -0,0 +1,267 @@
+"""Benchmark of filter-pageid, end to end and stage by stage.
+
+Usage:
+  python3 benchmarks/filter_pageid.py [--records N] [--compression C]
+      [--repeat R] [--data-dir DIR] [--save-baseline FILE]
+      [--baseline FILE] [--threshold T] [-- FILTER-PAGEID OPTIONS]
+
+Generates (once, in DATA-DIR) a synthetic WikiConv file of N objects, runs
+filter-pageid on it R times keeping the fastest run, and times each stage
+in isolation: decompression, JSON decoding, casting, serialization, sorting
+and compressed output. Reports objects/s, MB/s (of uncompressed input) and
+the peak memory of the end-to-end run.
+
+The noise of each measurement is the relative gap between the slowest and
+the fastest of its R runs. Results can be saved as a baseline and compared
+with a previous baseline: throughputs lower than the baseline by more than
+the threshold plus the noise of both measurements are reported as
+regressions and the script exits with status 1.
+"""
+import argparse
+import importlib
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from typing import List, Tuple
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+fu = importlib.import_module('wikiconv-crunch.file_utils')
+sorting = importlib.import_module('wikiconv-crunch.sorting')
+synthetic = importlib.import_module('wikiconv-crunch.synthetic')
+types = importlib.import_module('wikiconv-crunch.types')
+
+
+def dataset(args: argparse.Namespace) -> str:
+    """Return the path of the synthetic input, generating it if needed."""
+    name = 'synthetic-{}-{}-s{}'.format(args.records, args.pages, args.seed)
+    path = os.path.join(args.data_dir, name)
+    full_path = fu.compressed_path(path, args.compression)
+    if not os.path.exists(full_path):
+        os.makedirs(args.data_dir, exist_ok=True)
+        print("Generating {}...".format(full_path), file=sys.stderr)
+        synthetic.write_dump(path,
+                             args.records,
+                             compression=args.compression,
+                             pages=args.pages,
+                             seed=args.seed)
+    return full_path
+
+
+def noise(times: List[float]) -> float:
+    """Return the relative gap between the longest and the shortest of
+       times."""
+    return 1 - min(times) / max(times)
+
+
+def best_of(func, repeat: int) -> Tuple[float, float]:
+    """Return the shortest elapsed time of a call of func in repeat
+       measurements and its noise.
+
+       As with timeit, the garbage collector is disabled and each
+       measurement calls func enough times to last at least 0.2 seconds.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [elapsed / number for elapsed in timer.repeat(repeat, number)]
+    return min(times), noise(times)
+
+
+def run_end_to_end(path: str, args: argparse.Namespace) -> dict:
+    """Run filter-pageid in a subprocess, returning the fastest run and the
+       noise of the runs."""
+    best = None
+    times = []
+    for _ in range(args.repeat):
+        with tempfile.TemporaryDirectory() as output_dir:
+            cmd = [sys.executable, '-m', 'wikiconv-crunch',
+                   path, output_dir,
+                   'filter-pageid', '--start-id', '0',
+                   '--end-id', str(50 * args.pages),
+                   '--metrics-json'] + args.filter_args
+            start = time.perf_counter()
+            subprocess.run(cmd, cwd=str(ROOT), check=True,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+            times.append(elapsed)
+
+            metrics_paths = list(pathlib.Path(output_dir)
+                                 .glob('*.metrics.json'))
+            with open(str(metrics_paths[0]), 'rt') as infile:
+                metrics = json.load(infile)['performance']['metrics']
+
+        if best is None or elapsed < best['seconds']:
+            best = {'seconds': elapsed, 'metrics': metrics}
+
+    best['noise'] = noise(times)
+    return best
+
+
+def run_stages(path: str, args: argparse.Namespace) -> dict:
+    """Time each stage of filter-pageid in isolation, returning the elapsed
+       seconds and their noise by stage."""
+    lines = list(fu.open_jsonlines_file(path))
+    loads = fu.get_json_decoder('auto')
+    objs = [loads(line) for line in lines]
+    records = [types.cast_record(obj) for obj in objs]
+    serialized = [record.to_json() for record in records]
+
+    def sort():
+        sorter = sorting.ExternalSorter(1024*1024*1024)
+        for record, line in zip(records, serialized):
+            sorter.add((record.pageId,
+                        types.timestamp_key(record.timestamp)),
+                       line)
+        for _ in sorter.sorted():
+            pass
+
+    def write():
+        with tempfile.TemporaryDirectory() as output_dir:
+            with fu.output_writer(os.path.join(output_dir, 'out.json'),
+                                  args.compression) as output:
+                for line in serialized:
+                    output.write(line)
+                    output.write('\n')
+
+    stages = [
+        ('decompression', lambda: sum(1 for _ in
+                                      fu.open_jsonlines_file(path))),
+        ('raw_pageid', lambda: [types.raw_pageid(line) for line in lines]),
+        ('json_loads', lambda: [loads(line) for line in lines]),
+        ('cast_json', lambda: [types.cast_record(obj) for obj in objs]),
+        ('serialization', lambda: [record.to_json() for record in records]),
+        ('sort', sort),
+        ('compression', write),
+    ]
+    return {name: best_of(func, args.repeat) for name, func in stages}
+
+
+def throughput(seconds: float,
+               noise_: float,
+               nrecords: int,
+               size: int) -> dict:
+    return {
+        'seconds': round(seconds, 4),
+        'noise': round(noise_, 4),
+        'records_per_second': round(nrecords / seconds, 1),
+        'mb_per_second': round(size / 1024 / 1024 / seconds, 2),
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """Print the ratio of each throughput to the baseline, returning True if
+       some of them is lower than the baseline by more than threshold plus
+       the noise of the two measurements."""
+    regression = False
+    rows = [('end_to_end', results['end_to_end'],
+             baseline.get('end_to_end'))]
+    rows.extend((name, stage, baseline.get('stages', {}).get(name))
+                for name, stage in results['stages'].items())
+
+    print("\n{:>16} {:>14} {:>14} {:>8} {:>9}".format(
+        'stage', 'objects/s', 'baseline', 'ratio', 'tolerance'))
+    for name, current, previous in rows:
+        if previous is None:
+            continue
+        ratio = (current['records_per_second']
+                 / previous['records_per_second'])
+        tolerance = (threshold
+                     + current.get('noise', 0)
+                     + previous.get('noise', 0))
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = 'REGRESSION'
+            regression = True
+        print("{:>16} {:>14.0f} {:>14.0f} {:>8.2f} {:>9.2f} {}".format(
+            name, current['records_per_second'],
+            previous['records_per_second'], ratio, tolerance, flag))
+
+    previous_rss = baseline.get('end_to_end', {}).get('peak_rss_kb')
+    if previous_rss:
+        print("{:>16} {:>14} {:>14} {:>8.2f}".format(
+            'peak_rss_kb', results['end_to_end']['peak_rss_kb'],
+            previous_rss,
+            results['end_to_end']['peak_rss_kb'] / previous_rss))
+
+    return regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compression', choices={None, 'bz2', 'gzip'},
+                        default='gzip')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--data-dir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'wikiconv-crunch-bench'))
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--baseline', metavar='FILE')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('filter_args', nargs='*',
+                        help='Other options of filter-pageid, after --.')
+    args = parser.parse_args()
+
+    path = dataset(args)
+    lines = list(fu.open_jsonlines_file(path))
+    nrecords = len(lines)
+    size = sum(len(line) for line in lines)
+    del lines
+
+    end_to_end = run_end_to_end(path, args)
+    results = {
+        'params': {
+            'records': args.records,
+            'pages': args.pages,
+            'seed': args.seed,
+            'compression': args.compression,
+            'filter_args': args.filter_args,
+        },
+        'end_to_end': dict(
+            throughput(end_to_end['seconds'], end_to_end['noise'],
+                       nrecords, size),
+            peak_rss_kb=end_to_end['metrics']['peak_rss_kb'],
+            timers=end_to_end['metrics']['timers'],
+        ),
+        'stages': {name: throughput(seconds, noise_, nrecords, size)
+                   for name, (seconds, noise_)
+                   in run_stages(path, args).items()},
+    }
+
+    print("{} objects, {:.1f} MB".format(nrecords, size / 1024 / 1024))
+    for name, stage in ([('end_to_end', results['end_to_end'])]
+                        + list(results['stages'].items())):
+        print("{:>16}: {:8.3f} s {:10.0f} objects/s {:8.1f} MB/s "
+              "noise {:5.1%}".format(
+                  name, stage['seconds'], stage['records_per_second'],
+                  stage['mb_per_second'], stage['noise']))
+    print("{:>16}: {} KB".format('peak_rss',
+                                 results['end_to_end']['peak_rss_kb']))
+
+    regression = False
+    if args.baseline:
+        with open(args.baseline, 'rt') as infile:
+            baseline = json.load(infile)
+        if baseline.get('params') != results['params']:
+            print("Warning: the baseline was run with different parameters",
+                  file=sys.stderr)
+        regression = compare(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'wt') as outfile:
+            json.dump(results, outfile, indent=2)
+
+    sys.exit(1 if regression else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Microbenchmark of the JSON decoders on WikiConv lines.
+
+Usage:
+  python3 benchmarks/json_decoders.py [FILE] [--lines N] [--repeat R]
+
+Decodes the first N lines of FILE (a WikiConv file, can be compressed), or
+N sample lines if no file is given, with each installed decoder, one line
+at a time and in batches.
+"""
+import argparse
+import importlib
+import itertools
+import json
+import pathlib
+import random
+import string
+import sys
+import timeit
+
+from typing import Any, Callable, List
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+fu = importlib.import_module('wikiconv-crunch.file_utils')
+
+
+def sample_lines(nlines: int, seed: int=0):
+    """Return sample WikiConv lines, with long content."""
+    rnd = random.Random(seed)
+    words = [''.join(rnd.choice(string.ascii_lowercase)
+                     for _ in range(rnd.randint(2, 10)))
+             for _ in range(1000)]
+
+    lines = []
+    for num in range(nlines):
+        content = ' '.join(rnd.choice(words)
+                           for _ in range(rnd.randint(10, 400)))
+        obj = {
+            "id": "{}.0.{}".format(168283361 + num, num),
+            "revId": str(168283361 + num),
+            "type": rnd.choice(["ADDITION", "CREATION", "DELETION"]),
+            "conversationId": "11458020.300.300",
+            "pageTitle": "Talk:The Case for Faith",
+            "content": content,
+            "cleanedContent": content,
+            "user": {"id": str(rnd.randint(1, 10**7)), "text": "Hrafn"},
+            "timestamp": "2007-10-31T11:54:56Z",
+            "pageId": str(rnd.randint(1, 2*10**7)),
+            "parentId": "11458195.312.312",
+            "ancestorId": "11458020.312.300",
+            "authorList": [{"id": "86737", "text": "SocratesJedi"}],
+            "comment": "Archived to merged article",
+            "score": {key: rnd.random()
+                      for key in ["toxicity", "severeToxicity", "profanity",
+                                  "threat", "insult", "identityAttack"]},
+            "pageNamespace": 1,
+        }
+        lines.append(json.dumps(obj) + '\n')
+
+    return lines
+
+
+def decode_batches(lines: List[str], loads: Callable[[str], Any]):
+    """Decode the lines in batches, as open_jsonobjects_file does."""
+    size = fu.DECODE_BATCH_SIZE
+    return [obj
+            for start in range(0, len(lines), size)
+            for obj in fu.decode_batch(lines[start:start+size], loads)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('file', nargs='?', help='WikiConv input file.')
+    parser.add_argument('--lines', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.file:
+        lines = list(itertools.islice(fu.open_jsonlines_file(args.file),
+                                      args.lines))
+    else:
+        lines = sample_lines(args.lines)
+
+    size = sum(len(line) for line in lines) / 1024 / 1024
+    print("{} lines, {:.1f} MB".format(len(lines), size))
+
+    results = []
+    for name in fu.available_json_decoders():
+        loads = fu.get_json_decoder(name)
+        for mode, func in [
+                ('line', lambda: [loads(line) for line in lines]),
+                ('batch', lambda: decode_batches(lines, loads))]:
+            elapsed = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            results.append((name, mode, elapsed))
+
+    # speedup with respect to the json module, one line at a time
+    baseline = [elapsed for name, mode, elapsed in results
+                if (name, mode) == ('json', 'line')][0]
+    for name, mode, elapsed in results:
+        print("{:>8} {:>6}: {:8.3f} s {:10.0f} lines/s {:8.1f} MB/s "
+              "x{:.2f}".format(name, mode, elapsed,
+                               len(lines) / elapsed, size / elapsed,
+                               baseline / elapsed))
+
+if __name__ == '__main__':
+    main()
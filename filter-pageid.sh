@@ -183,26 +183,12 @@ echoverbose "  - start_id: $start_id"
 echoverbose "  - end_id: $end_id"
 echoverbose "  - step: $step:"
 
-for id in $(seq "$start_id" "$step" "$end_id"); do
-  sid="$id"
-  if [ "$id" -ne "$start_id" ]; then
-    sid="$((id+1))"
-  fi
-  if [ "$sid" -ge "$end_id" ]; then
-    break;
-  fi
-	eid="$((id+step))"
-
-	echoverbose "sid: $sid - eid $eid"
-
-  if $debug; then set -x; fi
-  (
-    cd "$SCRIPTDIR"
-    run python3 -m wikiconv-crunch --output-compression gzip \
-      "${INPUT_ARR[@]}" "$OUTPUT" \
-	    filter-pageid --start-id "$sid" --end-id "$eid"
-  )
-
-done
+if $debug; then set -x; fi
+(
+  cd "$SCRIPTDIR"
+  run python3 -m wikiconv-crunch --output-compression gzip \
+    "${INPUT_ARR[@]}" "$OUTPUT" \
+    filter-pageid --start-id "$start_id" --end-id "$end_id" --step "$step"
+)
 
 exit 0
\ No newline at end of file
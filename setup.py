@@ -34,6 +34,7 @@ setup(
         'mwxml==0.2.0',
         'regex==2018.8.17',
         'more-itertools==6.0.0',
+        'numpy==1.19.1',
         'fuzzywuzzy==0.8.0',
         'python-Levenshtein==0.12.0',
         'requests==2.9.1',
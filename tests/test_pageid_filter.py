@@ -0,0 +1,159 @@
+"""Tests of the filter-pageid sub-command."""
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from xml.etree import ElementTree
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+OBJECT = {
+    'id': '0.0.0',
+    'revId': '0',
+    'type': 'ADDITION',
+    'conversationId': '0.0.0',
+    'pageTitle': 'Talk:Page',
+    'content': 'hello world',
+    'cleanedContent': 'hello world',
+    'user': {'id': '1', 'text': 'U1'},
+    'timestamp': '2010-01-01T00:00:00Z',
+    'pageId': '10',
+    'ancestorId': '0.0.0',
+    'authorList': [],
+    'score': {
+        'toxicity': 0.5,
+        'severeToxicity': 0.1,
+        'profanity': 0.2,
+        'threat': 0.1,
+        'insult': 0.3,
+        'identityAttack': 0.1,
+    },
+    'pageNamespace': 1,
+}
+
+
+def run_crunch(*args: str) -> subprocess.CompletedProcess:
+    """Run wikiconv-crunch from the root of the repository."""
+    return subprocess.run(
+        [sys.executable, '-m', 'wikiconv-crunch'] + list(args),
+        cwd=str(ROOT),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+
+class DryRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp.name, 'input.json')
+        with open(self.input_path, 'wt') as infile:
+            for pageid in (5, 10, 15):
+                obj = dict(OBJECT, id='{}.0.0'.format(pageid),
+                           pageId=str(pageid))
+                infile.write(json.dumps(obj) + '\n')
+        self.output_dir = os.path.join(self.tmp.name, 'output')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check_dry_run(self, *options: str) -> None:
+        result = run_crunch('--dry-run', self.input_path, self.output_dir,
+                            'filter-pageid', '--start-id', '0',
+                            '--end-id', '20', *options)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        written = [name for name in os.listdir(self.output_dir)
+                   if name != 'manifest.json'] \
+            if os.path.exists(self.output_dir) else []
+        self.assertEqual(written, [])
+
+    def test_json(self):
+        self.check_dry_run()
+
+    def test_columnar(self):
+        self.check_dry_run('--output-format', 'columnar')
+
+    def test_shards(self):
+        self.check_dry_run('--shards', '2')
+
+
+class DedupStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp.name, 'input.json')
+        with open(self.input_path, 'wt') as infile:
+            for pageid in (5, 10, 15, 10):
+                obj = dict(OBJECT, id='{}.0.0'.format(pageid),
+                           pageId=str(pageid))
+                infile.write(json.dumps(obj) + '\n')
+        self.output_dir = os.path.join(self.tmp.name, 'output')
+        self.state_dir = os.path.join(self.tmp.name, 'state')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_dedup(self, *options: str) -> int:
+        """Run filter-pageid with the persistent dedup state, returning the
+           number of objects written."""
+        result = run_crunch(*options, self.input_path, self.output_dir,
+                            'filter-pageid', '--start-id', '0',
+                            '--end-id', '20', '--dedup',
+                            '--dedup-capacity', '1000',
+                            '--dedup-state', self.state_dir)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        output_path = os.path.join(self.output_dir,
+                                   'input.filter-pageid.00000000-00000020'
+                                   '.json')
+        with open(output_path, 'rt') as output:
+            return sum(1 for _ in output)
+
+    def test_force_keeps_own_records(self):
+        self.assertEqual(self.run_dedup(), 3)
+        self.assertEqual(self.run_dedup('--force'), 3)
+
+    def test_deleted_output_keeps_own_records(self):
+        self.assertEqual(self.run_dedup(), 3)
+        for name in os.listdir(self.output_dir):
+            if name.endswith('.json') and name != 'manifest.json':
+                os.remove(os.path.join(self.output_dir, name))
+        self.assertEqual(self.run_dedup(), 3)
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp.name, 'input.json')
+        with open(self.input_path, 'wt') as infile:
+            for pageid in range(1, 31):
+                obj = dict(OBJECT, id='{}.0.0'.format(pageid),
+                           pageId=str(pageid))
+                infile.write(json.dumps(obj) + '\n')
+        self.output_dir = os.path.join(self.tmp.name, 'output')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_write_stats_of_shards(self):
+        result = run_crunch(self.input_path, self.output_dir,
+                            'filter-pageid', '--start-id', '0',
+                            '--end-id', '40', '--pipeline', '--shards', '3')
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        output_dir = pathlib.Path(self.output_dir)
+        nchars = sum(len(path.read_text())
+                     for path in output_dir.glob('input.*.shard-*.json'))
+        stats = ElementTree.parse(str(
+            output_dir / 'input.filter-pageid.00000000-00000040.stats.xml'))
+        items = stats.find(".//pipeline/stage[@name='write']/items").text
+        self.assertEqual(int(items), nchars)
+
+
+if __name__ == '__main__':
+    unittest.main()
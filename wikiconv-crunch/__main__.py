@@ -1,8 +1,25 @@
 """Main module that parses command line arguments."""
 import argparse
+import concurrent.futures
+import itertools
 import pathlib
 
-from . import processors, utils, file_utils
+from typing import Iterable, List, Mapping, Optional, Tuple
+
+from . import processors, utils, dumper, file_utils, manifest
+
+
+def open_dump(path: str, args: argparse.Namespace):
+    """Open an input file, decoding its JSON objects."""
+    return file_utils.open_jsonobjects_file(
+        path,
+        loads=file_utils.get_json_decoder(args.json_decoder),
+    )
+
+
+def skip_completed(args: argparse.Namespace) -> bool:
+    """Whether the units completed by a previous run can be skipped."""
+    return True
 
 
 def get_args():
@@ -31,14 +48,73 @@ def get_args():
         default=None,
         help='Output compression format [default: no compression].',
     )
+    parser.add_argument(
+        '--compression-workers',
+        type=int,
+        default=0,
+        help='Number of threads compressing gzip and bz2 output in '
+             'independent blocks, 0 to compress in a single stream '
+             '[default: 0].',
+    )
+    parser.add_argument(
+        '--compression-block-size',
+        type=int,
+        default=4,
+        help='Size of the blocks compressed by each thread, in MB '
+             '[default: 4].',
+    )
+    parser.add_argument(
+        '--json-decoder',
+        choices=['auto'] + file_utils.JSON_DECODERS,
+        default='auto',
+        help='JSON decoder for the input, auto uses the fastest installed '
+             'one among {} [default: auto].'
+             .format(', '.join(file_utils.JSON_DECODERS)),
+    )
+    parser.add_argument(
+        '--template-cache-dir',
+        type=pathlib.Path,
+        default=None,
+        help='Directory where compiled templates are stored and reused '
+             'across runs [default: keep them only in memory].',
+    )
     parser.add_argument(
         '--dry-run', '-n',
         action='store_true',
         help="Don't write any file",
     )
+    parser.add_argument(
+        '--jobs', '-j',
+        type=int,
+        default=1,
+        help='Number of input files processed in parallel [default: 1].',
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Process again the input files already processed with the same '
+             'parameters according to the manifest of the output '
+             'directory.',
+    )
 
-    subparsers = parser.add_subparsers(help='sub-commands help')
+    subparsers = parser.add_subparsers(help='sub-commands help',
+                                       dest='command')
     processors.pageid_filter.configure_subparsers(subparsers)
+    processors.pageid_index.configure_subparsers(subparsers)
+    processors.conversations.configure_subparsers(subparsers)
+    processors.aggregate_scores.configure_subparsers(subparsers)
+    processors.user_stats.configure_subparsers(subparsers)
+    processors.expression_filter.configure_subparsers(subparsers)
+    processors.text_index.configure_subparsers(subparsers)
+    processors.text_search.configure_subparsers(subparsers)
+
+    # sub-commands that need the raw lines of the input, whose stats can
+    # not be merged by utils.merge_stats, or that must see again the input
+    # files already processed, override these
+    parser.set_defaults(dump_reader=open_dump,
+                        stats_template=None,
+                        stats_merger=utils.merge_stats,
+                        skip_completed=skip_completed)
 
     parsed_args = parser.parse_args()
     if 'func' not in parsed_args:
@@ -48,6 +124,64 @@ def get_args():
     return parsed_args
 
 
+def process_file(
+        input_file_path: pathlib.Path,
+        args: argparse.Namespace) -> Tuple[Optional[Mapping], List[str]]:
+    """Process an input file with the selected sub-command, returning its
+       stats and the paths of the outputs it wrote."""
+    utils.log("Analyzing {}...".format(input_file_path))
+
+    # forget the outputs of the previous file of this process
+    file_utils.take_outputs()
+
+    dump = args.dump_reader(str(input_file_path), args)
+
+    # get filename without the extension
+    # https://stackoverflow.com/a/47496703/2377454
+    basename = input_file_path.stem
+
+    res = args.func(
+        dump,
+        basename,
+        args,
+    )
+
+    # explicitly close input files
+    dump.close()
+
+    utils.log("Done Analyzing {}.".format(input_file_path))
+
+    return res, file_utils.take_outputs()
+
+
+def write_stats_summary(
+        results: Iterable[Optional[Mapping]],
+        args: argparse.Namespace) -> None:
+    """Merge the stats of each input file and write them in a single report
+       for each output of the sub-command."""
+    summary = dict()
+    for file_results in results:
+        if not file_results:
+            continue
+
+        for name, stats in file_results.items():
+            if name in summary:
+                summary[name] = args.stats_merger(summary[name], stats)
+            else:
+                summary[name] = stats
+
+    for name, stats in summary.items():
+        stats_filename = str(args.output_dir_path / (name + '.stats.xml'))
+        with file_utils.output_writer(
+                path=stats_filename,
+                compression=args.output_compression) as stats_output:
+            dumper.render_template(
+                args.stats_template,
+                stats_output,
+                stats=stats,
+            )
+
+
 def main():
     """Main function."""
     args = get_args()
@@ -55,25 +189,75 @@ def main():
     if not args.output_dir_path.exists():
         args.output_dir_path.mkdir(parents=True)
 
+    if args.template_cache_dir is not None:
+        dumper.set_module_directory(str(args.template_cache_dir))
+
+    units = None
+    if not args.dry_run:
+        units = manifest.Manifest(str(args.output_dir_path))
+
+    skip = not args.force and args.skip_completed(args)
+    if not (args.force or skip):
+        utils.log("Processing all the files again: {} can not skip the files "
+                  "already processed with these parameters."
+                  .format(args.command))
+
+    # results of the input files already processed, by input file
+    results = dict()
+    todo = []
     for input_file_path in args.files:
-        utils.log("Analyzing {}...".format(input_file_path))
+        unit = None
+        if units is not None and skip:
+            unit = units.completed(str(input_file_path), args)
+        if unit is not None:
+            utils.log("Skipping {}, already processed."
+                      .format(input_file_path))
+            results[input_file_path] = unit['results']
+        else:
+            todo.append(input_file_path)
 
-        dump = file_utils.open_jsonobjects_file(str(input_file_path))
+    if args.jobs > 1:
+        # executor.map returns the results in the order of the input files,
+        # whichever worker finishes first
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs)
+        todo_results = executor.map(process_file,
+                                    todo,
+                                    itertools.repeat(args))
+    else:
+        executor = None
+        todo_results = (process_file(input_file_path, args)
+                        for input_file_path in todo)
 
-        # get filename without the extension
-        # https://stackoverflow.com/a/47496703/2377454
-        basename = input_file_path.stem
+    # record each file in the manifest as soon as it is done, so that a
+    # failed run resumes from the first file that was not completed
+    try:
+        for input_file_path in todo:
+            try:
+                file_results, output_paths = next(todo_results)
+            except Exception as exc:
+                if units is not None:
+                    units.record(str(input_file_path),
+                                 [],
+                                 args,
+                                 None,
+                                 error=exc)
+                raise
 
-        args.func(
-            dump,
-            basename,
-            args,
-        )
+            results[input_file_path] = file_results
+            if units is not None:
+                units.record(str(input_file_path),
+                             output_paths,
+                             args,
+                             file_results)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-        # explicitly close input files
-        dump.close()
+    results = [results[input_file_path] for input_file_path in args.files]
 
-        utils.log("Done Analyzing {}.".format(input_file_path))
+    if not args.dry_run and args.stats_template is not None:
+        write_stats_summary(results, args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,287 @@
+"""Columnar binary format for WikiConv objects.
+
+Each output is a directory with a file per column and a meta.json file
+describing them:
+
+  * numeric columns (IDs, epoch timestamps, scores, namespace) are stored as
+    fixed-width arrays (<name>.int64, <name>.float64) that can be
+    memory-mapped as NumPy arrays;
+  * string columns are stored as a blob with the UTF-8 encoded strings
+    (<name>.blob) and an array of n+1 offsets into it (<name>.offsets),
+    nullable string columns have also an array of validity flags
+    (<name>.valid).
+
+Nested fields are flattened with a dot (e.g. user.id, score.toxicity),
+authorList is stored as a JSON-encoded string.
+"""
+import array
+import json
+import os
+import sys
+
+from typing import Any, Iterator, Mapping, Tuple
+
+import numpy as np
+
+from . import types
+
+COLUMNAR_VERSION = 1
+
+# suffix of the columnar output directories
+COLUMNS_SUFFIX = '.columns'
+
+# number of records buffered before writing them to the column files
+FLUSH_RECORDS = 65536
+
+# (name, type, nullable)
+COLUMNS = [
+    ('id', 'str', False),
+    ('revId', 'int64', False),
+    ('type', 'str', False),
+    ('conversationId', 'str', False),
+    ('pageTitle', 'str', False),
+    ('content', 'str', False),
+    ('cleanedContent', 'str', False),
+    ('user.id', 'int64', False),
+    ('user.text', 'str', True),
+    ('timestamp', 'int64', False),
+    ('pageId', 'int64', False),
+    ('parentId', 'str', True),
+    ('ancestorId', 'str', False),
+    ('authorList', 'str', False),
+    ('comment', 'str', True),
+    ('score.toxicity', 'float64', False),
+    ('score.severeToxicity', 'float64', False),
+    ('score.profanity', 'float64', False),
+    ('score.threat', 'float64', False),
+    ('score.insult', 'float64', False),
+    ('score.identityAttack', 'float64', False),
+    ('pageNamespace', 'int64', False),
+]
+
+# value of user.id for anonymous users
+MISSING_USER_ID = -1
+
+_ARRAY_TYPECODES = {
+    'int64': 'q',
+    'float64': 'd',
+}
+
+
+def encode(record: types.WikiConvRecord) -> Tuple[Any, ...]:
+    """Return the values of the columns of a record."""
+    user = record.user
+    if isinstance(user, tuple):
+        user_id, user_text = user
+    else:
+        user_id, user_text = MISSING_USER_ID, user.get('text')
+
+    return (
+        record.id,
+        record.revId,
+        record.type,
+        record.conversationId,
+        record.pageTitle,
+        record.content,
+        record.cleanedContent,
+        user_id,
+        user_text,
+        types.timestamp_epoch(record.timestamp),
+        record.pageId,
+        record.parentId,
+        record.ancestorId,
+        json.dumps(record['authorList']),
+        record.comment,
+        record.toxicity,
+        record.severeToxicity,
+        record.profanity,
+        record.threat,
+        record.insult,
+        record.identityAttack,
+        record.pageNamespace,
+    )
+
+
+def sizeof(values: Tuple[Any, ...]) -> int:
+    """Estimate the memory used by the values returned by encode."""
+    return sys.getsizeof(values) + sum(sys.getsizeof(value)
+                                       for value in values)
+
+
+class _StringColumnWriter(object):
+
+    def __init__(self, path: str, name: str, nullable: bool):
+        self.blob = open(os.path.join(path, name + '.blob'), 'wb')
+        self.offsets_file = open(os.path.join(path, name + '.offsets'), 'wb')
+        self.valid_file = None
+        if nullable:
+            self.valid_file = open(os.path.join(path, name + '.valid'), 'wb')
+
+        self.offset = 0
+        self.offsets = array.array('Q', [0])
+        self.valid = array.array('B')
+        self.chunks = []
+
+    def append(self, value: Any) -> None:
+        if value is None:
+            data = b''
+            self.valid.append(0)
+        else:
+            data = value.encode('utf-8')
+            self.valid.append(1)
+
+        self.chunks.append(data)
+        self.offset += len(data)
+        self.offsets.append(self.offset)
+
+    def flush(self) -> None:
+        self.blob.write(b''.join(self.chunks))
+        self.offsets.tofile(self.offsets_file)
+        if self.valid_file is not None:
+            self.valid.tofile(self.valid_file)
+
+        self.chunks = []
+        self.offsets = array.array('Q')
+        self.valid = array.array('B')
+
+    def close(self) -> None:
+        self.flush()
+        self.blob.close()
+        self.offsets_file.close()
+        if self.valid_file is not None:
+            self.valid_file.close()
+
+
+class _NumericColumnWriter(object):
+
+    def __init__(self, path: str, name: str, type_: str):
+        self.outfile = open(os.path.join(path, name + '.' + type_), 'wb')
+        self.typecode = _ARRAY_TYPECODES[type_]
+        self.values = array.array(self.typecode)
+        self.append = self.values.append
+
+    def flush(self) -> None:
+        self.values.tofile(self.outfile)
+        self.values = array.array(self.typecode)
+        self.append = self.values.append
+
+    def close(self) -> None:
+        self.flush()
+        self.outfile.close()
+
+
+class ColumnarWriter(object):
+    """Write the values returned by encode in a columnar output directory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.nrecords = 0
+        self.columns = []
+        for name, type_, nullable in COLUMNS:
+            if type_ == 'str':
+                writer = _StringColumnWriter(path, name, nullable)
+            else:
+                writer = _NumericColumnWriter(path, name, type_)
+            self.columns.append(writer)
+
+    def write_record(self, values: Tuple[Any, ...]) -> None:
+        """Append a record to the columns."""
+        for column, value in zip(self.columns, values):
+            column.append(value)
+
+        self.nrecords += 1
+        if self.nrecords % FLUSH_RECORDS == 0:
+            for column in self.columns:
+                column.flush()
+
+    def close(self) -> None:
+        """Write the buffered records and the metadata."""
+        for column in self.columns:
+            column.close()
+
+        meta = {
+            'version': COLUMNAR_VERSION,
+            'records': self.nrecords,
+            'byteorder': sys.byteorder,
+            'columns': [{'name': name, 'type': type_, 'nullable': nullable}
+                        for name, type_, nullable in COLUMNS],
+        }
+        with open(os.path.join(self.path, 'meta.json'), 'wt') as metafile:
+            json.dump(meta, metafile, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _memmap(path: str, dtype: np.dtype, count: int) -> np.ndarray:
+    """Memory-map an array, empty files can not be mapped."""
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count, ))
+
+
+class StringColumn(object):
+    """A string column, backed by memory-mapped offsets and blob."""
+
+    def __init__(self,
+                 offsets: np.ndarray,
+                 blob: np.ndarray,
+                 valid: np.ndarray=None):
+        self.offsets = offsets
+        self.blob = blob
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int):
+        if self.valid is not None and not self.valid[idx]:
+            return None
+
+        start, end = self.offsets[idx], self.offsets[idx+1]
+        return bytes(self.blob[start:end]).decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def open_columns(path: str) -> Mapping[str, Any]:
+    """Open a columnar output directory, returning a dictionary with a
+       NumPy array (memory-mapped, without copying the data) for each
+       numeric column and a StringColumn for each string column."""
+    with open(os.path.join(path, 'meta.json'), 'rt') as metafile:
+        meta = json.load(metafile)
+
+    order = '<' if meta['byteorder'] == 'little' else '>'
+    count = meta['records']
+
+    columns = dict()
+    for column in meta['columns']:
+        name = column['name']
+        basepath = os.path.join(path, name)
+        if column['type'] == 'str':
+            offsets = _memmap(basepath + '.offsets',
+                              np.dtype(order + 'u8'),
+                              count + 1)
+            blob_size = int(offsets[-1]) if count else 0
+            blob = _memmap(basepath + '.blob', np.dtype('u1'), blob_size)
+            valid = None
+            if column['nullable']:
+                valid = _memmap(basepath + '.valid', np.dtype('u1'), count)
+            columns[name] = StringColumn(offsets, blob, valid)
+        else:
+            dtype = np.dtype(order + ('i8' if column['type'] == 'int64'
+                                      else 'f8'))
+            columns[name] = _memmap(basepath + '.' + column['type'],
+                                    dtype,
+                                    count)
+
+    return columns
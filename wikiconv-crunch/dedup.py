@@ -0,0 +1,131 @@
+"""Duplicate elimination by record ID with bounded memory.
+
+The IDs seen so far are added to a Bloom filter, kept in memory, and to a
+SQLite table on disk. An ID that the filter has not seen is new for sure and
+is only inserted in the table, an ID that the filter may have seen (a
+suspected duplicate) is confirmed looking it up in the table, so false
+positives of the filter never drop a record. Memory is bounded by the size
+of the filter, set by the expected number of IDs and the false positive
+rate.
+
+The state can be kept in a directory, so that later runs drop the records
+already written by the previous ones. Each ID is stored with the unit (the
+outputs of an input file) that wrote it: the IDs of a unit are removed
+before it is processed again, e.g. with --force or after a crash, so that
+its records are not dropped as duplicates of themselves. Their bits stay in
+the Bloom filter, they are looked up and counted as false positives.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+
+from typing import List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from . import sketches
+
+# files of the state in its directory
+BLOOM_FILENAME = 'dedup.bloom.json'
+IDS_FILENAME = 'dedup.ids.sqlite'
+
+
+class Deduplicator(object):
+    """Tell apart the first occurrence of each ID from its duplicates."""
+
+    def __init__(self,
+                 capacity: int,
+                 error: float,
+                 state_dir: Optional[str]=None,
+                 tmp_dir: Optional[str]=None):
+        self._tmp = None
+        if state_dir is None:
+            self._tmp = tempfile.TemporaryDirectory(prefix='dedup-',
+                                                    dir=tmp_dir)
+            state_dir = self._tmp.name
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_dir = state_dir
+
+        bloom_path = os.path.join(state_dir, BLOOM_FILENAME)
+        if os.path.exists(bloom_path):
+            with open(bloom_path, 'rt', encoding='utf-8') as infile:
+                self.bloom = sketches.from_dict(json.load(infile))
+        else:
+            self.bloom = sketches.BloomFilter.from_error(capacity, error)
+
+        self.db = sqlite3.connect(os.path.join(state_dir, IDS_FILENAME))
+        self.db.execute('PRAGMA journal_mode=OFF')
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS units '
+                        '(num INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS ids '
+                        '(id TEXT PRIMARY KEY, unit INTEGER) WITHOUT ROWID')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(ids)')]
+        if 'unit' not in columns:
+            # state written before the IDs were stored with their unit
+            self.db.execute('ALTER TABLE ids ADD COLUMN unit INTEGER')
+        self.db.execute('CREATE INDEX IF NOT EXISTS ids_unit ON ids (unit)')
+        self.unit = None
+
+    def begin_unit(self, name: str) -> None:
+        """Store the following IDs as written by the unit name, forgetting
+           the IDs it wrote when it was processed before."""
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO units (name) VALUES (?)',
+                            (name,))
+            self.unit = self.db.execute(
+                'SELECT num FROM units WHERE name = ?', (name,)).fetchone()[0]
+            self.db.execute('DELETE FROM ids WHERE unit = ?', (self.unit,))
+
+    def check(self, ids: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return for each ID whether it is a suspected duplicate (the Bloom
+           filter may have seen it) and whether it is a duplicate of an ID
+           already seen, in this or in previous calls."""
+        duplicates = np.zeros(len(ids), dtype=bool)
+        if not ids:
+            return duplicates, duplicates
+
+        suspected = self.bloom.add_hashes(sketches.hash_values(ids))
+
+        with self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO ids VALUES (?, ?)',
+                ((id_, self.unit)
+                 for id_, suspect in zip(ids, suspected.tolist())
+                 if not suspect))
+            # in input order, the first occurrence of a suspected ID is
+            # inserted and the following ones are duplicates
+            for num in np.flatnonzero(suspected).tolist():
+                cursor = self.db.execute(
+                    'INSERT OR IGNORE INTO ids VALUES (?, ?)',
+                    (ids[num], self.unit))
+                duplicates[num] = (cursor.rowcount == 0)
+
+        return suspected, duplicates
+
+    def save(self) -> None:
+        """Write the Bloom filter in the state directory."""
+        if self._tmp is not None:
+            return
+        path = os.path.join(self.state_dir, BLOOM_FILENAME)
+        with open(path + '.tmp', 'wt', encoding='utf-8') as outfile:
+            json.dump(self.bloom.to_dict(), outfile)
+        os.replace(path + '.tmp', path)
+
+    def close(self) -> None:
+        self.save()
+        self.db.close()
+        if self._tmp is not None:
+            self._tmp.cleanup()
+
+
+def new_stats() -> Mapping:
+    """Return an empty dictionary of dedup counts."""
+    return {
+        'checked': 0,
+        'suspected': 0,
+        'duplicates': 0,
+        'false_positives': 0,
+        'peak_filter_bytes': 0,
+    }
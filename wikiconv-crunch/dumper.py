@@ -1,17 +1,18 @@
 """Auxiliary funcitons to dump the data."""
+import hashlib
+import os
+
 import mako.runtime
 import mako.template
-from typing import List, Optional
+from typing import Iterable, List, Optional
 
 
-pages_revisions_template = '''
+page_revisions_template = '''
 <%!
     from itertools import groupby
     def groupby_action(diff):
         return groupby(diff, lambda d: d.action)
 %>
-<root>
-    % for page in pages:
     <page>
         <title>${page.title}</title>
         <id>${page.id}</id>
@@ -19,7 +20,7 @@ pages_revisions_template = '''
             % for revision in page.revisions:
             <revision>
                 <id>${revision.id}</id>
-                <user id="{$revision.user.id}" name="${revision.user.text}" />
+                <user id="${revision.user.id}" name="${revision.user.text}" />
                 <timestamp>${revision.timestamp}</timestamp>
                 <references_diff>
                     % for key, group in groupby_action(revision.references_diff):
@@ -49,8 +50,6 @@ pages_revisions_template = '''
             %endfor
         </revisions>
     </page>
-    % endfor
-</root>
 '''
 
 stats_template = '''
@@ -74,6 +73,65 @@ stats_template = '''
 '''
 
 
+# compiled templates, by template source and default filters
+_templates = dict()
+
+# directory where the compiled templates are stored, see
+# set_module_directory
+_module_directory = None
+
+
+def set_module_directory(path: Optional[str]) -> None:
+    """Store the modules of the compiled templates in the given directory,
+       so that they are reused across processes, None to keep them only in
+       memory."""
+    global _module_directory
+
+    if path is not None:
+        path = os.path.abspath(path)
+        os.makedirs(path, exist_ok=True)
+
+    _module_directory = path
+    _templates.clear()
+
+
+def get_template(
+        template: str,
+        default_filters: Optional[List[str]]=None) -> mako.template.Template:
+    """Return the compiled mako template, compiling it only the first time
+       it is requested."""
+    key = (template,
+           tuple(default_filters) if default_filters is not None else None)
+
+    xml_template = _templates.get(key)
+    if xml_template is None:
+        if _module_directory is None:
+            xml_template = mako.template.Template(
+                template,
+                default_filters=default_filters,
+            )
+        else:
+            # mako stores the compiled module only for templates read from a
+            # file, the template source is stored in the module directory
+            # under a name that depends on its content
+            digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+            template_path = os.path.join(_module_directory,
+                                         digest + '.mako')
+            if not os.path.exists(template_path):
+                with open(template_path, 'wt', encoding='utf-8') as outfile:
+                    outfile.write(template)
+
+            xml_template = mako.template.Template(
+                filename=template_path,
+                module_directory=_module_directory,
+                default_filters=default_filters,
+            )
+
+        _templates[key] = xml_template
+
+    return xml_template
+
+
 def render_template(
         template: str,
         output_handler,
@@ -83,26 +141,28 @@ def render_template(
 
     ctx = mako.runtime.Context(output_handler, **kwargs)
 
-    xml_template = mako.template.Template(
-        template,
-        default_filters=default_filters,
-    )
+    xml_template = get_template(template, default_filters=default_filters)
     xml_template.render_context(ctx)
 
 
-def serialize_page_revisions(pages, output_handler):
-    render_template(
-        pages_revisions_template,
-        output_handler,
-        default_fiters=['x'],  # XML escaping
-        pages=pages,
-    )
+def serialize_page_revisions(pages: Iterable, output_handler):
+    """Serialize the pages as they are read from the iterable, without
+       keeping all of them in memory."""
+    output_handler.write('\n<root>')
+    for page in pages:
+        render_template(
+            page_revisions_template,
+            output_handler,
+            default_filters=['str', 'x'],  # XML escaping
+            page=page,
+        )
+    output_handler.write('</root>\n')
 
 
 def serialize_stats(stats, output_handler):
     render_template(
         stats_template,
         output_handler,
-        default_filters=['x'],  # XML escaping
+        default_filters=['str', 'x'],  # XML escaping
         stats=stats,
     )
@@ -0,0 +1,433 @@
+"""Filter expressions over the fields of WikiConv objects.
+
+An expression is a Python boolean expression over the fields of the dict
+returned by types.cast_json, e.g.:
+
+    pageNamespace == 1 and type in ('ADDITION', 'CREATION')
+        and '2010-01-01' <= timestamp < '2011-01-01'
+        and (score.toxicity >= 0.8 or user.id in (86737, 3939239))
+
+Supported are the comparison operators (also chained), in and not in with a
+list of constants, is None and is not None, and, or and not. Nested fields
+are written with a dot: user.id, user.text and score.<name>. Timestamps are
+compared as UTC instants, a constant can be a date or a date and time
+(without a time zone it is UTC). A comparison on a missing field (e.g.
+user.id of an anonymous user) is false.
+
+compile_expression translates the expression into the source code of a
+single function, evaluated on a LazyRecord. Only the fields used by the
+expression are cast, and the top-level scalar fields (RAW_FIELDS) are read
+from the raw line, as is their absence, so the line is decoded only if a
+clause needs a nested or a text field (also to test it with is None), or a
+top-level field whose value can not be read from the raw line (null or with
+escape sequences). The operands of and and or are reordered so that the
+cheapest and most selective clauses are evaluated first.
+"""
+import ast
+import functools
+import json
+import operator
+
+from typing import Any, Callable, Iterable, List, Mapping, Optional, Tuple
+
+from . import types
+
+# fields that can be read from the raw line with types.raw_value: they are
+# top-level keys that never appear in nested objects
+RAW_FIELDS = {
+    'revId',
+    'type',
+    'conversationId',
+    'pageTitle',
+    'timestamp',
+    'pageId',
+    'parentId',
+    'ancestorId',
+    'comment',
+    'pageNamespace',
+}
+
+# fields with their cast, None for strings
+FIELD_CASTS = {
+    'id': None,
+    'revId': 'int',
+    'type': None,
+    'conversationId': None,
+    'pageTitle': None,
+    'content': None,
+    'cleanedContent': None,
+    'user.id': 'int',
+    'user.text': None,
+    'timestamp': '_timestamp_key',
+    'pageId': 'int',
+    'parentId': None,
+    'ancestorId': None,
+    'comment': None,
+    'pageNamespace': 'int',
+}
+FIELD_CASTS.update(('score.' + name, 'float') for name in types.SCORE_FIELDS)
+
+# fields that may be missing or null
+OPTIONAL_FIELDS = {'user.id', 'user.text', 'parentId', 'comment'}
+
+# estimated cost of reading a field, relative to a raw string field; the
+# cost of decoding the line is added to the fields that are not raw
+DECODE_COST = 50
+CAST_COST = 1
+
+# estimated share of the objects that pass a comparison
+SELECTIVITY = {
+    ast.Eq: 0.1,
+    ast.NotEq: 0.9,
+    ast.Lt: 0.5,
+    ast.LtE: 0.5,
+    ast.Gt: 0.5,
+    ast.GtE: 0.5,
+    ast.In: 0.1,
+    ast.NotIn: 0.9,
+    ast.Is: 0.5,
+    ast.IsNot: 0.5,
+}
+
+OPERATORS = {
+    ast.Eq: '==',
+    ast.NotEq: '!=',
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+    ast.In: 'in',
+    ast.NotIn: 'not in',
+    ast.Is: 'is',
+    ast.IsNot: 'is not',
+}
+
+# the comparison a op b written as b op' a
+SWAPPED = {
+    ast.Eq: ast.Eq,
+    ast.NotEq: ast.NotEq,
+    ast.Lt: ast.Gt,
+    ast.LtE: ast.GtE,
+    ast.Gt: ast.Lt,
+    ast.GtE: ast.LtE,
+}
+
+
+class LazyRecord(object):
+    """WikiConv object read from a raw JSON line, decoded only when a field
+       can not be read from the raw line."""
+    __slots__ = ('line', 'loads', '_obj')
+
+    def __init__(self, line: str, loads: Callable[[str], Any]=json.loads):
+        self.line = line
+        self.loads = loads
+        self._obj = None
+
+    @property
+    def decoded(self) -> bool:
+        """True if the line has been decoded."""
+        return self._obj is not None
+
+    @property
+    def obj(self) -> Mapping:
+        """The decoded object."""
+        if self._obj is None:
+            self._obj = self.loads(self.line)
+        return self._obj
+
+    def raw(self, key: str) -> Any:
+        """Return the value of a top-level scalar field, from the raw line
+           if possible. A missing key is detected on the raw line too, so
+           e.g. parentId is None does not decode the line."""
+        value = types.raw_value(self.line, key)
+        if value is None:
+            if self._obj is None and not types.raw_has_key(self.line, key):
+                return None
+            return self.obj.get(key)
+        return value
+
+
+def timestamp_constant(value: str) -> str:
+    """Return a timestamp constant of an expression as a sort key of
+       types.timestamp_key, assuming UTC if it has no time zone."""
+    parsed = types.parse_timestamp(value)
+    if parsed.tzinfo is None:
+        return parsed.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return types.timestamp_key(value)
+
+
+def _optional(value: Any, compare: Callable[[Any, Any], bool],
+              constant: Any) -> bool:
+    return value is not None and compare(value, constant)
+
+
+class Clause(object):
+    """Compiled node of an expression: source code, fields, estimated cost
+       and selectivity."""
+
+    def __init__(self, source: str, fields: set, cost: float,
+                 selectivity: float):
+        self.source = source
+        self.fields = fields
+        self.cost = cost
+        self.selectivity = selectivity
+
+
+class Compiler(object):
+    """Translate the AST of an expression into Clauses."""
+
+    def __init__(self):
+        # constants of the generated code, by name
+        self.constants = dict()
+
+    def constant(self, value: Any) -> str:
+        """Return the name of a constant of the generated code."""
+        name = '_c{}'.format(len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def field(self, node: ast.AST) -> Optional[str]:
+        """Return the name of the field of a node, None if it is not a
+           field."""
+        if isinstance(node, ast.Name):
+            name = node.id
+        elif (isinstance(node, ast.Attribute)
+                and isinstance(node.value, ast.Name)):
+            name = '{}.{}'.format(node.value.id, node.attr)
+        else:
+            return None
+
+        if name not in FIELD_CASTS:
+            raise ValueError("Unknown field: {}".format(name))
+        return name
+
+    def literal(self, node: ast.AST) -> Any:
+        try:
+            return ast.literal_eval(node)
+        except ValueError:
+            raise ValueError("Not a constant: {}".format(ast.dump(node)))
+
+    def accessor(self, field: str, cast: bool=True) -> Tuple[str, float]:
+        """Return the source code reading a field, cast if cast is True, and
+           its cost."""
+        cost = 1
+        if field in RAW_FIELDS:
+            source = 'r.raw({!r})'.format(field)
+        elif field.startswith('user.'):
+            source = "r.obj.get('user', {{}}).get({!r})".format(field[5:])
+            cost += DECODE_COST
+        elif field.startswith('score.'):
+            source = "r.obj['score'][{!r}]".format(field[6:])
+            cost += DECODE_COST
+        else:
+            source = 'r.obj[{!r}]'.format(field)
+            cost += DECODE_COST
+
+        function = FIELD_CASTS[field]
+        if cast and function is not None:
+            cost += CAST_COST
+            if field in OPTIONAL_FIELDS:
+                source = '_none_or({}, {})'.format(function, source)
+            else:
+                source = '{}({})'.format(function, source)
+        return source, cost
+
+    def cast_constant(self, field: str, value: Any) -> Any:
+        cast = FIELD_CASTS[field]
+        if value is None:
+            return None
+        if cast == 'int':
+            return int(value)
+        if cast == 'float':
+            return float(value)
+        if cast == '_timestamp_key':
+            return timestamp_constant(value)
+        return str(value)
+
+    def comparison(self, field: str, op: type, value: Any) -> Clause:
+        """Compile field op value."""
+        if op in (ast.Is, ast.IsNot):
+            if value is not None:
+                raise ValueError("is and is not only compare with None")
+            source, cost = self.accessor(field, cast=False)
+            return Clause('({} {} None)'.format(source, OPERATORS[op]),
+                          {field}, cost, SELECTIVITY[op])
+
+        selectivity = SELECTIVITY[op]
+        if op in (ast.In, ast.NotIn):
+            if not isinstance(value, (list, tuple, set, frozenset)):
+                raise ValueError("in and not in need a list of constants")
+            value = frozenset(self.cast_constant(field, item)
+                              for item in value)
+            if op is ast.In:
+                selectivity = min(0.1 * len(value), 0.9)
+            else:
+                selectivity = max(1 - 0.1 * len(value), 0.1)
+        else:
+            value = self.cast_constant(field, value)
+        constant = self.constant(value)
+        source, cost = self.accessor(field)
+
+        if field in OPTIONAL_FIELDS:
+            return Clause('_optional({}, _op_{}, {})'.format(
+                              source, op.__name__, constant),
+                          {field}, cost, selectivity)
+        return Clause('({} {} {})'.format(source, OPERATORS[op], constant),
+                      {field}, cost, selectivity)
+
+    def compile(self, node: ast.AST) -> Clause:
+        if isinstance(node, ast.Expression):
+            return self.compile(node.body)
+
+        if isinstance(node, ast.BoolOp):
+            return self.boolean(node)
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            clause = self.compile(node.operand)
+            return Clause('(not {})'.format(clause.source),
+                          clause.fields,
+                          clause.cost,
+                          1 - clause.selectivity)
+
+        if isinstance(node, ast.Compare):
+            field = None
+            if len(node.ops) == 2:
+                field = self.field(node.comparators[0])
+            if (field is not None and field not in OPTIONAL_FIELDS
+                    and all(type(op) in SWAPPED for op in node.ops)):
+                # a window low < field < high reads the field once
+                source, cost = self.accessor(field)
+                low = self.constant(self.cast_constant(
+                    field, self.literal(node.left)))
+                high = self.constant(self.cast_constant(
+                    field, self.literal(node.comparators[1])))
+                return Clause('({} {} {} {} {})'.format(
+                                  low, OPERATORS[type(node.ops[0])],
+                                  source,
+                                  OPERATORS[type(node.ops[1])], high),
+                              {field}, cost,
+                              SELECTIVITY[type(node.ops[0])]
+                              * SELECTIVITY[type(node.ops[1])])
+
+            # a < b < c is a < b and b < c
+            clauses = []
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                clauses.append(self.compare(left, type(op), right))
+                left = right
+            if len(clauses) == 1:
+                return clauses[0]
+            return self.conjunction(clauses)
+
+        if isinstance(node, ast.Constant) and isinstance(node.value, bool):
+            return Clause(repr(node.value), set(), 0,
+                          1.0 if node.value else 0.0)
+
+        raise ValueError("Unsupported expression: {}"
+                         .format(ast.dump(node)))
+
+    def compare(self, left: ast.AST, op: type, right: ast.AST) -> Clause:
+        field = self.field(left)
+        if field is not None:
+            if self.field(right) is not None:
+                raise ValueError("Fields can only be compared with "
+                                 "constants")
+            return self.comparison(field, op, self.literal(right))
+
+        field = self.field(right)
+        if field is None or op not in SWAPPED:
+            raise ValueError("A comparison needs a field on the left and a "
+                             "constant on the right")
+        return self.comparison(field, SWAPPED[op], self.literal(left))
+
+    def boolean(self, node: ast.BoolOp) -> Clause:
+        clauses = [self.compile(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+            return self.conjunction(clauses)
+        return self.disjunction(clauses)
+
+    def conjunction(self, clauses: List[Clause]) -> Clause:
+        # evaluate first the clauses that reject the most objects at the
+        # lowest cost
+        clauses = sorted(clauses,
+                         key=lambda c: c.cost / max(1 - c.selectivity, 1e-3))
+        return Clause('({})'.format(' and '.join(c.source for c in clauses)),
+                      set().union(*(c.fields for c in clauses)),
+                      _combined_cost(clauses),
+                      _product(c.selectivity for c in clauses))
+
+    def disjunction(self, clauses: List[Clause]) -> Clause:
+        # evaluate first the clauses that accept the most objects at the
+        # lowest cost
+        clauses = sorted(clauses,
+                         key=lambda c: c.cost / max(c.selectivity, 1e-3))
+        return Clause('({})'.format(' or '.join(c.source for c in clauses)),
+                      set().union(*(c.fields for c in clauses)),
+                      _combined_cost(clauses),
+                      1 - _product(1 - c.selectivity for c in clauses))
+
+
+def _product(values: Iterable[float]) -> float:
+    return functools.reduce(operator.mul, values, 1.0)
+
+
+def _combined_cost(clauses: List[Clause]) -> float:
+    # the line is decoded at most once
+    cost = sum(c.cost for c in clauses)
+    decoding = sum(1 for c in clauses if c.cost >= DECODE_COST)
+    return cost - max(decoding - 1, 0) * DECODE_COST
+
+
+class CompiledExpression(object):
+    """Predicate of a compiled expression, called on a LazyRecord."""
+
+    def __init__(self, expression: str, source: str, fields: set,
+                 function: Callable[[LazyRecord], bool]):
+        self.expression = expression
+        self.source = source
+        self.fields = fields
+        self.function = function
+
+    @property
+    def needs_decoding(self) -> bool:
+        """True if some field can not be read from the raw line."""
+        return not self.fields <= RAW_FIELDS
+
+    def __call__(self, record: LazyRecord) -> bool:
+        return self.function(record)
+
+
+def _none_or(cast: Callable[[Any], Any], value: Any) -> Any:
+    return None if value is None else cast(value)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_expression(expression: str) -> CompiledExpression:
+    """Compile an expression into a predicate, raising ValueError if it is
+       not valid."""
+    try:
+        # parenthesized, so that the expression can span several lines
+        tree = ast.parse('(' + expression.strip() + ')', mode='eval')
+    except SyntaxError as exc:
+        raise ValueError("Invalid expression: {}".format(exc))
+
+    compiler = Compiler()
+    clause = compiler.compile(tree)
+
+    source = 'def _predicate(r):\n    return {}\n'.format(clause.source)
+    namespace = {
+        '_timestamp_key': types.timestamp_key,
+        '_none_or': _none_or,
+        '_optional': _optional,
+    }
+    namespace.update(('_op_' + op.__name__, getattr(operator, name))
+                     for op, name in [(ast.Eq, 'eq'), (ast.NotEq, 'ne'),
+                                      (ast.Lt, 'lt'), (ast.LtE, 'le'),
+                                      (ast.Gt, 'gt'), (ast.GtE, 'ge')])
+    namespace['_op_In'] = lambda value, values: value in values
+    namespace['_op_NotIn'] = lambda value, values: value not in values
+    namespace.update(compiler.constants)
+    exec(compile(source, '<expression>', 'exec'), namespace)
+
+    return CompiledExpression(expression, source, clause.fields,
+                              namespace['_predicate'])
@@ -2,14 +2,109 @@
 import io
 import json
 import bz2
+import functools
 import gzip
+import itertools
+import collections
+import concurrent.futures
 import subprocess
+import zlib
 
 import pathlib
-from typing import IO, Optional, Union
+from typing import (Any, Callable, IO, Iterable, Iterator, List, Optional,
+                    Tuple, Union)
 
 import compressed_stream as cs
 
+from . import sorting
+
+# optional faster JSON parsers
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# JSON decoders, in order of preference
+JSON_DECODERS = ['orjson', 'ujson', 'json']
+
+
+def _with_fallback(fast_loads):
+    """Wrap a fast JSON decoder, falling back to the json module on the
+       inputs it rejects (e.g. lone surrogates)."""
+    def loads(data):
+        try:
+            return fast_loads(data)
+        except ValueError:
+            return json.loads(data)
+
+    return loads
+
+
+def available_json_decoders() -> List[str]:
+    """Return the names of the installed JSON decoders."""
+    modules = {'orjson': orjson, 'ujson': ujson, 'json': json}
+    return [name for name in JSON_DECODERS if modules[name] is not None]
+
+
+def get_json_decoder(name: str='auto') -> Callable[[str], Any]:
+    """Return the loads function of a JSON decoder.
+
+       With 'auto' the fastest installed decoder is used. Faster decoders
+       fall back to the json module on the inputs they reject.
+    """
+    if name == 'auto':
+        name = available_json_decoders()[0]
+
+    if name == 'json':
+        return json.loads
+    elif name == 'orjson' and orjson is not None:
+        return _with_fallback(orjson.loads)
+    elif name == 'ujson' and ujson is not None:
+        return _with_fallback(ujson.loads)
+    else:
+        raise ValueError("JSON decoder not available: {}".format(name))
+
+
+# number of lines decoded with a single call by decode_batch in
+# open_jsonobjects_file
+DECODE_BATCH_SIZE = 1000
+
+
+def decode_batch(
+        lines: List[str],
+        loads: Callable[[str], Any]=json.loads) -> List[Any]:
+    """Decode a batch of JSON objects, one per line.
+
+       The lines are decoded with a single call as the items of a JSON
+       array, which saves the overhead of a call per line. If the array is
+       not valid, or does not have an item per line, the lines are decoded
+       one at a time, so that errors are raised for the offending line.
+    """
+    try:
+        objs = loads('[' + ','.join(lines) + ']')
+    except ValueError:
+        objs = None
+    if objs is None or len(objs) != len(lines):
+        objs = [loads(line) for line in lines]
+    return objs
+
+
+def _decode_lines(
+        lines: Iterable[str],
+        loads: Callable[[str], Any]) -> Iterator[Any]:
+    lines = iter(lines)
+    while True:
+        batch = list(itertools.islice(lines, DECODE_BATCH_SIZE))
+        if not batch:
+            break
+        yield from decode_batch(batch, loads)
+
 
 def open_csv_file(path: Union[str, IO]):
     """Open a csv file, decompressing it if necessary."""
@@ -19,14 +114,234 @@ def open_csv_file(path: Union[str, IO]):
     return f
 
 
-def open_jsonobjects_file(path: Union[str, IO]):
+def open_jsonobjects_file(
+        path: Union[str, IO],
+        loads: Callable[[str], Any]=json.loads):
     """Open a file of JSON object, one per line,
        decompressing it if necessary."""
     f = cs.functions.open_file(
         cs.functions.file(path)
     )
 
-    return (json.loads(line) for line in f)
+    if loads is json.loads:
+        # the json module decodes a batch faster as a single array, faster
+        # parsers do not gain from it (see benchmarks/json_decoders.py)
+        return _decode_lines(f, loads)
+    return (loads(line) for line in f)
+
+
+def open_jsonlines_file(path: Union[str, IO]):
+    """Open a file of JSON object, one per line, decompressing it if
+       necessary, and return the raw lines without decoding them."""
+    f = cs.functions.open_file(
+        cs.functions.file(path)
+    )
+
+    return f
+
+
+# size of the chunks read from a compressed file when indexing it
+INDEX_CHUNK_SIZE = 1024*1024
+
+
+def compression_from_path(path: str) -> Optional[str]:
+    """Return the compression of a file from its extension."""
+    if path.endswith('.7z'):
+        return '7z'
+    elif path.endswith('.bz2'):
+        return 'bz2'
+    elif path.endswith('.gz'):
+        return 'gzip'
+    else:
+        return None
+
+
+def _new_decompressor(compression: Optional[str]):
+    if compression == 'gzip':
+        return zlib.decompressobj(wbits=16+zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    else:
+        raise ValueError("Unsupported compression: {}".format(compression))
+
+
+def _iter_decompressed(
+        raw: IO,
+        compression: Optional[str]) -> Iterator[Tuple[int, bytes]]:
+    """Yield (member offset, data) for the decompressed data of a file,
+       where member offset is the offset in the compressed file of the
+       gzip member (or bz2 stream) the data belongs to.
+
+       Plain files are a single member starting at 0.
+    """
+    if compression is None:
+        for chunk in iter(lambda: raw.read(INDEX_CHUNK_SIZE), b''):
+            yield 0, chunk
+        return
+
+    decompressor = _new_decompressor(compression)
+    member_offset = 0
+    consumed = 0
+    for chunk in iter(lambda: raw.read(INDEX_CHUNK_SIZE), b''):
+        data = chunk
+        while data:
+            out = decompressor.decompress(data)
+            if out:
+                yield member_offset, out
+
+            if decompressor.eof:
+                unused = decompressor.unused_data
+                consumed += len(data) - len(unused)
+                data = unused
+                # gzip files may be padded with zeros after the last member
+                if not data.strip(b'\x00'):
+                    consumed += len(data)
+                    data = b''
+                member_offset = consumed
+                decompressor = _new_decompressor(compression)
+            else:
+                consumed += len(data)
+                data = b''
+
+
+def iter_line_offsets(path: str) -> Iterator[Tuple[int, int, str]]:
+    """Yield (restart offset, skip, line) for each line of a plain, gzip or
+       bz2 file.
+
+       Reading can be restarted at the line seeking to the restart offset in
+       the (compressed) file, decompressing from there and skipping the
+       first skip bytes of the decompressed data. For plain files every line
+       is a restart point, for compressed files each gzip member (or bz2
+       stream) is.
+    """
+    compression = compression_from_path(path)
+    if compression == '7z':
+        raise ValueError("7z files can not be read at an offset")
+
+    with open(path, 'rb') as raw:
+        pending = []
+        point = None
+        current_member = None
+        pos = 0
+        for member_offset, data in _iter_decompressed(raw, compression):
+            if member_offset != current_member:
+                current_member = member_offset
+                pos = 0
+
+            start = 0
+            while True:
+                end = data.find(b'\n', start)
+                if end < 0:
+                    break
+
+                if pending:
+                    pending.append(data[start:end+1])
+                    line = b''.join(pending)
+                    pending = []
+                else:
+                    line = data[start:end+1]
+                    point = (pos + start, 0) if compression is None \
+                        else (member_offset, pos + start)
+
+                yield point[0], point[1], line.decode('utf-8')
+                start = end + 1
+
+            if start < len(data):
+                if not pending:
+                    point = (pos + start, 0) if compression is None \
+                        else (member_offset, pos + start)
+                pending.append(data[start:])
+
+            pos += len(data)
+
+        if pending:
+            yield point[0], point[1], b''.join(pending).decode('utf-8')
+
+
+def _open_at(raw: IO, compression: Optional[str]) -> IO:
+    """Return a binary stream decompressing raw from its current position."""
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(raw, mode='rb')
+    else:
+        return raw
+
+
+def _skip_bytes(stream: IO, nbytes: int) -> int:
+    """Read and discard nbytes bytes of a stream, returning how many were
+       read."""
+    skipped = 0
+    while skipped < nbytes:
+        data = stream.read(min(nbytes - skipped, INDEX_CHUNK_SIZE))
+        if not data:
+            break
+        skipped += len(data)
+    return skipped
+
+
+def read_line_blocks(
+        path: str,
+        blocks: Iterable[Tuple[int, int, int, int]]) -> Iterator[str]:
+    """Yield the lines of the given blocks of a file.
+
+       Each block is a tuple (block number, restart offset, skip, number of
+       lines) as recorded by iter_line_offsets. Blocks must be sorted. A
+       block after the previous one in the same gzip member (or bz2 stream)
+       is reached reading forward, so a single-member file is decompressed
+       at most once; otherwise the file is re-opened at the restart offset.
+    """
+    compression = compression_from_path(path)
+    with open(path, 'rb') as raw:
+        stream = None
+        # restart offset of the open stream and decompressed bytes read
+        # from it
+        current_offset = None
+        position = 0
+        for _, offset, skip, nlines in blocks:
+            if (stream is None or compression is None
+                    or offset != current_offset or skip < position):
+                raw.seek(offset)
+                stream = _open_at(raw, compression)
+                current_offset = offset
+                position = 0
+            position += _skip_bytes(stream, skip - position)
+
+            for _ in range(nlines):
+                line = stream.readline()
+                if not line:
+                    break
+                position += len(line)
+                yield line.decode('utf-8')
+
+
+def read_lines_at(
+        path: str,
+        points: Iterable[Tuple[int, int, int]]) -> Iterator[str]:
+    """Yield the lines of a file at the given (line number, restart
+       offset, skip) points, as recorded by iter_line_offsets.
+
+       Points must be sorted by line number. A line after the previous one
+       with the same restart offset (in the same gzip member or bz2 stream)
+       is reached reading forward, otherwise the file is re-opened at its
+       restart offset.
+    """
+    compression = compression_from_path(path)
+    with open(path, 'rb') as raw:
+        stream = None
+        current = None
+        for nline, offset, skip in points:
+            if (stream is None or current is None or nline <= current[0]
+                    or offset != current[1] or compression is None):
+                raw.seek(offset)
+                stream = _open_at(raw, compression)
+                _skip_bytes(stream, skip)
+            else:
+                for _ in range(nline - current[0] - 1):
+                    stream.readline()
+
+            current = (nline, offset)
+            yield stream.readline().decode('utf-8')
 
 
 def compressor_7z(file_path: str):
@@ -40,18 +355,327 @@ def compressor_7z(file_path: str):
     return io.TextIOWrapper(p.stdin, encoding='utf-8')
 
 
-def output_writer(path: str, compression: Optional[str]):
-    """Write data to a compressed file."""
+class ParallelCompressor(object):
+    """Text file-like object that compresses data in independent blocks on
+       a pool of threads.
+
+       Each block of about block_size bytes is compressed as a gzip member
+       or as a bz2 stream, the output is a standard multi-member gzip (or
+       multi-stream bz2) file that can be read by the usual tools. zlib and
+       bz2 release the GIL while compressing, so blocks are compressed in
+       parallel.
+    """
+
+    def __init__(self,
+                 path: str,
+                 compression: str,
+                 workers: int,
+                 block_size: int=4*1024*1024,
+                 compresslevel: int=9):
+        if compression == 'gzip':
+            self._compress = functools.partial(gzip.compress,
+                                               compresslevel=compresslevel,
+                                               mtime=0)
+        elif compression == 'bz2':
+            self._compress = functools.partial(bz2.compress,
+                                               compresslevel=compresslevel)
+        else:
+            raise ValueError(
+                "Unsupported compression: {}".format(compression))
+
+        self.block_size = block_size
+        self.max_pending = 2*workers
+
+        self._outfile = open(path, 'wb')
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self._pending = collections.deque()
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data: str) -> int:
+        """Write a string."""
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size >= self.block_size:
+            self._submit_block()
+
+        return len(data)
+
+    def _submit_block(self) -> None:
+        block = ''.join(self._chunks).encode('utf-8')
+        self._chunks = []
+        self._size = 0
+
+        self._pending.append(self._executor.submit(self._compress, block))
+        # blocks are written in order, waiting for the oldest block when
+        # too many are pending
+        while (self._pending
+               and (self._pending[0].done()
+                    or len(self._pending) > self.max_pending)):
+            self._outfile.write(self._pending.popleft().result())
+
+    def close(self) -> None:
+        """Compress the remaining data and close the file."""
+        if self._chunks:
+            self._submit_block()
+
+        while self._pending:
+            self._outfile.write(self._pending.popleft().result())
+
+        self._executor.shutdown()
+        self._outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compressed_path(path: str, compression: Optional[str]) -> str:
+    """Return the path of a file with the extension of the compression."""
     if compression == '7z':
-        return compressor_7z(path + '.7z')
+        return path + '.7z'
     elif compression == 'bz2':
-        return bz2.open(path + '.bz2', 'wt', encoding='utf-8')
+        return path + '.bz2'
     elif compression == 'gzip':
-        return gzip.open(path + '.gz', 'wt', encoding='utf-8')
+        return path + '.gz'
+    else:
+        return path
+
+
+# paths of the outputs written since the last call of take_outputs()
+_outputs = []
+
+
+def register_output(path: str) -> None:
+    """Record that an output file (or directory) was written, see
+       take_outputs. output_writer registers the files it opens."""
+    _outputs.append(str(path))
+
+
+def take_outputs() -> List[str]:
+    """Return the paths of the outputs registered since the last call, in
+       order and without repetitions, and forget them."""
+    paths = list(collections.OrderedDict.fromkeys(_outputs))
+    del _outputs[:]
+    return paths
+
+
+def output_writer(
+        path: str,
+        compression: Optional[str],
+        workers: int=0,
+        block_size: int=4*1024*1024):
+    """Write data to a compressed file.
+
+       If workers is positive gzip and bz2 data is compressed in independent
+       blocks of about block_size bytes by a pool of workers threads.
+    """
+    path = compressed_path(path, compression)
+    register_output(path)
+    if compression == '7z':
+        return compressor_7z(path)
+    elif compression == 'bz2':
+        if workers > 0:
+            return ParallelCompressor(path, 'bz2',
+                                      workers=workers,
+                                      block_size=block_size)
+        return bz2.open(path, 'wt', encoding='utf-8')
+    elif compression == 'gzip':
+        if workers > 0:
+            return ParallelCompressor(path, 'gzip',
+                                      workers=workers,
+                                      block_size=block_size)
+        return gzip.open(path, 'wt', encoding='utf-8')
     else:
         return open(path, 'wt', encoding='utf-8')
 
 
+class JSONLinesWriter(object):
+    """Write serialized JSON objects, one per line.
+
+       Lines are buffered and written with a single call every buffer_size
+       characters.
+    """
+
+    def __init__(self, output: IO, buffer_size: int=1024*1024):
+        self.output = output
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+
+    def write_record(self, line: str) -> None:
+        """Write a serialized object."""
+        self._buffer.append(line)
+        self._buffered += len(line) + 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered lines."""
+        if self._buffer:
+            self._buffer.append('')
+            self.output.write('\n'.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self) -> None:
+        self.flush()
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NullWriter(object):
+    """Writer of dry runs, accepts and discards records of any kind."""
+
+    def write_record(self, record: Any) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def shard_of(key: Any, nshards: int) -> int:
+    """Return the shard of a key, stable across runs and processes."""
+    return zlib.crc32(str(key).encode('utf-8')) % nshards
+
+
+def shard_path(path: str, shard: int, nshards: int) -> str:
+    """Return the path of a shard, without the extension of the
+       compression."""
+    return '{path}.shard-{shard:04d}-of-{nshards:04d}.json'.format(
+        path=path,
+        shard=shard,
+        nshards=nshards,
+    )
+
+
+class ShardedWriter(object):
+    """Write serialized JSON objects, one per line, in nshards compressed
+       files that are kept open at once.
+
+       Lines are added with the shard they belong to (see shard_of) and
+       buffered, each shard is written in batches of about buffer_size
+       characters. If sort_memory is given the lines of each shard are
+       sorted by their key with an external sorter using at most about
+       sort_memory bytes, shared among the shards, and written on close.
+       Each output is wrapped with wrap, if given.
+    """
+
+    def __init__(self,
+                 path: str,
+                 nshards: int,
+                 compression: Optional[str],
+                 workers: int=0,
+                 block_size: int=4*1024*1024,
+                 buffer_size: int=256*1024,
+                 sort_memory: Optional[int]=None,
+                 tmp_dir: Optional[str]=None,
+                 wrap: Optional[Callable[[IO], IO]]=None):
+        assert (nshards > 0), "The number of shards must be positive"
+
+        self.paths = [compressed_path(shard_path(path, shard, nshards),
+                                      compression)
+                      for shard in range(nshards)]
+        self.buffer_size = buffer_size
+
+        self.outputs = []
+        for shard in range(nshards):
+            output = output_writer(shard_path(path, shard, nshards),
+                                   compression,
+                                   workers=workers,
+                                   block_size=block_size)
+            if wrap is not None:
+                output = wrap(output)
+            self.outputs.append(output)
+
+        self._buffers = [[] for _ in range(nshards)]
+        self._buffered = [0] * nshards
+
+        self.sorters = None
+        if sort_memory is not None:
+            self.sorters = [sorting.ExternalSorter(sort_memory // nshards,
+                                                   tmp_dir=tmp_dir)
+                            for _ in range(nshards)]
+
+    @property
+    def nruns(self) -> int:
+        """Number of sorted runs spilled to disk by the shards."""
+        if self.sorters is None:
+            return 0
+        return sum(sorter.nruns for sorter in self.sorters)
+
+    @property
+    def strategy(self) -> str:
+        """How the shards are sorted (see sorting.ExternalSorter.strategy),
+           'unsorted' if they are written in input order."""
+        if self.sorters is None:
+            return 'unsorted'
+        return ','.join(sorted({sorter.strategy
+                                for sorter in self.sorters}))
+
+    @property
+    def input_runs(self) -> int:
+        """Number of runs of objects added in key order to the shards."""
+        if self.sorters is None:
+            return 0
+        return sum(sorter.input_runs for sorter in self.sorters)
+
+    def write_record(self, shard: int, line: str) -> None:
+        """Write a serialized object in a shard."""
+        buffer = self._buffers[shard]
+        buffer.append(line)
+        buffer.append('\n')
+        self._buffered[shard] += len(line) + 1
+        if self._buffered[shard] >= self.buffer_size:
+            self._flush(shard)
+
+    def add(self, key: Any, payload: Tuple[int, str]) -> None:
+        """Add a (shard, serialized object) pair, sorting it by key within
+           its shard if the shards are sorted, with the same interface of
+           sorting.ExternalSorter."""
+        shard, line = payload
+        if self.sorters is None:
+            self.write_record(shard, line)
+        else:
+            self.sorters[shard].add(key, line)
+
+    def _flush(self, shard: int) -> None:
+        if self._buffers[shard]:
+            self.outputs[shard].write(''.join(self._buffers[shard]))
+            self._buffers[shard] = []
+            self._buffered[shard] = 0
+
+    def close(self) -> None:
+        """Write the sorted shards and the buffered lines, and close the
+           outputs."""
+        for shard, output in enumerate(self.outputs):
+            if self.sorters is not None:
+                for line in self.sorters[shard].sorted():
+                    self.write_record(shard, line)
+            self._flush(shard)
+            output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def create_path(path: Union[pathlib.Path, str]):
     """Create a path, which may or may not exist."""
     path = pathlib.Path(path)
@@ -0,0 +1,142 @@
+"""Lightweight named timers and counters.
+
+Timers accumulate wall-clock seconds and number of calls, counters
+accumulate integers (e.g. bytes read or written, counted UTF-8 encoded for
+text). Hot loops should measure a whole batch and add it with a single call
+rather than timing each object.
+"""
+import itertools
+import resource
+import threading
+import time
+
+from typing import IO, Iterable, Iterator, List, Mapping, TypeVar, Union
+
+T = TypeVar('T')
+
+
+def nbytes(data: Union[str, bytes]) -> int:
+    """Return the size of data in bytes, UTF-8 encoded if it is text."""
+    if isinstance(data, str) and not data.isascii():
+        return len(data.encode('utf-8'))
+    return len(data)
+
+
+def batch_nbytes(batch: List[Union[str, bytes]]) -> int:
+    """Return the total size of the items of batch in bytes."""
+    if isinstance(batch[0], str):
+        if all(map(str.isascii, batch)):
+            return sum(map(len, batch))
+        return nbytes(''.join(batch))
+    return sum(map(len, batch))
+
+
+def peak_rss() -> int:
+    """Return the peak resident set size of the process, in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Metrics(object):
+    """Named timers and counters, safe to update from several threads."""
+
+    def __init__(self):
+        self.timers = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+
+    def add_time(self, name: str, seconds: float, calls: int=1) -> None:
+        """Add seconds to the timer name."""
+        with self._lock:
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += calls
+
+    def count(self, name: str, value: int=1) -> None:
+        """Add value to the counter name."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timed_iter(self,
+                   iterable: Iterable[T],
+                   name: str,
+                   counter: str=None,
+                   batch_size: int=1000) -> Iterator[T]:
+        """Iterate over iterable, adding the time spent waiting for the items
+           to the timer name and their size in bytes to counter.
+
+           Items are read ahead in batches of batch_size, each batch is
+           timed and measured at once.
+        """
+        iterator = iter(iterable)
+        elapsed = 0.0
+        calls = 0
+        size = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = list(itertools.islice(iterator, batch_size))
+                elapsed += time.perf_counter() - start
+                if not batch:
+                    break
+                calls += len(batch)
+                if counter is not None:
+                    size += batch_nbytes(batch)
+
+                yield from batch
+        finally:
+            self.add_time(name, elapsed, calls)
+            if counter is not None:
+                self.count(counter, size)
+
+    def as_dict(self) -> Mapping:
+        """Return the timers and counters as a stats dictionary."""
+        with self._lock:
+            return {
+                'timers': {name: {'seconds': round(seconds, 3),
+                                  'calls': calls}
+                           for name, (seconds, calls) in self.timers.items()},
+                'counters': dict(self.counters),
+                'peak_rss_kb': peak_rss(),
+            }
+
+
+class TimedWriter(object):
+    """File-like object adding the time spent writing (and compressing) to
+       a timer and the size of the written data in bytes to a counter."""
+
+    def __init__(self,
+                 output: IO,
+                 metrics: Metrics,
+                 name: str='compression',
+                 counter: str='bytes_out'):
+        self.output = output
+        self.metrics = metrics
+        self.name = name
+        self.counter = counter
+
+        self._elapsed = 0.0
+        self._calls = 0
+        self._size = 0
+
+    def write(self, data: str) -> int:
+        start = time.perf_counter()
+        res = self.output.write(data)
+        self._elapsed += time.perf_counter() - start
+        self._calls += 1
+        self._size += nbytes(data)
+
+        return res
+
+    def close(self) -> None:
+        start = time.perf_counter()
+        self.output.close()
+        self._elapsed += time.perf_counter() - start
+
+        self.metrics.add_time(self.name, self._elapsed, self._calls)
+        self.metrics.count(self.counter, self._size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
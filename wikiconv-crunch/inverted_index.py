@@ -0,0 +1,314 @@
+"""On-disk inverted index of a text field of WikiConv objects.
+
+The index of a file of JSON objects maps each term of the field to the
+posting list of the ordinals of the objects (the line numbers) that contain
+it, and records where each object can be read from the file. It is made of:
+
+  * <prefix>.json: metadata, with the indexed file and its size and
+    modification time;
+  * <prefix>.lexicon: the terms, UTF-8 encoded, sorted and concatenated;
+  * <prefix>.terms.npy: for each term (plus a final sentinel) the offset of
+    the term in the lexicon, the offset of its posting list and the number
+    of its postings;
+  * <prefix>.postings: the posting lists, as varint encoded gaps between
+    increasing ordinals;
+  * <prefix>.offsets.npy: the restart offset and skip of each object (see
+    file_utils.iter_line_offsets).
+
+The binary files are memory-mapped by TextIndex, terms are looked up with a
+binary search, so a query reads only the posting lists of its terms.
+"""
+import array
+import itertools
+import json
+import mmap
+import os
+import re
+
+from operator import itemgetter
+from typing import Iterable, Mapping, Optional, Set
+
+import numpy as np
+
+from . import sorting
+
+INDEX_VERSION = 1
+
+# terms are the lowercased words of at least MIN_TERM_LENGTH and at most
+# MAX_TERM_LENGTH characters
+TERM_RE = re.compile(r'\w+')
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+
+# suffixes of the files of an index, after its prefix
+SUFFIXES = ('json', 'lexicon', 'terms.npy', 'postings', 'offsets.npy')
+
+
+def tokenize(text: Optional[str]) -> Set[str]:
+    """Return the terms of a text."""
+    if not text:
+        return set()
+    return {term for term in TERM_RE.findall(text.lower())
+            if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH}
+
+
+def encode_varints(values: np.ndarray) -> bytes:
+    """Encode non-negative integers with 7 bits per byte, the high bit set
+       on all the bytes but the last of each integer."""
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        nbytes += (values >= np.uint64(1 << shift))
+
+    starts = np.cumsum(nbytes) - nbytes
+    # position of each output byte within its integer
+    position = (np.arange(int(nbytes.sum()), dtype=np.int64)
+                - np.repeat(starts, nbytes))
+    data = ((np.repeat(values, nbytes) >> (position * 7).astype(np.uint64))
+            & np.uint64(0x7f)).astype(np.uint8)
+    data[position < np.repeat(nbytes, nbytes) - 1] |= 0x80
+    return data.tobytes()
+
+
+def decode_varints(data: bytes) -> np.ndarray:
+    """Decode the integers encoded by encode_varints."""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    position = (np.arange(len(data), dtype=np.int64)
+                - np.repeat(starts, ends - starts + 1))
+    parts = ((data & 0x7f).astype(np.uint64)
+             << (position * 7).astype(np.uint64))
+    return np.add.reduceat(parts, starts)
+
+
+class IndexWriter(object):
+    """Build the index of a file, adding the terms of its objects in
+       order.
+
+       (term, ordinal) pairs are sorted by term with an external sorter
+       using at most about memory_limit bytes; the sort is stable, so the
+       ordinals of each term come out in increasing order.
+    """
+
+    def __init__(self,
+                 prefix: str,
+                 memory_limit: int,
+                 tmp_dir: Optional[str]=None):
+        self.prefix = prefix
+        self.sorter = sorting.ExternalSorter(
+            memory_limit,
+            tmp_dir=tmp_dir,
+            sizeof=lambda pair: len(pair[0]) + 50,
+        )
+        # restart offset and skip of each object
+        self.offsets = array.array('q')
+
+    @property
+    def nobjects(self) -> int:
+        return len(self.offsets) // 2
+
+    def add(self, offset: int, skip: int, terms: Iterable[str]) -> None:
+        """Add the next object, with its restart point and terms."""
+        ordinal = self.nobjects
+        self.offsets.extend((offset, skip))
+        add = self.sorter.add
+        for term in terms:
+            add(term, (term, ordinal))
+
+    def write(self, metadata: Mapping) -> Mapping:
+        """Write the index with the given metadata, returning the number of
+           objects, terms and postings and the size of the postings."""
+        lexicon_offset = 0
+        postings_offset = 0
+        terms = []
+        npostings = 0
+        with open(self.prefix + '.lexicon', 'wb') as lexicon, \
+                open(self.prefix + '.postings', 'wb') as postings:
+            for term, pairs in itertools.groupby(self.sorter.sorted(),
+                                                 key=itemgetter(0)):
+                ordinals = np.fromiter(map(itemgetter(1), pairs),
+                                       dtype=np.uint64)
+                data = encode_varints(np.diff(ordinals, prepend=0))
+                encoded = term.encode('utf-8')
+
+                terms.append((lexicon_offset, postings_offset, len(ordinals)))
+                lexicon.write(encoded)
+                postings.write(data)
+                lexicon_offset += len(encoded)
+                postings_offset += len(data)
+                npostings += len(ordinals)
+
+        terms.append((lexicon_offset, postings_offset, 0))
+        np.save(self.prefix + '.terms.npy',
+                np.array(terms, dtype=np.int64).reshape(-1, 3))
+        np.save(self.prefix + '.offsets.npy',
+                np.frombuffer(self.offsets, dtype=np.int64).reshape(-1, 2))
+
+        counts = {
+            'objects': self.nobjects,
+            'terms': len(terms) - 1,
+            'postings': npostings,
+            'postings_bytes': postings_offset,
+        }
+        with open(self.prefix + '.json', 'wt', encoding='utf-8') as outfile:
+            json.dump(dict(metadata, version=INDEX_VERSION, **counts),
+                      outfile, indent=2)
+        return counts
+
+
+class TextIndex(object):
+    """Memory-mapped index, opened from its metadata file."""
+
+    def __init__(self, path: str):
+        assert path.endswith('.json'), \
+               "The index is opened from its .json metadata file"
+        prefix = path[:-len('.json')]
+        self.path = path
+        with open(path, 'rt', encoding='utf-8') as infile:
+            self.metadata = json.load(infile)
+        assert (self.metadata.get('version') == INDEX_VERSION), \
+               "Unsupported index version: {}".format(path)
+
+        self.terms = np.load(prefix + '.terms.npy', mmap_mode='r')
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        self._files = []
+        self.lexicon = self._map(prefix + '.lexicon')
+        self.postings = self._map(prefix + '.postings')
+
+    def _map(self, path: str) -> bytes:
+        if os.path.getsize(path) == 0:
+            return b''
+        infile = open(path, 'rb')
+        self._files.append(infile)
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def nobjects(self) -> int:
+        return len(self.offsets)
+
+    def term(self, num: int) -> str:
+        """Return the num-th term of the lexicon."""
+        start, end = int(self.terms[num, 0]), int(self.terms[num + 1, 0])
+        return self.lexicon[start:end].decode('utf-8')
+
+    def lookup(self, term: str) -> np.ndarray:
+        """Return the sorted ordinals of the objects that contain a term."""
+        # binary search of the lexicon
+        low, high = 0, len(self.terms) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(self.terms) - 1 or self.term(low) != term:
+            return np.zeros(0, dtype=np.uint64)
+
+        start, end = int(self.terms[low, 1]), int(self.terms[low + 1, 1])
+        return np.cumsum(decode_varints(self.postings[start:end]),
+                         dtype=np.uint64)
+
+    def close(self) -> None:
+        for data in (self.lexicon, self.postings):
+            if isinstance(data, mmap.mmap):
+                data.close()
+        for infile in self._files:
+            infile.close()
+        self._files = []
+
+
+def parse_query(query: str) -> tuple:
+    """Parse a boolean query of terms, AND, OR, NOT and parentheses into a
+       tree of ('term', term), ('and', [nodes]), ('or', [nodes]) and ('not',
+       node) tuples. Adjacent terms are joined with AND, a word with several
+       terms (e.g. a hyphenated one) is the AND of its terms."""
+    tokens = re.findall(r'\(|\)|[^\s()]+', query)
+    pos = 0
+
+    def peek() -> Optional[str]:
+        return tokens[pos] if pos < len(tokens) else None
+
+    def parse_or() -> tuple:
+        nonlocal pos
+        nodes = [parse_and()]
+        while peek() == 'OR':
+            pos += 1
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and() -> tuple:
+        nonlocal pos
+        nodes = [parse_not()]
+        while peek() is not None and peek() not in ('OR', ')'):
+            if peek() == 'AND':
+                pos += 1
+            nodes.append(parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not() -> tuple:
+        nonlocal pos
+        token = peek()
+        if token is None or token in ('AND', 'OR', ')'):
+            raise ValueError("Invalid query: {}".format(query))
+        pos += 1
+        if token == 'NOT':
+            return ('not', parse_not())
+        if token == '(':
+            node = parse_or()
+            if peek() != ')':
+                raise ValueError("Unbalanced parentheses: {}".format(query))
+            pos += 1
+            return node
+
+        terms = sorted(tokenize(token))
+        if not terms:
+            raise ValueError("No term can be indexed in: {}".format(token))
+        if len(terms) == 1:
+            return ('term', terms[0])
+        return ('and', [('term', term) for term in terms])
+
+    tree = parse_or()
+    if pos != len(tokens):
+        raise ValueError("Invalid query: {}".format(query))
+    return tree
+
+
+def evaluate(index: TextIndex, node: tuple) -> np.ndarray:
+    """Return the sorted ordinals of the objects matching a query tree."""
+    kind, value = node
+    if kind == 'term':
+        return index.lookup(value)
+
+    if kind == 'not':
+        return np.setdiff1d(np.arange(index.nobjects, dtype=np.uint64),
+                            evaluate(index, value), assume_unique=True)
+
+    if kind == 'or':
+        result = np.zeros(0, dtype=np.uint64)
+        for child in value:
+            result = np.union1d(result, evaluate(index, child))
+        return result
+
+    # a AND NOT b is computed as a difference, and the shortest lists are
+    # intersected first
+    positive = [child for child in value if child[0] != 'not']
+    negative = [child[1] for child in value if child[0] == 'not']
+    if not positive:
+        return evaluate(index, ('not', ('or', negative)))
+
+    lists = sorted((evaluate(index, child) for child in positive), key=len)
+    result = lists[0]
+    for ordinals in lists[1:]:
+        if not len(result):
+            break
+        result = np.intersect1d(result, ordinals, assume_unique=True)
+    for child in negative:
+        if not len(result):
+            break
+        result = np.setdiff1d(result, evaluate(index, child),
+                              assume_unique=True)
+    return result
@@ -0,0 +1,218 @@
+"""Manifest of the work units completed in an output directory.
+
+A unit is the processing of an input file by a sub-command with some
+parameters. For each completed unit the manifest records the size and
+modification time of the input, the outputs with their size and checksum
+and the stats returned by the sub-command, so that a rerun on the same
+output directory skips the units that are already done and still merges
+their stats in the summary.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+
+from typing import Any, Iterable, Mapping, Optional
+
+MANIFEST_VERSION = 1
+
+MANIFEST_NAME = 'manifest.json'
+
+# arguments that do not change the outputs of a unit
+IGNORED_ARGS = {
+    'files',
+    'output_dir_path',
+    'jobs',
+    'dry_run',
+    'force',
+    'template_cache_dir',
+    'func',
+    'dump_reader',
+    'stats_template',
+    'stats_merger',
+    'json_decoder',
+    'compression_workers',
+    'pipeline',
+    'pipeline_workers',
+    'sort_memory',
+    'tmp_dir',
+    'no_index',
+    'skip_completed',
+}
+
+# arguments naming an input file: the unit depends on its content, not on
+# its path only
+FILE_ARGS = {
+    'ids_file',
+}
+
+# buffer size for computing the checksums of the outputs
+CHECKSUM_BUFFER_SIZE = 1024*1024
+
+
+def unit_params(args: argparse.Namespace) -> Mapping[str, Any]:
+    """Return the parameters of the sub-command that affect its outputs, with
+       the checksum of the files named by FILE_ARGS."""
+    params = dict()
+    for name, value in sorted(vars(args).items()):
+        if name in IGNORED_ARGS:
+            continue
+        if name in FILE_ARGS and value is not None:
+            value = {'path': str(value), 'sha256': file_checksum(str(value))}
+        params[name] = value
+    return params
+
+
+def params_hash(params: Mapping[str, Any]) -> str:
+    """Return a short hash identifying the parameters."""
+    data = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+
+def file_checksum(path: str) -> str:
+    """Return the SHA-256 checksum of a file, or of the files of a
+       directory."""
+    checksum = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(path, name) for name in os.listdir(path))
+    else:
+        paths = [path]
+
+    for file_path in paths:
+        with open(file_path, 'rb') as infile:
+            for data in iter(lambda: infile.read(CHECKSUM_BUFFER_SIZE), b''):
+                checksum.update(data)
+
+    return checksum.hexdigest()
+
+
+def file_size(path: str) -> int:
+    """Return the size of a file, or of the files of a directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name))
+                   for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    return str(value)
+
+
+def _decode_object(obj: Mapping) -> Any:
+    if len(obj) == 1 and '$datetime' in obj:
+        return datetime.datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+
+class Manifest(object):
+    """Work units completed in an output directory, stored in JSON."""
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.output_dir = output_dir
+        self.units = dict()
+
+        if os.path.exists(self.path):
+            with open(self.path, 'rt', encoding='utf-8') as infile:
+                manifest = json.load(infile, object_hook=_decode_object)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.units = manifest['units']
+
+    @staticmethod
+    def unit_key(input_path: str, params: Mapping[str, Any],
+                 args: argparse.Namespace) -> str:
+        """Return the key of the unit processing input_path with the given
+           parameters."""
+        return '{input}:{command}:{params}'.format(
+            input=os.path.abspath(input_path),
+            command=args.command,
+            params=params_hash(params),
+        )
+
+    def completed(
+            self,
+            input_path: str,
+            args: argparse.Namespace) -> Optional[Mapping]:
+        """Return the unit processing input_path if it is done, its input
+           did not change and its outputs still exist unchanged, else
+           None."""
+        unit = self.units.get(self.unit_key(input_path,
+                                            unit_params(args),
+                                            args))
+        if unit is None or unit['state'] != 'done':
+            return None
+
+        stat = os.stat(input_path)
+        if (unit['size'] != stat.st_size
+                or unit['mtime_ns'] != stat.st_mtime_ns):
+            return None
+
+        paths = {name: os.path.join(self.output_dir, name)
+                 for name in unit['outputs']}
+        for name, output in unit['outputs'].items():
+            path = paths[name]
+            if not os.path.exists(path) or file_size(path) != output['size']:
+                return None
+        # checksums are computed only if all the sizes match
+        for name, output in unit['outputs'].items():
+            if file_checksum(paths[name]) != output['sha256']:
+                return None
+
+        return unit
+
+    def output_name(self, path: str) -> str:
+        """Return the name of an output in the manifest: its path relative to
+           the output directory, or its absolute path if it is outside."""
+        name = os.path.relpath(os.path.abspath(path),
+                               os.path.abspath(self.output_dir))
+        if name.split(os.sep, 1)[0] == os.pardir:
+            return os.path.abspath(path)
+        return name
+
+    def record(
+            self,
+            input_path: str,
+            output_paths: Iterable[str],
+            args: argparse.Namespace,
+            results: Optional[Mapping],
+            error: Optional[BaseException]=None) -> None:
+        """Record the outcome of the unit processing input_path, output_paths
+           are the files (and directories) it wrote, results the stats
+           returned by the sub-command, by output name."""
+        stat = os.stat(input_path)
+        params = unit_params(args)
+
+        outputs = dict()
+        if error is None:
+            for path in output_paths:
+                outputs[self.output_name(path)] = {
+                    'size': file_size(path),
+                    'sha256': file_checksum(path),
+                }
+
+        self.units[self.unit_key(input_path, params, args)] = {
+            'input': os.path.abspath(input_path),
+            'command': args.command,
+            'params': params,
+            'state': 'done' if error is None else 'failed',
+            'error': None if error is None else repr(error),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'completed_at': datetime.datetime.utcnow(),
+            'outputs': outputs,
+            'results': results,
+        }
+        self.save()
+
+    def save(self) -> None:
+        """Write the manifest, replacing the previous one atomically."""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wt', encoding='utf-8') as outfile:
+            json.dump({'version': MANIFEST_VERSION, 'units': self.units},
+                      outfile,
+                      indent=2,
+                      default=_encode_value)
+        os.replace(tmp_path, self.path)
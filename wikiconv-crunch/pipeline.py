@@ -0,0 +1,262 @@
+"""Pipelined processing stages connected by bounded queues.
+
+The input is read (and decompressed) by a reader thread, processed in
+batches of lines by a pool of worker threads and the output is written (and
+compressed) by a dedicated writer thread. Each queue is bounded, so a slow
+stage blocks the stages before it.
+
+The workers are threads: the processing of the batches (e.g. JSON decoding)
+holds the GIL, so it is not parallelized by adding workers. What overlaps
+is the work that releases the GIL, decompression in the reader and
+compression in the writer.
+"""
+import queue
+import threading
+import time
+
+from typing import Any, Callable, Iterable, Iterator, List, Mapping, IO
+
+# sentinel signalling the end of a queue
+_END = object()
+
+
+class StageCounters(object):
+    """Throughput counters of a pipeline stage.
+
+       Items are lines for the read and parse stages and characters for the
+       write stage, busy and wait times are in seconds.
+    """
+
+    def __init__(self):
+        self.items = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int, busy_time: float, wait_time: float) -> None:
+        """Account for a batch processed by the stage."""
+        with self._lock:
+            self.items += items
+            self.batches += 1
+            self.busy_time += busy_time
+            self.wait_time += wait_time
+
+    def as_dict(self) -> Mapping:
+        """Return the counters as a stats dictionary."""
+        return {
+            'items': self.items,
+            'batches': self.batches,
+            'busy_time': round(self.busy_time, 3),
+            'wait_time': round(self.wait_time, 3),
+        }
+
+
+class _Failure(object):
+    """Exception raised in a stage, to be re-raised by the consumer."""
+
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def _reader(
+        iterable: Iterable[Any],
+        batch_size: int,
+        in_queue: queue.Queue,
+        inflight: threading.Semaphore,
+        nworkers: int,
+        counters: StageCounters) -> None:
+    try:
+        iterator = iter(iterable)
+        seq = 0
+        while True:
+            start = time.perf_counter()
+            batch = []
+            for item in iterator:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    break
+            busy = time.perf_counter() - start
+
+            if not batch:
+                break
+
+            start = time.perf_counter()
+            inflight.acquire()
+            in_queue.put((seq, batch))
+            counters.add(len(batch), busy, time.perf_counter() - start)
+            seq += 1
+    except BaseException as exc:
+        in_queue.put((None, _Failure(exc)))
+    finally:
+        for _ in range(nworkers):
+            in_queue.put(_END)
+
+
+def _worker(
+        func: Callable[[List[Any]], Any],
+        in_queue: queue.Queue,
+        out_queue: queue.Queue,
+        counters: StageCounters) -> None:
+    try:
+        while True:
+            start = time.perf_counter()
+            task = in_queue.get()
+            wait = time.perf_counter() - start
+            if task is _END:
+                break
+
+            seq, batch = task
+            if isinstance(batch, _Failure):
+                out_queue.put(task)
+                continue
+
+            start = time.perf_counter()
+            res = func(batch)
+            counters.add(len(batch), time.perf_counter() - start, wait)
+
+            out_queue.put((seq, res))
+    except BaseException as exc:
+        out_queue.put((None, _Failure(exc)))
+    finally:
+        out_queue.put(_END)
+
+
+def map_batches(
+        iterable: Iterable[Any],
+        func: Callable[[List[Any]], Any],
+        stats: Mapping,
+        workers: int=2,
+        batch_size: int=1000,
+        queue_size: int=8) -> Iterator[Any]:
+    """Apply func to batches of batch_size items of iterable, in a pool of
+       worker threads, yielding the results in the order of the input.
+
+       The iterable is consumed by a dedicated reader thread. At most
+       queue_size + workers batches are in flight at any time. The counters
+       of the 'read' and 'parse' stages are stored in stats.
+    """
+    read_counters = StageCounters()
+    parse_counters = StageCounters()
+
+    in_queue = queue.Queue(maxsize=queue_size)
+    out_queue = queue.Queue(maxsize=queue_size)
+    inflight = threading.Semaphore(queue_size + workers)
+
+    threads = [threading.Thread(target=_reader,
+                                args=(iterable, batch_size, in_queue,
+                                      inflight, workers, read_counters),
+                                daemon=True)]
+    threads.extend(threading.Thread(target=_worker,
+                                    args=(func, in_queue, out_queue,
+                                          parse_counters),
+                                    daemon=True)
+                   for _ in range(workers))
+    for thread in threads:
+        thread.start()
+
+    pending = dict()
+    next_seq = 0
+    running = workers
+    while running:
+        task = out_queue.get()
+        if task is _END:
+            running -= 1
+            continue
+
+        seq, res = task
+        if isinstance(res, _Failure):
+            raise res.exc
+
+        pending[seq] = res
+        while next_seq in pending:
+            yield pending.pop(next_seq)
+            inflight.release()
+            next_seq += 1
+
+    for thread in threads:
+        thread.join()
+
+    stats['read'] = read_counters.as_dict()
+    stats['parse'] = parse_counters.as_dict()
+
+
+class ThreadedWriter(object):
+    """File-like object that writes (and compresses) data in a dedicated
+       thread.
+
+       Data is accumulated in chunks of about chunk_size characters, at most
+       queue_size chunks are waiting to be written at any time.
+    """
+
+    def __init__(self,
+                 output: IO,
+                 stats: Mapping,
+                 chunk_size: int=1024*1024,
+                 queue_size: int=8):
+        self.output = output
+        self.stats = stats
+        self.chunk_size = chunk_size
+
+        self._counters = StageCounters()
+        self._chunk = []
+        self._chunk_len = 0
+        self._failure = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            chunk = self._queue.get()
+            wait = time.perf_counter() - start
+            if chunk is _END:
+                break
+
+            if self._failure is not None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                self.output.write(chunk)
+            except BaseException as exc:
+                self._failure = exc
+            self._counters.add(len(chunk), time.perf_counter() - start, wait)
+
+    def write(self, data: str) -> None:
+        """Write data to the output."""
+        if self._failure is not None:
+            raise self._failure
+
+        self._chunk.append(data)
+        self._chunk_len += len(data)
+        if self._chunk_len >= self.chunk_size:
+            self._flush_chunk()
+
+    def _flush_chunk(self) -> None:
+        if self._chunk:
+            self._queue.put(''.join(self._chunk))
+            self._chunk = []
+            self._chunk_len = 0
+
+    def close(self) -> None:
+        """Write the remaining data and close the output."""
+        self._flush_chunk()
+        self._queue.put(_END)
+        self._thread.join()
+        self.output.close()
+
+        # the writers of the shards of an output share the stats
+        write_stats = self.stats.setdefault('write', dict())
+        for key, value in self._counters.as_dict().items():
+            write_stats[key] = round(write_stats.get(key, 0) + value, 3)
+
+        if self._failure is not None:
+            raise self._failure
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
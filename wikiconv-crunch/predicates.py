@@ -0,0 +1,139 @@
+"""Predicates on page IDs.
+
+Closed ranges are tested with a binary search on their bounds, using memory
+proportional to the number of ranges, lists of IDs are kept in a sorted
+array of 64-bit integers. Both can be tested one ID at a time or on a NumPy
+array of IDs at once.
+"""
+import array
+import bisect
+
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from . import file_utils as fu
+
+
+class IdRanges(object):
+    """Union of closed ranges of IDs, which must not overlap."""
+
+    def __init__(self, ranges: Iterable[Tuple[int, int]]):
+        self.ranges = sorted(ranges)
+        self.starts = [start_id for start_id, _ in self.ranges]
+        self.ends = [end_id for _, end_id in self.ranges]
+
+        for prev_end, next_start in zip(self.ends, self.starts[1:]):
+            assert (prev_end < next_start), "ID ranges must not overlap"
+
+        self._starts = np.array(self.starts, dtype=np.int64)
+        self._ends = np.array(self.ends, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def find(self, id_: int) -> Optional[int]:
+        """Return the index of the range containing id_, or None."""
+        idx = bisect.bisect_right(self.starts, id_) - 1
+        if idx >= 0 and id_ <= self.ends[idx]:
+            return idx
+        return None
+
+    def __contains__(self, id_: int) -> bool:
+        return self.find(id_) is not None
+
+    def find_many(self, ids: np.ndarray) -> np.ndarray:
+        """Return the index of the range containing each ID, -1 for IDs that
+           are not in any range."""
+        idx = np.searchsorted(self._starts, ids, side='right') - 1
+        found = (idx >= 0) & (ids <= self._ends[np.maximum(idx, 0)])
+        return np.where(found, idx, -1)
+
+    def overlaps(self, min_id: int, max_id: int) -> bool:
+        """Return True if some ID in [min_id, max_id] is in a range."""
+        # the range with the largest start not greater than max_id is the
+        # one with the largest end among those starting before max_id
+        idx = bisect.bisect_right(self.starts, max_id) - 1
+        return idx >= 0 and self.ends[idx] >= min_id
+
+
+class IdSet(object):
+    """Set of IDs, stored as a sorted array of 64-bit integers."""
+
+    def __init__(self, ids: Iterable[int]):
+        values = np.unique(np.fromiter(ids, dtype=np.int64))
+        # bisect works on array.array without creating NumPy scalars
+        self.ids = array.array('q', values.tobytes())
+        self._ids = np.frombuffer(self.ids, dtype=np.int64)
+
+    @classmethod
+    def from_file(cls, path: str) -> 'IdSet':
+        """Load the IDs from a file, with an ID at the beginning of each line,
+           can be compressed. Empty lines and lines starting with # are
+           ignored."""
+        infile = fu.open_csv_file(path)
+        try:
+            return cls(int(line.split(None, 1)[0].rstrip(','))
+                       for line in infile
+                       if line.strip() and not line.startswith('#'))
+        finally:
+            infile.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def min(self) -> int:
+        return self.ids[0]
+
+    @property
+    def max(self) -> int:
+        return self.ids[-1]
+
+    def __contains__(self, id_: int) -> bool:
+        idx = bisect.bisect_left(self.ids, id_)
+        return idx < len(self.ids) and self.ids[idx] == id_
+
+    def contains_many(self, ids: np.ndarray) -> np.ndarray:
+        """Return a boolean mask of the IDs in the set."""
+        if not len(self.ids):
+            return np.zeros(len(ids), dtype=bool)
+
+        idx = np.searchsorted(self._ids, ids)
+        idx = np.minimum(idx, len(self._ids) - 1)
+        return self._ids[idx] == ids
+
+    def overlaps(self, min_id: int, max_id: int) -> bool:
+        """Return True if some ID in [min_id, max_id] is in the set."""
+        idx = bisect.bisect_left(self.ids, min_id)
+        return idx < len(self.ids) and self.ids[idx] <= max_id
+
+
+class PageIdPredicate(object):
+    """Assign page IDs to a range, optionally accepting only the IDs of a
+       list."""
+
+    def __init__(self, ranges: IdRanges, ids: Optional[IdSet]=None):
+        self.ranges = ranges
+        self.ids = ids
+
+    def find(self, pageid: int) -> Optional[int]:
+        """Return the index of the range of an accepted ID, or None."""
+        idx = self.ranges.find(pageid)
+        if idx is not None and self.ids is not None and pageid not in self.ids:
+            return None
+        return idx
+
+    def find_many(self, pageids: List[int]) -> List[int]:
+        """Return the index of the range of each ID, -1 for IDs that are not
+           accepted."""
+        values = np.array(pageids, dtype=np.int64)
+        idx = self.ranges.find_many(values)
+        if self.ids is not None:
+            idx[~self.ids.contains_many(values)] = -1
+        return idx.tolist()
+
+    def overlaps(self, min_id: int, max_id: int) -> bool:
+        """Return True if some ID in [min_id, max_id] may be accepted."""
+        return (self.ranges.overlaps(min_id, max_id)
+                and (self.ids is None or self.ids.overlaps(min_id, max_id)))
@@ -1,3 +1,10 @@
 from . import (
     pageid_filter,
+    pageid_index,
+    conversations,
+    aggregate_scores,
+    user_stats,
+    expression_filter,
+    text_index,
+    text_search,
 )
@@ -0,0 +1,421 @@
+"""
+Aggregate the toxicity scores by page, user or month.
+
+Scores are collected in NumPy arrays in batches of BATCH_SIZE objects and
+added to the aggregates of their group with vectorized operations: count,
+sum and sum of squares, minimum, maximum and a histogram of each score.
+Memory is proportional to the number of groups, quantiles are interpolated
+from the histograms, so their precision is 1/bins.
+
+The stats report the number of groups of each input file (file_groups),
+which the summary of several files sums: a group spanning several files,
+e.g. a month, is counted once per file.
+
+The output format is csv or XML, one row (or element) per group.
+"""
+
+import csv
+import argparse
+import datetime
+
+from typing import Any, Iterable, List, Mapping
+
+import numpy as np
+
+from .. import file_utils as fu
+from .. import dumper
+from .. import types
+from .. import utils
+
+# print a dot each NPRINTREVISION revisions
+NPRINTREVISION = 10000
+
+# number of objects aggregated in a batch
+BATCH_SIZE = 10000
+
+# initial number of groups allocated
+INITIAL_GROUPS = 1024
+
+GROUP_BY = ['page', 'user', 'month']
+
+# templates
+stats_template = '''
+<%!
+    def mean(score):
+        return score['sum'] / score['count'] if score['count'] else 0.0
+
+    def std(score):
+        if not score['count']:
+            return 0.0
+        var = score['sum_squares'] / score['count'] - mean(score) ** 2
+        return max(var, 0.0) ** 0.5
+%>
+<stats>
+    <performance>
+        <start_time>${stats['performance']['start_time'] | x}</start_time>
+        <end_time>${stats['performance']['end_time'] | x}</end_time>
+        <input>
+            <objects>${stats['performance']['input']['objects'] | x}</objects>
+        </input>
+        <output>
+            <file_groups>${stats['performance']['output']['file_groups'] | x}</file_groups>
+        </output>
+    </performance>
+    <scores>
+        % for name, score in stats['scores'].items():
+        <score name="${name | x}" count="${score['count'] | x}" mean="${round(mean(score), 6) | x}" std="${round(std(score), 6) | x}">
+            <histogram>${' '.join(str(count) for count in score['histogram'].values()) | x}</histogram>
+        </score>
+        % endfor
+    </scores>
+</stats>
+'''
+
+groups_template = '''
+<groups by="${group_by | x}">
+    % for key, count, values in rows:
+    <group key="${key | x}" count="${count | x}">
+        % for name, (mean, std, min_, max_, quantiles, histogram) in zip(score_fields, values):
+        <score name="${name | x}" mean="${mean | x}" std="${std | x}" min="${min_ | x}" max="${max_ | x}">
+            % for q, value in zip(quantile_levels, quantiles):
+            <quantile q="${q | x}">${value | x}</quantile>
+            % endfor
+            <histogram>${' '.join(str(count) for count in histogram) | x}</histogram>
+        </score>
+        % endfor
+    </group>
+    % endfor
+</groups>
+'''
+
+
+def group_key(obj: Mapping, group_by: str) -> Any:
+    """Return the key of the group of an object."""
+    if group_by == 'page':
+        return int(obj['pageId'])
+    elif group_by == 'user':
+        user = obj.get('user', {})
+        if 'id' in user:
+            return str(user['id'])
+        return user.get('text', '')
+    else:
+        return types.timestamp_key(obj['timestamp'])[:7]
+
+
+class GroupedScores(object):
+    """Aggregates of the scores of each group, in arrays indexed by group
+       number."""
+
+    def __init__(self, bins: int):
+        self.bins = bins
+        self.groups = dict()
+
+        nscores = len(types.SCORE_FIELDS)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros((0, nscores))
+        self.sum_squares = np.zeros((0, nscores))
+        self.min = np.zeros((0, nscores))
+        self.max = np.zeros((0, nscores))
+        self.histogram = np.zeros((0, nscores, bins), dtype=np.uint32)
+        self._grow(INITIAL_GROUPS)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def _grow(self, capacity: int) -> None:
+        def resize(values: np.ndarray, fill: Any) -> np.ndarray:
+            res = np.full((capacity, ) + values.shape[1:],
+                          fill,
+                          dtype=values.dtype)
+            res[:len(values)] = values
+            return res
+
+        self.count = resize(self.count, 0)
+        self.sum = resize(self.sum, 0.0)
+        self.sum_squares = resize(self.sum_squares, 0.0)
+        self.min = resize(self.min, np.inf)
+        self.max = resize(self.max, -np.inf)
+        self.histogram = resize(self.histogram, 0)
+
+    def group_indices(self, keys: List[Any]) -> np.ndarray:
+        """Return the number of the group of each key, adding the new
+           ones."""
+        groups = self.groups
+        indices = np.fromiter((groups.setdefault(key, len(groups))
+                               for key in keys),
+                              dtype=np.int64,
+                              count=len(keys))
+
+        if len(groups) > len(self.count):
+            self._grow(max(len(groups), 2*len(self.count)))
+
+        return indices
+
+    def add_batch(self, keys: List[Any], scores: np.ndarray) -> None:
+        """Add a batch of scores, an array with a row per key and a column
+           per score field."""
+        indices = self.group_indices(keys)
+
+        np.add.at(self.count, indices, 1)
+        np.add.at(self.sum, indices, scores)
+        np.add.at(self.sum_squares, indices, scores * scores)
+        np.minimum.at(self.min, indices, scores)
+        np.maximum.at(self.max, indices, scores)
+
+        bins = np.clip((scores * self.bins).astype(np.int64),
+                       0, self.bins - 1)
+        fields = np.arange(scores.shape[1])
+        np.add.at(self.histogram, (indices[:, None], fields[None, :], bins), 1)
+
+    def quantiles(self, levels: List[float]) -> np.ndarray:
+        """Return the quantiles of each score of each group, interpolated
+           linearly inside the bins of the histograms, as an array of shape
+           (groups, scores, levels)."""
+        ngroups = len(self.groups)
+        histogram = self.histogram[:ngroups].astype(np.int64)
+        cumulative = np.cumsum(histogram, axis=-1)
+        counts = self.count[:ngroups, None]
+
+        res = np.zeros(histogram.shape[:2] + (len(levels), ))
+        for num, level in enumerate(levels):
+            target = level * counts
+            # first bin whose cumulative count reaches the target
+            bins = np.minimum((cumulative < target[..., None]).sum(axis=-1),
+                              self.bins - 1)
+            before = np.take_along_axis(cumulative, bins[..., None],
+                                        axis=-1)[..., 0]
+            inside = np.take_along_axis(histogram, bins[..., None],
+                                        axis=-1)[..., 0]
+            before = before - inside
+            fraction = np.where(inside > 0,
+                                (target - before) / np.maximum(inside, 1),
+                                0.0)
+            values = (bins + np.clip(fraction, 0.0, 1.0)) / self.bins
+            res[:, :, num] = np.clip(values,
+                                     self.min[:ngroups],
+                                     self.max[:ngroups])
+
+        return res
+
+    def rows(self, levels: List[float]) -> Iterable[tuple]:
+        """Yield a (key, count, values) tuple for each group, sorted by key,
+           values are a (mean, std, min, max, quantiles, histogram) tuple
+           for each score."""
+        ngroups = len(self.groups)
+        count = self.count[:ngroups, None]
+        mean = self.sum[:ngroups] / count
+        std = np.sqrt(np.maximum(self.sum_squares[:ngroups] / count
+                                 - mean * mean, 0.0))
+        quantiles = self.quantiles(levels)
+
+        for key, idx in sorted(self.groups.items()):
+            values = tuple(
+                (round(float(mean[idx, field]), 6),
+                 round(float(std[idx, field]), 6),
+                 float(self.min[idx, field]),
+                 float(self.max[idx, field]),
+                 [round(float(value), 6) for value in quantiles[idx, field]],
+                 self.histogram[idx, field].tolist())
+                for field in range(len(types.SCORE_FIELDS)))
+            yield key, int(self.count[idx]), values
+
+    def totals(self) -> Mapping:
+        """Return the aggregates of all the groups as a stats dictionary,
+           whose values can be merged with utils.merge_stats."""
+        ngroups = len(self.groups)
+        histogram = self.histogram[:ngroups].sum(axis=0)
+        total = int(self.count[:ngroups].sum())
+        return {
+            name: {
+                'count': total,
+                'sum': float(self.sum[:ngroups, field].sum()),
+                'sum_squares': float(self.sum_squares[:ngroups, field].sum()),
+                'histogram': {'{:03d}'.format(num): int(count)
+                              for num, count in enumerate(histogram[field])},
+            }
+            for field, name in enumerate(types.SCORE_FIELDS)
+        }
+
+
+def aggregate(
+        dump: Iterable[Mapping],
+        aggregates: Mapping[str, GroupedScores],
+        stats: Mapping) -> None:
+    """Add the scores of each object to the aggregates, by group_by."""
+    def add_batch(batch: List[Mapping]) -> None:
+        scores = np.array([[obj['score'][field]
+                            for field in types.SCORE_FIELDS]
+                           for obj in batch],
+                          dtype=np.float64)
+        for group_by, grouped in aggregates.items():
+            grouped.add_batch([group_key(obj, group_by) for obj in batch],
+                              scores)
+
+    nobjs = 0
+    batch = []
+    for obj in dump:
+        nobjs += 1
+        if (nobjs-1) % NPRINTREVISION == 0:
+            utils.dot()
+
+        batch.append(obj)
+        if len(batch) >= BATCH_SIZE:
+            add_batch(batch)
+            batch = []
+    if batch:
+        add_batch(batch)
+
+    stats['performance']['input']['objects'] = nobjs
+
+
+def write_csv(
+        output,
+        group_by: str,
+        grouped: GroupedScores,
+        levels: List[float]) -> None:
+    """Write a row per group, histograms are space-separated counts."""
+    writer = csv.writer(output, lineterminator='\n')
+
+    header = [group_by, 'count']
+    for name in types.SCORE_FIELDS:
+        header.extend('{}_{}'.format(name, column)
+                      for column in ('mean', 'std', 'min', 'max'))
+        header.extend('{}_q{:g}'.format(name, level) for level in levels)
+        header.append('{}_histogram'.format(name))
+    writer.writerow(header)
+
+    for key, count, values in grouped.rows(levels):
+        row = [key, count]
+        for mean, std, min_, max_, quantiles, histogram in values:
+            row.extend((mean, std, min_, max_))
+            row.extend(quantiles)
+            row.append(' '.join(str(count) for count in histogram))
+        writer.writerow(row)
+
+
+def parse_levels(spec: str) -> List[float]:
+    """Parse a comma-separated list of quantile levels."""
+    levels = [float(level) for level in spec.split(',')]
+    for level in levels:
+        assert (0 <= level <= 1), "Quantile levels must be in [0, 1]"
+    return levels
+
+
+def configure_subparsers(subparsers):
+    """Configure a new subparser ."""
+    parser = subparsers.add_parser(
+        'aggregate-scores',
+        help='Aggregate the toxicity scores by page, user or month.',
+    )
+    parser.add_argument(
+        '--group-by',
+        choices=GROUP_BY,
+        action='append',
+        help='Group the scores by page ID, user (ID, or text for anonymous '
+             'users) or month; can be repeated to write several '
+             'aggregations in a single pass [default: page].'
+    )
+    parser.add_argument(
+        '--bins',
+        type=int,
+        default=20,
+        help='Number of bins of the histograms of the scores, quantiles '
+             'are interpolated from them [default: 20].'
+    )
+    parser.add_argument(
+        '--quantiles',
+        type=parse_levels,
+        default=parse_levels('0.25,0.5,0.75,0.9,0.99'),
+        help='Comma-separated list of quantile levels '
+             '[default: 0.25,0.5,0.75,0.9,0.99].'
+    )
+    parser.add_argument(
+        '--output-format',
+        choices=['csv', 'xml'],
+        default='csv',
+        help='Output format [default: csv].'
+    )
+
+    parser.set_defaults(func=main, stats_template=stats_template)
+
+
+def new_stats() -> Mapping:
+    """Return an empty stats dictionary."""
+    return {
+        'performance': {
+            'start_time': None,
+            'end_time': None,
+            'input': {
+                'objects': 0,
+            },
+            'output': {
+                'file_groups': 0,
+            },
+        },
+        'scores': dict(),
+    }
+
+
+def main(
+        dump: Iterable[Mapping],
+        basename: str,
+        args: argparse.Namespace) -> Mapping:
+    """Main function that parses the arguments and writes the output.
+
+       Return the stats of each aggregation, by output name.
+    """
+    assert (args.bins > 0), "The number of bins must be positive"
+
+    start_time = datetime.datetime.utcnow()
+
+    group_bys = list(dict.fromkeys(args.group_by or ['page']))
+    aggregates = {group_by: GroupedScores(args.bins)
+                  for group_by in group_bys}
+
+    stats = new_stats()
+    stats['performance']['start_time'] = start_time
+    aggregate(dump, aggregates, stats)
+    stats['performance']['end_time'] = datetime.datetime.utcnow()
+
+    results = dict()
+    for group_by, grouped in aggregates.items():
+        name = 'aggregate-scores.{}'.format(group_by)
+
+        group_stats = new_stats()
+        group_stats['performance'] = dict(stats['performance'])
+        group_stats['performance']['output'] = {'file_groups': len(grouped)}
+        group_stats['scores'] = grouped.totals()
+        results[name] = group_stats
+
+        if args.dry_run:
+            continue
+
+        varname = '{basename}.{name}'.format(basename=basename, name=name)
+        output_filename = str(args.output_dir_path /
+                              (varname + '.' + args.output_format))
+        with fu.output_writer(
+                path=output_filename,
+                compression=args.output_compression) as output:
+            if args.output_format == 'csv':
+                write_csv(output, group_by, grouped, args.quantiles)
+            else:
+                dumper.render_template(
+                    groups_template,
+                    output,
+                    group_by=group_by,
+                    rows=grouped.rows(args.quantiles),
+                    score_fields=types.SCORE_FIELDS,
+                    quantile_levels=args.quantiles,
+                )
+
+        stats_filename = str(args.output_dir_path / (varname + '.stats.xml'))
+        with fu.output_writer(
+                path=stats_filename,
+                compression=args.output_compression) as stats_output:
+            dumper.render_template(
+                stats_template,
+                stats_output,
+                stats=group_stats,
+            )
+
+    return results
@@ -0,0 +1,247 @@
+"""
+Reconstruct the conversations of the output of filter-pageid.
+
+The input must be sorted by page ID and timestamp. The actions of each page
+are read together and assembled in a reply tree per conversation, the
+conversations of a page are written as soon as the following page starts,
+so only the actions of one page are kept in memory.
+
+ADDITION and CREATION actions are the nodes of the reply tree, a node is a
+child of the action with its parentId (if it belongs to the conversation)
+and a root otherwise. The other actions (MODIFICATION, DELETION,
+RESTORATION) are counted, but do not change the tree.
+
+The output format is JSON, one conversation per line.
+"""
+
+import os
+import json
+import argparse
+import datetime
+import itertools
+
+from typing import Iterable, Iterator, List, Mapping
+
+from .. import file_utils as fu
+from .. import dumper
+from .. import types
+from .. import utils
+
+# print a dot each NPRINTREVISION revisions
+NPRINTREVISION = 10000
+
+# types of the actions that add a node to the reply tree
+NODE_TYPES = {'ADDITION', 'CREATION'}
+
+# templates
+stats_template = '''
+<stats>
+    <performance>
+        <start_time>${stats['performance']['start_time'] | x}</start_time>
+        <end_time>${stats['performance']['end_time'] | x}</end_time>
+        <input>
+            <objects>${stats['performance']['input']['objects'] | x}</objects>
+            <pages>${stats['performance']['input']['pages'] | x}</pages>
+        </input>
+        <output>
+            <conversations>${stats['performance']['output']['conversations'] | x}</conversations>
+        </output>
+        <peak_page_objects>${stats['performance']['peak_page_objects'] | x}</peak_page_objects>
+        <peak_depth>${stats['performance']['peak_depth'] | x}</peak_depth>
+    </performance>
+</stats>
+'''
+
+
+class Conversation(object):
+    """Reply tree of a conversation, built one action at a time."""
+
+    def __init__(self, record: types.WikiConvRecord):
+        self.conversationId = record.conversationId
+        self.pageId = record.pageId
+        self.pageTitle = record.pageTitle
+        self.first_timestamp = record.timestamp
+        self.last_timestamp = record.timestamp
+
+        # depth of each node, by action id
+        self.depths = dict()
+        self.roots = 0
+        self.max_depth = 0
+        self.actions = 0
+        self.types = dict()
+        self.participants = set()
+        self.anonymous = set()
+        self.max_toxicity = 0.0
+        self.sum_toxicity = 0.0
+
+    def add(self, record: types.WikiConvRecord) -> None:
+        """Add an action, which must not be earlier than the previous
+           ones."""
+        self.actions += 1
+        self.types[record.type] = self.types.get(record.type, 0) + 1
+        self.last_timestamp = record.timestamp
+
+        user = record.user
+        if isinstance(user, tuple):
+            self.participants.add(user[0])
+        elif user.get('text') is not None:
+            self.anonymous.add(user['text'])
+
+        if record.type in NODE_TYPES:
+            parent_depth = self.depths.get(record.parentId)
+            if parent_depth is None:
+                depth = 0
+                self.roots += 1
+            else:
+                depth = parent_depth + 1
+            self.depths[record.id] = depth
+            self.max_depth = max(self.max_depth, depth)
+
+            self.max_toxicity = max(self.max_toxicity, record.toxicity)
+            self.sum_toxicity += record.toxicity
+
+    def to_dict(self) -> Mapping:
+        """Return the statistics of the conversation."""
+        nodes = len(self.depths)
+        return {
+            'conversationId': self.conversationId,
+            'pageId': self.pageId,
+            'pageTitle': self.pageTitle,
+            'firstTimestamp': types.isoformat_timestamp(self.first_timestamp),
+            'lastTimestamp': types.isoformat_timestamp(self.last_timestamp),
+            'actions': self.actions,
+            'types': dict(sorted(self.types.items())),
+            'comments': nodes,
+            'roots': self.roots,
+            'replies': nodes - self.roots,
+            'maxDepth': self.max_depth,
+            'participants': len(self.participants) + len(self.anonymous),
+            'registeredParticipants': len(self.participants),
+            'anonymousParticipants': len(self.anonymous),
+            'maxToxicity': self.max_toxicity,
+            'meanToxicity': self.sum_toxicity / nodes if nodes else 0.0,
+        }
+
+
+def page_conversations(
+        records: Iterable[types.WikiConvRecord]) -> List[Conversation]:
+    """Build the conversations of the actions of a page, in order of their
+       first action."""
+    conversations = dict()
+    for record in records:
+        conversation = conversations.get(record.conversationId)
+        if conversation is None:
+            conversation = Conversation(record)
+            conversations[record.conversationId] = conversation
+        conversation.add(record)
+
+    return list(conversations.values())
+
+
+def iter_conversations(
+        dump: Iterable[Mapping],
+        stats: Mapping) -> Iterator[Conversation]:
+    """Yield the conversations of the input, page by page."""
+    def records():
+        nobjs = 0
+        for obj in dump:
+            nobjs += 1
+            if (nobjs-1) % NPRINTREVISION == 0:
+                utils.dot()
+            yield types.cast_record(obj)
+        stats['performance']['input']['objects'] = nobjs
+
+    prev_pageid = None
+    for pageid, page_records in itertools.groupby(records(),
+                                                  key=lambda rec: rec.pageId):
+        assert (prev_pageid is None or pageid > prev_pageid), \
+               "The input must be sorted by page ID, " \
+               "as the output of filter-pageid"
+        prev_pageid = pageid
+
+        conversations = page_conversations(page_records)
+
+        page_objects = sum(conv.actions for conv in conversations)
+        stats['performance']['input']['pages'] += 1
+        stats['performance']['peak_page_objects'] = max(
+            stats['performance']['peak_page_objects'], page_objects)
+
+        for conversation in conversations:
+            stats['performance']['output']['conversations'] += 1
+            stats['performance']['peak_depth'] = max(
+                stats['performance']['peak_depth'], conversation.max_depth)
+            yield conversation
+
+
+def configure_subparsers(subparsers):
+    """Configure a new subparser ."""
+    parser = subparsers.add_parser(
+        'conversations',
+        help='Reconstruct the conversations of the output of filter-pageid, '
+             'writing the statistics of each one.',
+    )
+
+    parser.set_defaults(func=main, stats_template=stats_template)
+
+
+def new_stats() -> Mapping:
+    """Return an empty stats dictionary."""
+    return {
+        'performance': {
+            'start_time': None,
+            'end_time': None,
+            'input': {
+                'objects': 0,
+                'pages': 0,
+            },
+            'output': {
+                'conversations': 0,
+            },
+            'peak_page_objects': 0,
+            'peak_depth': 0,
+        },
+    }
+
+
+def main(
+        dump: Iterable[Mapping],
+        basename: str,
+        args: argparse.Namespace) -> Mapping:
+    """Main function that parses the arguments and writes the output.
+
+       Return the stats of the output, by output name.
+    """
+    name = 'conversations'
+
+    stats = new_stats()
+    stats['performance']['start_time'] = datetime.datetime.utcnow()
+
+    output = fu.JSONLinesWriter(open(os.devnull, 'wt'))
+    stats_output = open(os.devnull, 'wt')
+    if not args.dry_run:
+        varname = '{basename}.{name}'.format(basename=basename, name=name)
+        output = fu.JSONLinesWriter(fu.output_writer(
+            path=str(args.output_dir_path / (varname + '.json')),
+            compression=args.output_compression,
+            workers=args.compression_workers,
+            block_size=args.compression_block_size*1024*1024,
+        ))
+        stats_output = fu.output_writer(
+            path=str(args.output_dir_path / (varname + '.stats.xml')),
+            compression=args.output_compression,
+        )
+
+    with output:
+        for conversation in iter_conversations(dump, stats):
+            output.write_record(json.dumps(conversation.to_dict()))
+
+    stats['performance']['end_time'] = datetime.datetime.utcnow()
+
+    with stats_output:
+        dumper.render_template(
+            stats_template,
+            stats_output,
+            stats=stats,
+        )
+
+    return {name: stats}
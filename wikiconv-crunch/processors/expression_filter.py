@@ -0,0 +1,171 @@
+"""
+Filter the objects with an expression over their fields.
+
+The expression (see expressions.py) is compiled once into a single
+predicate, which reads from each raw line only the fields it needs: lines
+are decoded only if a clause needs a nested or a text field, and only when
+the cheaper clauses did not already reject them.
+
+The output format is JSON, one object per line, in input order.
+"""
+
+import os
+import argparse
+import datetime
+
+from typing import Any, Callable, Iterable, Mapping
+
+from .. import file_utils as fu
+from .. import dumper
+from .. import expressions
+from .. import types
+from .. import utils
+
+# print a dot each NPRINTREVISION revisions
+NPRINTREVISION = 10000
+
+# templates
+stats_template = '''
+<stats>
+    <performance>
+        <start_time>${stats['performance']['start_time'] | x}</start_time>
+        <end_time>${stats['performance']['end_time'] | x}</end_time>
+        <input>
+            <objects>${stats['performance']['input']['objects'] | x}</objects>
+            <decoded>${stats['performance']['input']['decoded'] | x}</decoded>
+            <filtered>${stats['performance']['input']['filtered'] | x}</filtered>
+        </input>
+    </performance>
+</stats>
+'''
+
+
+def open_dump(path: str, args: argparse.Namespace) -> Iterable[str]:
+    """Open an input file, reading its raw lines."""
+    return fu.open_jsonlines_file(path)
+
+
+def configure_subparsers(subparsers):
+    """Configure a new subparser ."""
+    parser = subparsers.add_parser(
+        'filter',
+        help='Filter the objects with an expression over their fields, '
+             'e.g. "pageNamespace == 1 and score.toxicity >= 0.8".',
+    )
+    parser.add_argument(
+        '--where',
+        required=True,
+        help='Filter expression: comparisons of the fields of the objects '
+             '(user.id, score.toxicity, ...) with constants, in and not in '
+             'lists of constants, is None, combined with and, or, not.'
+    )
+    parser.add_argument(
+        '--name',
+        default='filter',
+        help='Name of the output, to tell apart the outputs of different '
+             'expressions [default: filter].'
+    )
+    parser.add_argument(
+        '--passthrough',
+        action='store_true',
+        help='Write the accepted input lines as they are, without decoding '
+             'and serializing them again.'
+    )
+
+    parser.set_defaults(func=main,
+                        dump_reader=open_dump,
+                        stats_template=stats_template)
+
+
+def new_stats() -> Mapping:
+    """Return an empty stats dictionary."""
+    return {
+        'performance': {
+            'start_time': None,
+            'end_time': None,
+            'input': {
+                'objects': 0,
+                'decoded': 0,
+                'filtered': 0,
+            },
+        },
+    }
+
+
+def filter_lines(
+        lines: Iterable[str],
+        predicate: expressions.CompiledExpression,
+        loads: Callable[[str], Any],
+        passthrough: bool,
+        stats: Mapping) -> Iterable[str]:
+    """Yield the serialized objects of the lines accepted by predicate."""
+    nobjs = 0
+    decoded = 0
+    filtered = 0
+    for line in lines:
+        nobjs += 1
+        if (nobjs-1) % NPRINTREVISION == 0:
+            utils.dot()
+
+        record = expressions.LazyRecord(line, loads)
+        if predicate(record):
+            filtered += 1
+            if passthrough:
+                yield line.rstrip('\r\n')
+            else:
+                yield types.cast_record(record.obj).to_json()
+        decoded += record.decoded
+
+    stats['performance']['input']['objects'] = nobjs
+    stats['performance']['input']['decoded'] = decoded
+    stats['performance']['input']['filtered'] = filtered
+
+
+def main(
+        dump: Iterable[str],
+        basename: str,
+        args: argparse.Namespace) -> Mapping:
+    """Main function that parses the arguments and writes the output.
+
+       Return the stats of the output, by output name.
+    """
+    name = args.name
+    predicate = expressions.compile_expression(args.where)
+    utils.log("Compiled filter:\n{}".format(predicate.source))
+
+    stats = new_stats()
+    stats['performance']['start_time'] = datetime.datetime.utcnow()
+
+    output = fu.JSONLinesWriter(open(os.devnull, 'wt'))
+    stats_output = open(os.devnull, 'wt')
+    if not args.dry_run:
+        varname = '{basename}.{name}'.format(basename=basename, name=name)
+        output = fu.JSONLinesWriter(fu.output_writer(
+            path=str(args.output_dir_path / (varname + '.json')),
+            compression=args.output_compression,
+            workers=args.compression_workers,
+            block_size=args.compression_block_size*1024*1024,
+        ))
+        stats_output = fu.output_writer(
+            path=str(args.output_dir_path / (varname + '.stats.xml')),
+            compression=args.output_compression,
+        )
+
+    with output:
+        for line in filter_lines(dump,
+                                 predicate,
+                                 loads=fu.get_json_decoder(args.json_decoder),
+                                 passthrough=args.passthrough,
+                                 stats=stats):
+            output.write_record(line)
+
+    stats['performance']['end_time'] = datetime.datetime.utcnow()
+
+    with stats_output:
+        dumper.render_template(
+            stats_template,
+            stats_output,
+            stats=stats,
+        )
+
+    return {name: stats}
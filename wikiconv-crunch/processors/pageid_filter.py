@@ -5,23 +5,39 @@ The output format is csv.
 """
 
 import os
+import sys
+import copy
 import json
+import functools
 import argparse
 import datetime
+import time
 
-from typing import Iterable, Iterator, Mapping
+from typing import (Any, Callable, Iterable, Iterator, List, Mapping,
+                    Optional, Tuple)
+
+import more_itertools
 
 from .. import file_utils as fu
+from .. import columnar
+from .. import dedup
 from .. import dumper
+from .. import instrumentation
+from .. import pipeline
+from .. import predicates
+from .. import sorting
 from .. import types
 from .. import utils
+from . import pageid_index
 
-from operator import itemgetter
 from pprint import pprint
 
 # print a dot each NPRINTREVISION revisions
 NPRINTREVISION = 10000
 
+# number of lines filtered in a batch
+BATCH_SIZE = 1000
+
 # templates
 stats_template = '''
 <stats>
@@ -31,45 +47,514 @@ stats_template = '''
         <input>
             <objects>${stats['performance']['input']['objects'] | x}</objects>
             <filtered>${stats['performance']['input']['filtered'] | x}</filtered>
+            <order>${stats['performance']['input']['order'] | x}</order>
+            <stopped_early>${stats['performance']['input']['stopped_early'] | x}</stopped_early>
         </input>
         <sort>
             <start_time>${stats['performance']['sort']['start_time'] | x}</start_time>
             <end_time>${stats['performance']['sort']['end_time'] | x}</end_time>
+            <runs>${stats['performance']['sort']['runs'] | x}</runs>
+            <strategy>${stats['performance']['sort']['strategy'] | x}</strategy>
+            <input_runs>${stats['performance']['sort']['input_runs'] | x}</input_runs>
         </sort>
+        % if 'dedup' in stats['performance']:
+        <dedup>
+            <checked>${stats['performance']['dedup']['checked'] | x}</checked>
+            <suspected>${stats['performance']['dedup']['suspected'] | x}</suspected>
+            <duplicates>${stats['performance']['dedup']['duplicates'] | x}</duplicates>
+            <false_positives>${stats['performance']['dedup']['false_positives'] | x}</false_positives>
+            <peak_filter_bytes>${stats['performance']['dedup']['peak_filter_bytes'] | x}</peak_filter_bytes>
+        </dedup>
+        % endif
+        % if 'pipeline' in stats['performance']:
+        <pipeline>
+            % for stage, counters in stats['performance']['pipeline'].items():
+            <stage name="${stage | x}">
+                <items>${counters['items'] | x}</items>
+                <batches>${counters['batches'] | x}</batches>
+                <busy_time>${counters['busy_time'] | x}</busy_time>
+                <wait_time>${counters['wait_time'] | x}</wait_time>
+                <items_per_second>${round(counters['items']/counters['busy_time'], 1) if counters['busy_time'] else 0 | x}</items_per_second>
+            </stage>
+            % endfor
+        </pipeline>
+        % endif
+        % if 'metrics' in stats['performance']:
+        <metrics>
+            % for name, timer in stats['performance']['metrics']['timers'].items():
+            <timer name="${name | x}" seconds="${round(timer['seconds'], 3) | x}" calls="${timer['calls'] | x}" />
+            % endfor
+            % for name, value in stats['performance']['metrics']['counters'].items():
+            <counter name="${name | x}" value="${value | x}" />
+            % endfor
+            <objects_per_second>${round(stats['performance']['input']['objects']/max((stats['performance']['end_time'] - stats['performance']['start_time']).total_seconds(), 1e-6), 1) | x}</objects_per_second>
+            <peak_rss_kb>${stats['performance']['metrics']['peak_rss_kb'] | x}</peak_rss_kb>
+        </metrics>
+        % endif
     </performance>
 </stats>
 '''
 
 
+def get_ranges(args: argparse.Namespace) -> List[Tuple[int, int]]:
+    """Return the list of (start_id, end_id) ranges requested on the command
+       line, sorted by start ID.
+
+       Ranges are either given explicitly with --ranges or computed from
+       --start-id, --end-id and --step in the same way filter-pageid.sh
+       does: the first range starts at start_id, each range spans step IDs
+       and the following one starts right after the end of the previous.
+
+       If only --ids-file is given the single range spans from the smallest
+       to the largest listed ID.
+    """
+    if args.ranges:
+        ranges = []
+        for spec in args.ranges.split(','):
+            start, end = spec.split('-')
+            ranges.append((int(start), int(end)))
+    elif (args.ids_file is not None
+            and args.start_id is None and args.end_id is None):
+        ids = load_ids(args.ids_file)
+        assert len(ids), "The IDs file does not contain any ID"
+        return [(ids.min, ids.max)]
+    else:
+        assert (args.start_id is not None and args.end_id is not None), \
+               "Either --ranges, --ids-file or --start-id and --end-id " \
+               "are required"
+
+        if args.step is None:
+            ranges = [(args.start_id, args.end_id)]
+        else:
+            assert (args.step > 0), "Step must be positive"
+
+            ranges = []
+            for id_ in range(args.start_id, args.end_id+1, args.step):
+                sid = id_ if id_ == args.start_id else id_ + 1
+                if sid >= args.end_id:
+                    break
+                ranges.append((sid, id_ + args.step))
+
+    ranges.sort()
+    for start_id, end_id in ranges:
+        assert (start_id < end_id), \
+               "Start ID must be smaller than end ID"
+    for (_, prev_end), (next_start, _) in utils.pairwise(ranges):
+        assert (prev_end < next_start), \
+               "ID ranges must not overlap"
+
+    return ranges
+
+
+@functools.lru_cache(maxsize=1)
+def load_ids(path: str) -> predicates.IdSet:
+    """Load the page IDs listed in a file."""
+    return predicates.IdSet.from_file(path)
+
+
+def ids_suffix(path: Optional[str]) -> str:
+    """Return the suffix of the output names for the IDs file path."""
+    if path is None:
+        return ''
+    return '.ids-{}'.format(os.path.basename(path).split('.')[0])
+
+
+def get_predicate(
+        args: argparse.Namespace,
+        ranges: List[Tuple[int, int]]) -> predicates.PageIdPredicate:
+    """Return the predicate assigning page IDs to the ranges, accepting only
+       the IDs listed in --ids-file if given."""
+    ids = None
+    if args.ids_file is not None:
+        ids = load_ids(args.ids_file)
+    return predicates.PageIdPredicate(predicates.IdRanges(ranges), ids)
+
+
+@functools.lru_cache(maxsize=1)
+def get_deduplicator(
+        capacity: int,
+        error: float,
+        state_dir: Optional[str],
+        tmp_dir: Optional[str]) -> dedup.Deduplicator:
+    """Return the deduplicator shared by the input files of a run."""
+    return dedup.Deduplicator(capacity, error,
+                              state_dir=state_dir,
+                              tmp_dir=tmp_dir)
+
+
+def encode_json(record: types.WikiConvRecord) -> str:
+    """Serialize a record."""
+    return record.to_json()
+
+
+def encode_sharded(
+        record: types.WikiConvRecord,
+        shard_key: str,
+        nshards: int) -> Tuple[int, str]:
+    """Serialize a record, together with the shard of its shard_key
+       field."""
+    return (fu.shard_of(getattr(record, shard_key), nshards),
+            record.to_json())
+
+
+def encode_raw(line: str) -> str:
+    """Return a raw line as it is, without the line terminator."""
+    return line.rstrip('\r\n')
+
+
+def encode_raw_sharded(
+        line: str,
+        shard_key: str,
+        nshards: int) -> Tuple[int, str]:
+    """Return a raw line as it is, without the line terminator, together
+       with the shard of its shard_key field."""
+    value = types.raw_value(line, shard_key)
+    if value is None:
+        value = json.loads(line)[shard_key]
+    if shard_key == 'pageId':
+        value = int(value)
+    return (fu.shard_of(value, nshards), line.rstrip('\r\n'))
+
+
+def raw_sort_key(
+        line: str,
+        pageid: int,
+        loads: Callable[[str], Any]=json.loads) -> Tuple[int, str]:
+    """Return the sort key of a raw line, decoding it only if the timestamp
+       can not be read from the raw line."""
+    timestamp = types.raw_value(line, 'timestamp')
+    if timestamp is None:
+        timestamp = loads(line)['timestamp']
+    return (pageid, types.timestamp_key(timestamp))
+
+
+def filter_lines(
+        lines: Iterable[str],
+        predicate: predicates.PageIdPredicate,
+        encode: Callable[[Any], Any]=encode_json,
+        loads: Callable[[str], Any]=json.loads,
+        metrics: Optional[instrumentation.Metrics]=None,
+        passthrough: bool=False,
+        record_ids: bool=False
+        ) -> Tuple[int, List[tuple]]:
+    """Return the number of lines and the (range index, sort key, encoded
+       object) triple of each line whose page ID is accepted by predicate.
+
+       If passthrough is True accepted lines are not decoded, encode is
+       called on the raw line instead of the record. If record_ids is True
+       the id of the record is appended to each triple.
+
+       Time spent decoding, casting, encoding and filtering is added to
+       metrics.
+    """
+    perf_counter = time.perf_counter
+    loads_time = cast_time = encode_time = 0.0
+
+    batch_start = perf_counter()
+    # read only the pageId from the raw lines, the full objects are decoded
+    # and cast only if they are accepted
+    lines = list(lines)
+    pageids = []
+    for line in lines:
+        pageid = types.raw_pageid(line)
+        if pageid is None:
+            pageid = int(loads(line)['pageId'])
+        pageids.append(pageid)
+
+    accepted = []
+    nlines = len(lines)
+    for line, pageid, idx in zip(lines,
+                                 pageids,
+                                 predicate.find_many(pageids)):
+        if idx >= 0 and passthrough:
+            key = raw_sort_key(line, pageid, loads)
+            start = perf_counter()
+            accepted.append((idx, key, encode(line)))
+            encode_time += perf_counter() - start
+            if record_ids:
+                record_id = types.raw_record_id(line)
+                if record_id is None:
+                    record_id = loads(line)['id']
+                accepted[-1] += (record_id, )
+        elif idx >= 0:
+            start = perf_counter()
+            raw_obj = loads(line)
+            loaded = perf_counter()
+            record = types.cast_record(raw_obj)
+            cast = perf_counter()
+
+            key = (record.pageId, types.timestamp_key(record.timestamp))
+            accepted.append((idx, key, encode(record)))
+            if record_ids:
+                accepted[-1] += (record.id, )
+
+            encode_time += perf_counter() - cast
+            cast_time += cast - loaded
+            loads_time += loaded - start
+
+    if metrics is not None:
+        total_time = perf_counter() - batch_start
+        naccepted = len(accepted)
+        metrics.add_time('json_loads', loads_time, naccepted)
+        metrics.add_time('cast_json', cast_time, naccepted)
+        metrics.add_time('serialization', encode_time, naccepted)
+        metrics.add_time('filter',
+                         total_time - loads_time - cast_time - encode_time,
+                         nlines)
+
+    return nlines, accepted
+
+
+def drop_duplicates(
+        accepted: List[tuple],
+        deduplicator: dedup.Deduplicator,
+        stats: List[Mapping]) -> List[tuple]:
+    """Return the (range index, sort key, encoded object) triples of the
+       accepted objects whose id was not seen before, counting the
+       duplicates in the stats of each range."""
+    suspected, duplicates = deduplicator.check(
+        [record_id for _, _, _, record_id in accepted])
+
+    res = []
+    for (idx, key, line, _), suspect, duplicate in zip(
+            accepted, suspected.tolist(), duplicates.tolist()):
+        dedup_stats = stats[idx]['performance']['dedup']
+        dedup_stats['checked'] += 1
+        dedup_stats['suspected'] += suspect
+        dedup_stats['duplicates'] += duplicate
+        dedup_stats['false_positives'] += suspect and not duplicate
+        if not duplicate:
+            res.append((idx, key, line))
+
+    for range_stats in stats:
+        dedup_stats = range_stats['performance']['dedup']
+        dedup_stats['peak_filter_bytes'] = deduplicator.bloom.nbytes
+    return res
+
+
 def process_lines(
-        dump: Iterable[list],
-        ids: Iterable[set],
-        stats: Mapping) -> Iterator[list]:
-    """Assign each revision to the snapshot or snapshots to which they
-       belong.
+        dump: Iterable[str],
+        predicate: predicates.PageIdPredicate,
+        sorters: List[sorting.ExternalSorter],
+        stats: List[Mapping],
+        encode: Callable[[types.WikiConvRecord], Any]=encode_json,
+        loads: Callable[[str], Any]=json.loads,
+        metrics: Optional[instrumentation.Metrics]=None,
+        pipeline_stats: Optional[Mapping]=None,
+        pipeline_workers: int=2,
+        passthrough: bool=False,
+        end_id: Optional[int]=None,
+        deduplicator: Optional[dedup.Deduplicator]=None) -> None:
+    """Assign each object to the ID range to which it belongs, adding it to
+       the sorter of the range.
+
+       If deduplicator is given the objects whose id was already seen are
+       dropped.
+
+       If end_id is given the input is sorted by page ID, and reading stops
+       once the page ID passes end_id.
+
+       If passthrough is True the raw lines are added instead of the
+       encoded records.
+
+       If pipeline_stats is given the input is read and filtered by the
+       stages of a pipeline, whose counters are stored in pipeline_stats.
     """
+    if metrics is None:
+        metrics = instrumentation.Metrics()
 
-    filtered_objs = list()
-    for raw_obj in dump:
-        obj = types.cast_json(raw_obj)
+    read_state = {'stopped_early': False}
+    if end_id is not None:
+        dump = read_until(dump, end_id, read_state)
+    dump = metrics.timed_iter(dump, 'decompression', counter='bytes_in')
 
-        stats['performance']['input']['objects'] += 1
-        if obj['pageId'] in ids:
-            filtered_objs.append(obj)
-            stats['performance']['input']['filtered'] += 1
+    filter_batch = functools.partial(filter_lines,
+                                     predicate=predicate,
+                                     encode=encode,
+                                     loads=loads,
+                                     metrics=metrics,
+                                     passthrough=passthrough,
+                                     record_ids=deduplicator is not None)
+    if pipeline_stats is not None:
+        results = pipeline.map_batches(
+            dump,
+            filter_batch,
+            stats=pipeline_stats,
+            workers=pipeline_workers,
+            batch_size=BATCH_SIZE,
+        )
+    else:
+        results = (filter_batch(batch)
+                   for batch in more_itertools.chunked(dump, BATCH_SIZE))
 
-        nobjs = stats['performance']['input']['objects']
-        if (nobjs-1) % NPRINTREVISION == 0:
+    nobjs = 0
+    for nlines, accepted in results:
+        ndots = -(-nobjs // NPRINTREVISION)
+        nobjs += nlines
+        for _ in range(ndots, -(-nobjs // NPRINTREVISION)):
             utils.dot()
 
+        if deduplicator is not None:
+            start = time.perf_counter()
+            nchecked = len(accepted)
+            accepted = drop_duplicates(accepted, deduplicator, stats)
+            metrics.add_time('dedup', time.perf_counter() - start, nchecked)
+
+        start = time.perf_counter()
+        for idx, key, line in accepted:
+            sorters[idx].add(key, line)
+            stats[idx]['performance']['input']['filtered'] += 1
+        metrics.add_time('sort_add', time.perf_counter() - start,
+                         len(accepted))
+
+    metrics.count('objects', nobjs)
+    for range_stats in stats:
+        range_stats['performance']['input']['objects'] = nobjs
+        range_stats['performance']['input']['stopped_early'] = \
+            read_state['stopped_early']
+
+
+def sort_lines(
+        sorter: sorting.ExternalSorter,
+        stats: Mapping) -> Iterator[Any]:
+    """Yield the encoded objects sorted by page ID and timestamp."""
+
     stats['performance']['sort']['start_time'] = datetime.datetime.utcnow()
-    filtered_objs.sort(key=itemgetter('pageId', 'timestamp'))
+    stats['performance']['sort']['runs'] = sorter.nruns
+    stats['performance']['sort']['strategy'] = sorter.strategy
+    stats['performance']['sort']['input_runs'] = sorter.input_runs
+
+    yield from sorter.sorted()
+
     stats['performance']['sort']['end_time'] = datetime.datetime.utcnow()
 
-    for obj in filtered_objs:
-        obj["timestamp"] = obj["timestamp"].isoformat()
 
-        yield obj
+class InputLines(object):
+    """Raw lines of an input file, with what is known of their order: 'index'
+       if the index of the file says that it is sorted by page ID, 'assumed'
+       with --assume-sorted and 'unknown' otherwise."""
+
+    def __init__(self, lines: Iterable[str], order: str='unknown'):
+        self.lines = lines
+        self.order = order
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def close(self):
+        if hasattr(self.lines, 'close'):
+            self.lines.close()
+
+
+def open_dump(path: str, args: argparse.Namespace) -> InputLines:
+    """Open an input file, reading its raw lines.
+
+       If the file has an up-to-date page ID index only the blocks that may
+       contain a page ID in the requested ranges are read.
+    """
+    order = 'assumed' if args.assume_sorted else 'unknown'
+
+    index = None
+    if not args.no_index:
+        index = pageid_index.load_index(path)
+
+    if index is None:
+        return InputLines(fu.open_jsonlines_file(path), order)
+
+    if index['sorted']:
+        order = 'index'
+
+    blocks = pageid_index.select_blocks(
+        index, get_predicate(args, get_ranges(args)))
+    utils.log("Reading {} of {} blocks of {}"
+              .format(len(blocks), len(index['blocks']), path))
+
+    return InputLines(fu.read_line_blocks(path, blocks), order)
+
+
+def read_until(
+        lines: Iterable[str],
+        end_id: int,
+        state: Mapping,
+        every: int=BATCH_SIZE) -> Iterator[str]:
+    """Yield the lines of an input sorted by page ID, stopping once the page
+       ID passes end_id.
+
+       The page ID is read every every lines, the lines after the last
+       check are filtered as usual. If the page IDs turn out not to be
+       sorted the whole input is read. state['stopped_early'] is set if the
+       input was not read to the end.
+    """
+    checking = True
+    prev_pageid = None
+    for nline, line in enumerate(lines):
+        if checking and nline % every == 0:
+            pageid = types.raw_pageid(line)
+            if pageid is None:
+                pageid = int(json.loads(line)['pageId'])
+
+            if prev_pageid is not None and pageid < prev_pageid:
+                utils.log("The input is not sorted by page ID, reading "
+                          "it to the end")
+                checking = False
+            elif pageid > end_id:
+                state['stopped_early'] = True
+                return
+            prev_pageid = pageid
+
+        yield line
+
+
+def open_output(
+        path: str,
+        args: argparse.Namespace,
+        metrics: Optional[instrumentation.Metrics]=None,
+        pipeline_stats: Optional[Mapping]=None,
+        sort_memory: Optional[int]=None):
+    """Open the writer of an output, path is without extension.
+
+       If metrics is given the time spent writing JSON output is added to
+       it, if pipeline_stats is given JSON output is written and compressed
+       in a dedicated thread, whose counters (added up over the shards) are
+       stored in pipeline_stats. Sharded output is sorted using at most
+       about sort_memory bytes.
+    """
+    if args.output_format == 'columnar':
+        fu.register_output(path + columnar.COLUMNS_SUFFIX)
+        return columnar.ColumnarWriter(path + columnar.COLUMNS_SUFFIX)
+
+    def wrap(output):
+        if metrics is not None:
+            output = instrumentation.TimedWriter(output, metrics)
+        if pipeline_stats is not None:
+            output = pipeline.ThreadedWriter(output, stats=pipeline_stats)
+        return output
+
+    if args.shards:
+        return fu.ShardedWriter(
+            path,
+            nshards=args.shards,
+            compression=args.output_compression,
+            workers=args.compression_workers,
+            block_size=args.compression_block_size*1024*1024,
+            sort_memory=sort_memory if args.shard_sort else None,
+            tmp_dir=args.tmp_dir,
+            wrap=wrap,
+        )
+
+    return fu.JSONLinesWriter(wrap(fu.output_writer(
+        path=path + '.json',
+        compression=args.output_compression,
+        workers=args.compression_workers,
+        block_size=args.compression_block_size*1024*1024,
+    )))
+
+
+def skip_completed(args: argparse.Namespace) -> bool:
+    """Whether the units completed by a previous run can be skipped: not
+       when deduplicating with the state of this run only, which must see
+       the ids of all the input files."""
+    return not args.dedup or args.dedup_state is not None
 
 
 def configure_subparsers(subparsers):
@@ -81,85 +566,338 @@ def configure_subparsers(subparsers):
     parser.add_argument(
         '--start-id',
         type=int,
-        required=True,
         help='Start ID.'
     )
     parser.add_argument(
         '--end-id',
         type=int,
-        required=True,
         help='End ID.'
     )
+    parser.add_argument(
+        '--step',
+        type=int,
+        help='Partition [start ID, end ID] in ranges of STEP IDs, '
+             'writing one output per range in a single pass.'
+    )
+    parser.add_argument(
+        '--ranges',
+        help='Comma-separated list of ID ranges START-END, writing one '
+             'output per range in a single pass (e.g. 0-100,101-200).'
+    )
+    parser.add_argument(
+        '--ids-file',
+        type=str,
+        default=None,
+        help='File with the page IDs to keep, one per line, can be '
+             'compressed; combined with the ranges, or spanning from the '
+             'smallest to the largest ID if no range is given.'
+    )
 
-    parser.set_defaults(func=main)
+    parser.add_argument(
+        '--sort-memory',
+        type=int,
+        default=1024,
+        help='Memory budget for sorting, in MB, shared among the ranges; '
+             'sorted runs are spilled to temporary files when it is '
+             'exceeded [default: 1024].'
+    )
+    parser.add_argument(
+        '--tmp-dir',
+        type=str,
+        default=None,
+        help='Directory for the temporary sorted runs '
+             '[default: system temporary directory].'
+    )
 
+    parser.add_argument(
+        '--output-format',
+        choices=['json', 'columnar'],
+        default='json',
+        help='Output format: JSON objects, one per line, or a directory of '
+             'binary columns that can be memory-mapped; columnar output is '
+             'never compressed [default: json].'
+    )
+    parser.add_argument(
+        '--passthrough',
+        action='store_true',
+        help='Write the accepted input lines as they are, without decoding '
+             'and serializing them again; JSON output only.'
+    )
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=None,
+        help='Write each output in SHARDS JSON files, assigning the objects '
+             'of the same page (or conversation, see --shard-key) to the '
+             'same shard; objects are written in input order unless '
+             '--shard-sort is given.'
+    )
+    parser.add_argument(
+        '--shard-key',
+        choices=['pageId', 'conversationId'],
+        default='pageId',
+        help='Field whose hash selects the shard of an object '
+             '[default: pageId].'
+    )
+    parser.add_argument(
+        '--shard-sort',
+        action='store_true',
+        help='Sort each shard by page ID and timestamp.'
+    )
+    parser.add_argument(
+        '--dedup',
+        action='store_true',
+        help='Drop the objects whose id was already seen, in the same or in '
+             'a previous input file; needs --jobs 1.'
+    )
+    parser.add_argument(
+        '--dedup-capacity',
+        type=int,
+        default=100000000,
+        help='Expected number of distinct ids, the Bloom filter of --dedup '
+             'uses about 1.2 bytes per id at 1%% false positive rate '
+             '[default: 100000000].'
+    )
+    parser.add_argument(
+        '--dedup-error',
+        type=float,
+        default=0.01,
+        help='False positive rate of the Bloom filter of --dedup; false '
+             'positives are looked up on disk, they never drop an object '
+             '[default: 0.01].'
+    )
+    parser.add_argument(
+        '--dedup-state',
+        type=str,
+        default=None,
+        help='Directory where the ids seen by --dedup are kept, so that '
+             'later runs drop the objects written by the previous ones; '
+             'an existing filter keeps its capacity and error '
+             '[default: a temporary directory, for this run only].'
+    )
+    parser.add_argument(
+        '--assume-sorted',
+        action='store_true',
+        help='The input files are sorted by page ID: stop reading each '
+             'file once its page IDs pass the last range (files whose '
+             'index says that they are sorted are treated so anyway).'
+    )
+    parser.add_argument(
+        '--no-index',
+        action='store_true',
+        help='Read the whole input files, ignoring their page ID index.'
+    )
+    parser.add_argument(
+        '--metrics-json',
+        action='store_true',
+        help='Write also the stats and metrics of each output in a JSON '
+             'file.'
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Read, filter and write in separate pipeline stages connected '
+             'by bounded queues.'
+    )
+    parser.add_argument(
+        '--pipeline-workers',
+        type=int,
+        default=2,
+        help='Number of filter worker threads of the pipeline; JSON '
+             'decoding and filtering hold the GIL, so more than one worker '
+             'does not parallelize them, only decompression and compression '
+             'overlap with them [default: 2].'
+    )
 
-def main(
-        dump: Iterable[list],
-        basename: str,
-        args: argparse.Namespace) -> None:
-    """Main function that parses the arguments and writes the output."""
-    stats = {
+    parser.set_defaults(func=main,
+                        dump_reader=open_dump,
+                        stats_template=stats_template,
+                        skip_completed=skip_completed)
+
+
+def new_stats() -> Mapping:
+    """Return an empty stats dictionary."""
+    return {
         'performance': {
             'start_time': None,
             'end_time': None,
             'input': {
                 'objects': 0,
-                'filtered': 0
+                'filtered': 0,
+                'order': 'unknown',
+                'stopped_early': False,
             },
             'sort': {
                 'start_time': None,
                 'end_time': None,
+                'runs': 0,
+                'strategy': None,
+                'input_runs': 0,
             }
         },
     }
-    stats['performance']['start_time'] = datetime.datetime.utcnow()
 
-    assert (args.start_id < args.end_id), \
-           "Start ID must be smaller than end ID"
 
-    output = open(os.devnull, 'wt')
-    stats_output = open(os.devnull, 'wt')
-    if not args.dry_run:
-        varname = ('{basename}.{func}.{start_id:08d}-{end_id:08d}'
-                   .format(basename=basename,
-                           func='filter-pageid',
-                           start_id=args.start_id,
-                           end_id=args.end_id
-                           )
-                   )
-
-        output_filename = str(args.output_dir_path /
-                              (varname + '.json'))
-        stats_filename = str(args.output_dir_path /
-                             (varname + '.stats.xml'))
-
-        output = fu.output_writer(
-            path=output_filename,
-            compression=args.output_compression,
-        )
-        stats_output = fu.output_writer(
-            path=stats_filename,
-            compression=args.output_compression,
+def main(
+        dump: Iterable[str],
+        basename: str,
+        args: argparse.Namespace) -> Mapping:
+    """Main function that parses the arguments and writes the output.
+
+       Return the stats of each range, by output name.
+    """
+    start_time = datetime.datetime.utcnow()
+
+    ranges = get_ranges(args)
+    predicate = get_predicate(args, ranges)
+
+    stats = [new_stats() for _ in ranges]
+    deduplicator = None
+    if args.dedup:
+        assert (args.jobs == 1), "Deduplication needs --jobs 1"
+        deduplicator = get_deduplicator(args.dedup_capacity,
+                                        args.dedup_error,
+                                        args.dedup_state,
+                                        args.tmp_dir)
+        # the unit is identified by the prefix of its outputs, that a new
+        # run overwrites
+        deduplicator.begin_unit(
+            os.path.abspath(str(args.output_dir_path / basename)))
+
+    order = getattr(dump, 'order', 'unknown')
+    for range_stats in stats:
+        range_stats['performance']['start_time'] = start_time
+        range_stats['performance']['input']['order'] = order
+        if deduplicator is not None:
+            range_stats['performance']['dedup'] = dedup.new_stats()
+
+    metrics = instrumentation.Metrics()
+    pipeline_stats = dict() if args.pipeline else None
+    # the write stage of each output, added up over its shards
+    write_stats = [dict() if args.pipeline else None for _ in ranges]
+
+    # dry runs discard the encoded records, whatever the output format
+    outputs = [fu.NullWriter() for _ in ranges]
+    stats_outputs = [open(os.devnull, 'wt') for _ in ranges]
+    names = ['{func}.{start_id:08d}-{end_id:08d}{ids}'
+             .format(func='filter-pageid',
+                     start_id=start_id,
+                     end_id=end_id,
+                     ids=ids_suffix(args.ids_file),
+                     )
+             for start_id, end_id in ranges]
+    encode = encode_raw if args.passthrough else encode_json
+    sizeof = sys.getsizeof
+    if args.output_format == 'columnar':
+        assert (not args.shards), "Sharded output must be in JSON format"
+        assert (not args.passthrough), \
+               "Passthrough output must be in JSON format"
+        encode = columnar.encode
+        sizeof = columnar.sizeof
+    elif args.shards:
+        encode = functools.partial(
+            encode_raw_sharded if args.passthrough else encode_sharded,
+            shard_key=args.shard_key,
+            nshards=args.shards,
         )
 
-    ids = set(range(args.start_id, args.end_id+1))
+    memory_limit = args.sort_memory * 1024 * 1024 // len(ranges)
 
-    res = process_lines(
+    if not args.dry_run:
+        for idx, name in enumerate(names):
+            varname = '{basename}.{name}'.format(basename=basename, name=name)
+
+            stats_filename = str(args.output_dir_path /
+                                 (varname + '.stats.xml'))
+
+            outputs[idx] = open_output(
+                str(args.output_dir_path / varname),
+                args,
+                metrics=metrics,
+                pipeline_stats=write_stats[idx],
+                sort_memory=memory_limit,
+            )
+            stats_outputs[idx] = fu.output_writer(
+                path=stats_filename,
+                compression=args.output_compression,
+            )
+
+    # sharded writers write (or sort) the objects of each shard
+    # themselves, without sorting the whole output
+    sorters = [output
+               if isinstance(output, fu.ShardedWriter)
+               else sorting.ExternalSorter(memory_limit,
+                                           tmp_dir=args.tmp_dir,
+                                           sizeof=sizeof)
+               for output in outputs]
+
+    process_lines(
         dump,
-        ids=ids,
+        predicate=predicate,
+        sorters=sorters,
         stats=stats,
+        encode=encode,
+        loads=fu.get_json_decoder(args.json_decoder),
+        metrics=metrics,
+        pipeline_stats=pipeline_stats,
+        pipeline_workers=args.pipeline_workers,
+        passthrough=args.passthrough,
+        end_id=ranges[-1][1] if order != 'unknown' else None,
+        deduplicator=deduplicator,
     )
+    if deduplicator is not None:
+        deduplicator.save()
 
-    for obj in res:
-        output.write(json.dumps(obj))
-        output.write("\n")
+    for output, sorter, range_stats, range_write_stats in zip(
+            outputs, sorters, stats, write_stats):
+        if isinstance(output, fu.ShardedWriter):
+            sort_stats = range_stats['performance']['sort']
+            sort_stats['start_time'] = datetime.datetime.utcnow()
+            output.close()
+            sort_stats['runs'] = output.nruns
+            sort_stats['strategy'] = output.strategy
+            sort_stats['input_runs'] = output.input_runs
+            sort_stats['end_time'] = datetime.datetime.utcnow()
+        else:
+            with output:
+                for record in metrics.timed_iter(
+                        sort_lines(sorter, range_stats), 'sort_merge'):
+                    output.write_record(record)
 
-    stats['performance']['end_time'] = datetime.datetime.utcnow()
+        if pipeline_stats is not None:
+            range_stats['performance']['pipeline'] = \
+                dict(copy.deepcopy(pipeline_stats), **range_write_stats)
 
-    with stats_output:
-        dumper.render_template(
-            stats_template,
-            stats_output,
-            stats=stats,
-        )
+    if not args.dry_run and args.output_format == 'json':
+        if args.shards:
+            paths = [path for output in outputs for path in output.paths]
+        else:
+            paths = [fu.compressed_path(
+                        str(args.output_dir_path /
+                            (basename + '.' + name + '.json')),
+                        args.output_compression)
+                     for name in names]
+        metrics.count('output_file_bytes',
+                      sum(os.path.getsize(path) for path in paths))
+
+    end_time = datetime.datetime.utcnow()
+    metrics_stats = metrics.as_dict()
+    for name, range_stats, stats_output in zip(names, stats, stats_outputs):
+        range_stats['performance']['end_time'] = end_time
+        range_stats['performance']['metrics'] = copy.deepcopy(metrics_stats)
+
+        if args.metrics_json and not args.dry_run:
+            metrics_filename = str(args.output_dir_path /
+                                   (basename + '.' + name + '.metrics.json'))
+            fu.register_output(metrics_filename)
+            with open(metrics_filename, 'wt') as metrics_output:
+                json.dump(range_stats, metrics_output, indent=2, default=str)
+
+        with stats_output:
+            dumper.render_template(
+                stats_template,
+                stats_output,
+                stats=range_stats,
+            )
+
+    return dict(zip(names, stats))
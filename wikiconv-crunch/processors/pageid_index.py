@@ -0,0 +1,164 @@
+"""
+Build a sidecar index of the page IDs of an input file.
+
+The index records the minimum and maximum page ID of the file and of each
+block of lines, together with the point from which the block can be read
+without reading the file from the beginning. For gzip and bz2 files blocks
+can be restarted only at the beginning of a gzip member (or bz2 stream), so
+files compressed as a single member can be skipped as a whole but need to
+be decompressed up to the blocks to read.
+
+The output format is JSON.
+"""
+
+import os
+import json
+import argparse
+
+from typing import Iterable, List, Mapping, Optional, Tuple
+
+from .. import file_utils as fu
+from .. import predicates
+from .. import types
+from .. import utils
+
+INDEX_VERSION = 1
+
+# print a dot each NPRINTREVISION revisions
+NPRINTREVISION = 10000
+
+
+class LineOffsets(object):
+    """Lines of an input file, with their restart points."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __iter__(self):
+        return fu.iter_line_offsets(self.path)
+
+    def close(self):
+        pass
+
+
+def index_path(path: str) -> str:
+    """Return the path of the index of an input file."""
+    return path + '.idx.json'
+
+
+def load_index(path: str) -> Optional[Mapping]:
+    """Load the index of an input file, returning None if it does not exist
+       or if it is out of date."""
+    idx_path = index_path(path)
+    if not os.path.exists(idx_path):
+        return None
+
+    with open(idx_path, 'rt', encoding='utf-8') as infile:
+        index = json.load(infile)
+
+    stat = os.stat(path)
+    if (index.get('version') != INDEX_VERSION
+            or index['size'] != stat.st_size
+            or index['mtime_ns'] != stat.st_mtime_ns):
+        utils.log("Ignoring out of date index {}".format(idx_path))
+        return None
+
+    return index
+
+
+def select_blocks(
+        index: Mapping,
+        predicate: predicates.PageIdPredicate
+        ) -> List[Tuple[int, int, int, int]]:
+    """Return the blocks of the index that may contain a page ID accepted by
+       predicate, as (block number, restart offset, skip, number of lines)
+       tuples.
+    """
+    if (index['lines'] == 0
+            or not predicate.overlaps(index['min'], index['max'])):
+        return []
+
+    return [(num, offset, skip, nlines)
+            for num, (offset, skip, nlines, min_id, max_id)
+            in enumerate(index['blocks'])
+            if predicate.overlaps(min_id, max_id)]
+
+
+def build_index(
+        lines: Iterable[Tuple[int, int, str]],
+        block_size: int) -> Mapping:
+    """Build the index from the lines of a file with their restart points."""
+    blocks = []
+    nlines = 0
+    is_sorted = True
+    prev_pageid = None
+
+    block = None
+    for offset, skip, line in lines:
+        pageid = types.raw_pageid(line)
+        if pageid is None:
+            pageid = int(json.loads(line)['pageId'])
+
+        if prev_pageid is not None and pageid < prev_pageid:
+            is_sorted = False
+        prev_pageid = pageid
+
+        if block is None or block[2] >= block_size:
+            block = [offset, skip, 0, pageid, pageid]
+            blocks.append(block)
+
+        block[2] += 1
+        block[3] = min(block[3], pageid)
+        block[4] = max(block[4], pageid)
+
+        nlines += 1
+        if (nlines-1) % NPRINTREVISION == 0:
+            utils.dot()
+
+    return {
+        'version': INDEX_VERSION,
+        'lines': nlines,
+        'min': min((block[3] for block in blocks), default=None),
+        'max': max((block[4] for block in blocks), default=None),
+        'sorted': is_sorted,
+        'block_size': block_size,
+        'blocks': blocks,
+    }
+
+
+def open_dump(path: str, args: argparse.Namespace) -> LineOffsets:
+    """Open an input file, reading the restart point of each line."""
+    return LineOffsets(path)
+
+
+def configure_subparsers(subparsers):
+    """Configure a new subparser ."""
+    parser = subparsers.add_parser(
+        'index',
+        help='Write a sidecar page ID index next to each input file.',
+    )
+    parser.add_argument(
+        '--block-size',
+        type=int,
+        default=10000,
+        help='Number of lines in each block of the index [default: 10000].'
+    )
+
+    parser.set_defaults(func=main, dump_reader=open_dump)
+
+
+def main(
+        dump: LineOffsets,
+        basename: str,
+        args: argparse.Namespace) -> None:
+    """Main function that parses the arguments and writes the output."""
+    stat = os.stat(dump.path)
+
+    index = build_index(dump, block_size=args.block_size)
+    index['size'] = stat.st_size
+    index['mtime_ns'] = stat.st_mtime_ns
+
+    if not args.dry_run:
+        fu.register_output(index_path(dump.path))
+        with open(index_path(dump.path), 'wt', encoding='utf-8') as outfile:
+            json.dump(index, outfile, separators=(',', ':'))
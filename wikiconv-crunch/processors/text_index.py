@@ -0,0 +1,178 @@
+"""
+Build an inverted index of the terms of a text field of each input file.
+
+The input files are JSON objects, one per line, e.g. the output of
+filter-pageid, and are indexed one at a time: the index of each file is
+independent, so new files can be indexed incrementally. The index maps the
+lowercased words of the field (cleanedContent by default) to the ordinals
+of the objects that contain them, and records where each object can be read
+from the file, see inverted_index.py. Use the search sub-command to query
+it.
+
+The output format is binary, with JSON metadata.
+"""
+
+import os
+import argparse
+import datetime
+
+from typing import Iterable, Mapping, Tuple
+
+from .. import file_utils as fu
+from .. import dumper
+from .. import inverted_index
+from .. import types
+from .. import utils
+from . import pageid_index
+
+# print a dot each NPRINTREVISION revisions
+NPRINTREVISION = 10000
+
+# name of the output, its files are <input>.text-index.<suffix>
+NAME = 'text-index'
+
+# templates
+stats_template = '''
+<stats>
+    <performance>
+        <start_time>${stats['performance']['start_time'] | x}</start_time>
+        <end_time>${stats['performance']['end_time'] | x}</end_time>
+        <input>
+            <objects>${stats['performance']['input']['objects'] | x}</objects>
+        </input>
+        <index>
+            <terms>${stats['performance']['index']['terms'] | x}</terms>
+            <postings>${stats['performance']['index']['postings'] | x}</postings>
+            <postings_bytes>${stats['performance']['index']['postings_bytes'] | x}</postings_bytes>
+            <sort_runs>${stats['performance']['index']['sort_runs'] | x}</sort_runs>
+        </index>
+    </performance>
+</stats>
+'''
+
+
+def configure_subparsers(subparsers):
+    """Configure a new subparser ."""
+    parser = subparsers.add_parser(
+        'index-text',
+        help='Build an inverted index of the terms of a text field of each '
+             'input file, to be queried with search.',
+    )
+    parser.add_argument(
+        '--field',
+        choices=['cleanedContent', 'content', 'comment', 'pageTitle'],
+        default='cleanedContent',
+        help='Field whose terms are indexed [default: cleanedContent].'
+    )
+    parser.add_argument(
+        '--sort-memory',
+        type=int,
+        default=1024,
+        help='Memory budget for sorting the postings, in MB; sorted runs '
+             'are spilled to temporary files when it is exceeded '
+             '[default: 1024].'
+    )
+    parser.add_argument(
+        '--tmp-dir',
+        type=str,
+        default=None,
+        help='Directory for the temporary sorted runs '
+             '[default: system temporary directory].'
+    )
+
+    parser.set_defaults(func=main,
+                        dump_reader=pageid_index.open_dump,
+                        stats_template=stats_template)
+
+
+def new_stats() -> Mapping:
+    """Return an empty stats dictionary."""
+    return {
+        'performance': {
+            'start_time': None,
+            'end_time': None,
+            'input': {
+                'objects': 0,
+            },
+            'index': {
+                'terms': 0,
+                'postings': 0,
+                'postings_bytes': 0,
+                'sort_runs': 0,
+            },
+        },
+    }
+
+
+def add_lines(
+        lines: Iterable[Tuple[int, int, str]],
+        writer: inverted_index.IndexWriter,
+        field: str,
+        args: argparse.Namespace) -> None:
+    """Add the terms of the field of each line to the index."""
+    loads = fu.get_json_decoder(args.json_decoder)
+    nobjs = 0
+    for offset, skip, line in lines:
+        nobjs += 1
+        if (nobjs-1) % NPRINTREVISION == 0:
+            utils.dot()
+
+        text = None
+        if field in ('pageTitle', 'comment'):
+            # top-level strings, read from the raw line when possible
+            text = types.raw_value(line, field)
+        if text is None:
+            text = loads(line).get(field)
+        writer.add(offset, skip, inverted_index.tokenize(text))
+
+
+def main(
+        dump: pageid_index.LineOffsets,
+        basename: str,
+        args: argparse.Namespace) -> Mapping:
+    """Main function that parses the arguments and writes the output.
+
+       Return the stats of the output, by output name.
+    """
+    stats = new_stats()
+    stats['performance']['start_time'] = datetime.datetime.utcnow()
+
+    varname = '{basename}.{name}'.format(basename=basename, name=NAME)
+    writer = inverted_index.IndexWriter(
+        str(args.output_dir_path / varname),
+        memory_limit=args.sort_memory*1024*1024,
+        tmp_dir=args.tmp_dir,
+    )
+    add_lines(dump, writer, args.field, args)
+
+    stat = os.stat(dump.path)
+    metadata = {
+        'input': os.path.abspath(dump.path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'field': args.field,
+    }
+    stats['performance']['input']['objects'] = writer.nobjects
+    stats['performance']['index']['sort_runs'] = writer.sorter.nruns
+    if args.dry_run:
+        writer.sorter.close()
+    else:
+        counts = writer.write(metadata)
+        for suffix in inverted_index.SUFFIXES:
+            fu.register_output(writer.prefix + '.' + suffix)
+        for key in ('terms', 'postings', 'postings_bytes'):
+            stats['performance']['index'][key] = counts[key]
+
+    stats['performance']['end_time'] = datetime.datetime.utcnow()
+
+    if not args.dry_run:
+        with fu.output_writer(
+                path=str(args.output_dir_path / (varname + '.stats.xml')),
+                compression=args.output_compression) as stats_output:
+            dumper.render_template(
+                stats_template,
+                stats_output,
+                stats=stats,
+            )
+
+    return {NAME: stats}
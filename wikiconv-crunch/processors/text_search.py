@@ -0,0 +1,160 @@
+"""
+Search the inverted indexes written by index-text.
+
+The input files are the .text-index.json metadata files of the indexes. The
+query is a boolean query of terms, with AND (also implicit between adjacent
+terms), OR, NOT and parentheses, e.g.:
+
+    idiot OR (stupid AND NOT article)
+
+Terms are normalized as when indexing. The posting lists of the terms are
+read from the memory-mapped index and combined, then the matching objects
+are read from the indexed file at their offsets, without scanning it.
+
+The output format is JSON, the matching objects as they are in the indexed
+file, one per line.
+"""
+
+import os
+import argparse
+import datetime
+
+from typing import Mapping
+
+import numpy as np
+
+from .. import file_utils as fu
+from .. import dumper
+from .. import inverted_index
+from . import text_index
+
+# templates
+stats_template = '''
+<stats>
+    <performance>
+        <start_time>${stats['performance']['start_time'] | x}</start_time>
+        <end_time>${stats['performance']['end_time'] | x}</end_time>
+        <query>${stats['performance']['query'] | x}</query>
+        <input>
+            <objects>${stats['performance']['input']['objects'] | x}</objects>
+        </input>
+        <output>
+            <matches>${stats['performance']['output']['matches'] | x}</matches>
+            <written>${stats['performance']['output']['written'] | x}</written>
+        </output>
+    </performance>
+</stats>
+'''
+
+
+def open_dump(path: str, args: argparse.Namespace) -> inverted_index.TextIndex:
+    """Open the index with the given metadata file."""
+    return inverted_index.TextIndex(path)
+
+
+def configure_subparsers(subparsers):
+    """Configure a new subparser ."""
+    parser = subparsers.add_parser(
+        'search',
+        help='Search the indexes written by index-text (their .json '
+             'metadata files are the input files), writing the matching '
+             'objects.',
+    )
+    parser.add_argument(
+        '--query',
+        required=True,
+        help='Boolean query: terms combined with AND (also implicit), OR, '
+             'NOT and parentheses.'
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        help='Write at most LIMIT matching objects of each index.'
+    )
+
+    parser.set_defaults(func=main,
+                        dump_reader=open_dump,
+                        stats_template=stats_template)
+
+
+def new_stats() -> Mapping:
+    """Return an empty stats dictionary."""
+    return {
+        'performance': {
+            'start_time': None,
+            'end_time': None,
+            'query': None,
+            'input': {
+                'objects': 0,
+            },
+            'output': {
+                'matches': 0,
+                'written': 0,
+            },
+        },
+    }
+
+
+def main(
+        dump: inverted_index.TextIndex,
+        basename: str,
+        args: argparse.Namespace) -> Mapping:
+    """Main function that parses the arguments and writes the output.
+
+       Return the stats of the output, by output name.
+    """
+    name = 'search'
+
+    stats = new_stats()
+    stats['performance']['start_time'] = datetime.datetime.utcnow()
+    stats['performance']['query'] = args.query
+
+    metadata = dump.metadata
+    stat = os.stat(metadata['input'])
+    assert (stat.st_size == metadata['size']
+            and stat.st_mtime_ns == metadata['mtime_ns']), \
+           "The index is out of date: {}".format(metadata['input'])
+
+    ordinals = inverted_index.evaluate(
+        dump, inverted_index.parse_query(args.query))
+    stats['performance']['input']['objects'] = dump.nobjects
+    stats['performance']['output']['matches'] = len(ordinals)
+    if args.limit is not None:
+        ordinals = ordinals[:args.limit]
+    stats['performance']['output']['written'] = len(ordinals)
+
+    # basename is the name of the metadata file without .json
+    basename = basename[:-len('.' + text_index.NAME)]
+
+    output = fu.JSONLinesWriter(open(os.devnull, 'wt'))
+    stats_output = open(os.devnull, 'wt')
+    if not args.dry_run:
+        varname = '{basename}.{name}'.format(basename=basename, name=name)
+        output = fu.JSONLinesWriter(fu.output_writer(
+            path=str(args.output_dir_path / (varname + '.json')),
+            compression=args.output_compression,
+        ))
+        stats_output = fu.output_writer(
+            path=str(args.output_dir_path / (varname + '.stats.xml')),
+            compression=args.output_compression,
+        )
+
+    offsets = np.asarray(dump.offsets[ordinals.astype(np.int64)])
+    points = ((int(ordinal), int(offset), int(skip))
+              for ordinal, (offset, skip) in zip(ordinals.tolist(),
+                                                 offsets.tolist()))
+    with output:
+        for line in fu.read_lines_at(metadata['input'], points):
+            output.write_record(line.rstrip('\r\n'))
+
+    stats['performance']['end_time'] = datetime.datetime.utcnow()
+
+    with stats_output:
+        dumper.render_template(
+            stats_template,
+            stats_output,
+            stats=stats,
+        )
+
+    return {name: stats}
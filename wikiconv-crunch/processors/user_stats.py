@@ -0,0 +1,435 @@
+"""
+Approximate user activity statistics with bounded-memory sketches.
+
+The users of the objects (and the authors in their authorList) are added
+to mergeable sketches: HyperLogLog for the number of distinct users and
+authors, count-min for the number of actions of each user and SpaceSaving
+for the most active users and pages. The participants of the most active
+pages, the ones kept by SpaceSaving, are counted with a small HyperLogLog
+each, so memory does not grow with the number of pages. Users are
+identified by their ID, anonymous users by their text (IP address).
+
+The sketches of each input file are written in a JSON file, which can be
+passed back as input to user-stats to merge the results of separate runs.
+
+The output format is csv (actions and participants of the most active
+pages) and JSON (sketches).
+"""
+
+import os
+import json
+import argparse
+import datetime
+
+from typing import Any, Iterable, Mapping, Tuple
+
+import numpy as np
+
+from .. import file_utils as fu
+from .. import dumper
+from .. import sketches
+from .. import types
+from .. import utils
+
+# print a dot each NPRINTREVISION revisions
+NPRINTREVISION = 10000
+
+# number of objects added to the sketches in a batch
+BATCH_SIZE = 10000
+
+# suffix of the files with the sketches, after the output name
+SKETCH_SUFFIX = '.sketch.json'
+
+# templates
+stats_template = '''
+<stats>
+    <performance>
+        <start_time>${stats['performance']['start_time'] | x}</start_time>
+        <end_time>${stats['performance']['end_time'] | x}</end_time>
+        <input>
+            <objects>${stats['performance']['input']['objects'] | x}</objects>
+            <authors>${stats['performance']['input']['authors'] | x}</authors>
+        </input>
+    </performance>
+    <estimates>
+        <distinct_users error="${stats['estimates']['distinct_error'] | x}">${stats['estimates']['distinct_users'] | x}</distinct_users>
+        <distinct_authors error="${stats['estimates']['distinct_error'] | x}">${stats['estimates']['distinct_authors'] | x}</distinct_authors>
+        <top_users max_count_error="${stats['estimates']['count_error'] | x}">
+            % for user, count, error, sketch_count in stats['estimates']['top_users']:
+            <user name="${user | x}" count="${count | x}" error="${error | x}" count_min="${sketch_count | x}" />
+            % endfor
+        </top_users>
+    </estimates>
+</stats>
+'''
+
+
+def user_key(user: Any) -> str:
+    """Return the key of a user of a WikiConvRecord: the ID, or the text for
+       anonymous users."""
+    if isinstance(user, tuple):
+        return str(user[0])
+    return user.get('text', '')
+
+
+class UserSketches(object):
+    """Sketches of the users of a set of objects."""
+
+    def __init__(self,
+                 distinct_error: float=0.01,
+                 count_epsilon: float=0.0001,
+                 count_delta: float=0.01,
+                 top_k: int=100,
+                 top_pages: int=1000,
+                 page_error: float=0.1):
+        self.users = sketches.HyperLogLog.from_error(distinct_error)
+        self.authors = sketches.HyperLogLog.from_error(distinct_error)
+        self.activity = sketches.CountMinSketch.from_error(count_epsilon,
+                                                           count_delta)
+        self.top_users = sketches.SpaceSaving(top_k)
+        self.page_activity = sketches.SpaceSaving(top_pages)
+        self.page_precision = \
+            sketches.HyperLogLog.from_error(page_error).precision
+        # participants of the pages kept by page_activity
+        self.pages = dict()
+
+        self.objects = 0
+        self.nauthors = 0
+
+    def add_batch(self, records: Iterable[types.WikiConvRecord]) -> None:
+        """Add the users and authors of a batch of records."""
+        records = list(records)
+        users = [user_key(record.user) for record in records]
+        authors = [user_key(author)
+                   for record in records
+                   for author in record.authorList]
+
+        user_hashes = sketches.hash_values(users)
+        self.users.add_hashes(user_hashes[:, 0])
+        self.activity.add_hashes(user_hashes,
+                                 np.ones(len(users), dtype=np.int64))
+        self.top_users.add_many(users)
+        if authors:
+            self.authors.add_hashes(sketches.hash_values(authors)[:, 0])
+
+        # a page that enters the most active ones starts counting its
+        # participants from this batch, like its count starts from the
+        # count of the page it replaces
+        self.page_activity.add_many(record.pageId for record in records)
+        kept = self.page_activity.counts
+        pages = self.pages
+        for record, hash_ in zip(records, user_hashes[:, 0].tolist()):
+            if record.pageId not in kept:
+                continue
+            page = pages.get(record.pageId)
+            if page is None:
+                page = sketches.HyperLogLog(self.page_precision)
+                pages[record.pageId] = page
+            page.add_hash(hash_)
+        self._prune_pages()
+
+        self.objects += len(records)
+        self.nauthors += len(authors)
+
+    def _prune_pages(self) -> None:
+        """Drop the participants of the pages that are no longer among the
+           most active ones."""
+        kept = self.page_activity.counts
+        for pageid in [pageid for pageid in self.pages if pageid not in kept]:
+            del self.pages[pageid]
+
+    def top_pages(self) -> Iterable[Tuple[int, int, int]]:
+        """Yield the (page ID, actions, participants) of the most active
+           pages, by decreasing number of actions."""
+        for pageid, count, _ in self.page_activity.top():
+            page = self.pages.get(pageid)
+            yield pageid, count, round(page.count()) if page else 0
+
+    def merge(self, other: 'UserSketches') -> None:
+        """Merge the sketches of another set of objects."""
+        self.users.merge(other.users)
+        self.authors.merge(other.authors)
+        self.activity.merge(other.activity)
+        self.top_users.merge(other.top_users)
+        self.page_activity.merge(other.page_activity)
+        for pageid, page in other.pages.items():
+            if pageid in self.pages:
+                self.pages[pageid].merge(page)
+            else:
+                self.pages[pageid] = page
+        self._prune_pages()
+
+        self.objects += other.objects
+        self.nauthors += other.nauthors
+
+    def estimates(self) -> Mapping:
+        """Return the estimates of the sketches."""
+        top = self.top_users.top()
+        sketch_counts = []
+        if top:
+            sketch_counts = self.activity.estimate_hashes(
+                sketches.hash_values(user for user, _, _ in top)).tolist()
+
+        return {
+            'distinct_users': round(self.users.count()),
+            'distinct_authors': round(self.authors.count()),
+            'distinct_error': round(self.users.error, 4),
+            'count_error': int(np.ceil(self.activity.total * np.e
+                                       / self.activity.width)),
+            'top_users': [(user, count, error, sketch_count)
+                          for (user, count, error), sketch_count
+                          in zip(top, sketch_counts)],
+        }
+
+    def to_dict(self, pages: bool=True) -> Mapping:
+        dct = {
+            'objects': self.objects,
+            'authors': self.nauthors,
+            'users': self.users.to_dict(),
+            'author_users': self.authors.to_dict(),
+            'activity': self.activity.to_dict(),
+            'top_users': self.top_users.to_dict(),
+            'page_activity': self.page_activity.to_dict(),
+        }
+        if pages:
+            dct['page_precision'] = self.page_precision
+            dct['pages'] = {str(pageid): page.to_dict()
+                            for pageid, page in sorted(self.pages.items())}
+        return dct
+
+    @classmethod
+    def from_dict(cls, dct: Mapping) -> 'UserSketches':
+        res = cls.__new__(cls)
+        res.objects = dct['objects']
+        res.nauthors = dct['authors']
+        res.users = sketches.from_dict(dct['users'])
+        res.authors = sketches.from_dict(dct['author_users'])
+        res.activity = sketches.from_dict(dct['activity'])
+        res.top_users = sketches.from_dict(dct['top_users'])
+        res.page_activity = sketches.from_dict(dct['page_activity'])
+        res.page_precision = dct.get('page_precision')
+        res.pages = {int(pageid): sketches.from_dict(page)
+                     for pageid, page in dct.get('pages', dict()).items()}
+        return res
+
+
+class SketchFile(object):
+    """Sketches written by a previous run, read in place of an input
+       file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rt', encoding='utf-8') as infile:
+            self.sketches = UserSketches.from_dict(json.load(infile))
+
+    def close(self):
+        pass
+
+
+def open_dump(path: str, args: argparse.Namespace) -> Any:
+    """Open an input file, decoding its JSON objects, or load the sketches
+       of a previous run."""
+    if path.endswith(SKETCH_SUFFIX):
+        return SketchFile(path)
+
+    return fu.open_jsonobjects_file(
+        path,
+        loads=fu.get_json_decoder(args.json_decoder),
+    )
+
+
+def load_sketches(dct: Mapping) -> UserSketches:
+    """Load the sketches of the stats of a run: the path of its sketch file,
+       or the sketches themselves (dry runs and merged stats)."""
+    if 'path' in dct:
+        return SketchFile(dct['path']).sketches
+    return UserSketches.from_dict(dct)
+
+
+def merge_stats(first: Mapping, second: Mapping) -> Mapping:
+    """Merge the stats of two runs, merging their sketches and computing
+       the estimates again."""
+    merged = utils.merge_stats(
+        {key: value for key, value in first.items()
+         if key not in ('sketches', 'estimates')},
+        {key: value for key, value in second.items()
+         if key not in ('sketches', 'estimates')},
+    )
+
+    user_sketches = load_sketches(first['sketches'])
+    user_sketches.merge(load_sketches(second['sketches']))
+    merged['sketches'] = user_sketches.to_dict(pages=False)
+    merged['estimates'] = user_sketches.estimates()
+
+    return merged
+
+
+def configure_subparsers(subparsers):
+    """Configure a new subparser ."""
+    parser = subparsers.add_parser(
+        'user-stats',
+        help='Estimate distinct users, most active users and participants '
+             'of each page with bounded-memory sketches; sketch files '
+             'written by previous runs can be given as input to merge '
+             'them.',
+    )
+    parser.add_argument(
+        '--distinct-error',
+        type=float,
+        default=0.01,
+        help='Relative standard error of the number of distinct users and '
+             'authors [default: 0.01].'
+    )
+    parser.add_argument(
+        '--count-epsilon',
+        type=float,
+        default=0.0001,
+        help='Maximum overestimation of the number of actions of a user, '
+             'as a fraction of the total number of actions '
+             '[default: 0.0001].'
+    )
+    parser.add_argument(
+        '--count-delta',
+        type=float,
+        default=0.01,
+        help='Probability of exceeding the overestimation of the number of '
+             'actions of a user [default: 0.01].'
+    )
+    parser.add_argument(
+        '--top-k',
+        type=int,
+        default=100,
+        help='Number of most active users [default: 100].'
+    )
+    parser.add_argument(
+        '--top-pages',
+        type=int,
+        default=1000,
+        help='Number of most active pages whose participants are counted '
+             '[default: 1000].'
+    )
+    parser.add_argument(
+        '--page-error',
+        type=float,
+        default=0.1,
+        help='Relative standard error of the number of participants of '
+             'each page [default: 0.1].'
+    )
+
+    parser.set_defaults(func=main,
+                        dump_reader=open_dump,
+                        stats_template=stats_template,
+                        stats_merger=merge_stats)
+
+
+def new_stats() -> Mapping:
+    """Return an empty stats dictionary."""
+    return {
+        'performance': {
+            'start_time': None,
+            'end_time': None,
+            'input': {
+                'objects': 0,
+                'authors': 0,
+            },
+        },
+        'sketches': None,
+        'estimates': None,
+    }
+
+
+def build_sketches(
+        dump: Iterable[Mapping],
+        args: argparse.Namespace) -> UserSketches:
+    """Add the users of the objects of the input to new sketches."""
+    user_sketches = UserSketches(
+        distinct_error=args.distinct_error,
+        count_epsilon=args.count_epsilon,
+        count_delta=args.count_delta,
+        top_k=args.top_k,
+        top_pages=args.top_pages,
+        page_error=args.page_error,
+    )
+
+    nobjs = 0
+    batch = []
+    for obj in dump:
+        nobjs += 1
+        if (nobjs-1) % NPRINTREVISION == 0:
+            utils.dot()
+
+        batch.append(types.cast_record(obj))
+        if len(batch) >= BATCH_SIZE:
+            user_sketches.add_batch(batch)
+            batch = []
+    if batch:
+        user_sketches.add_batch(batch)
+
+    return user_sketches
+
+
+def main(
+        dump: Any,
+        basename: str,
+        args: argparse.Namespace) -> Mapping:
+    """Main function that parses the arguments and writes the output.
+
+       Return the stats of the output, by output name.
+    """
+    start_time = datetime.datetime.utcnow()
+
+    if isinstance(dump, SketchFile):
+        user_sketches = dump.sketches
+        # basename is the name of the sketch file without .json
+        basename = os.path.basename(dump.path)[:-len(SKETCH_SUFFIX)]
+        basename = basename.rsplit('.user-stats', 1)[0]
+    else:
+        user_sketches = build_sketches(dump, args)
+
+    stats = new_stats()
+    stats['performance']['start_time'] = start_time
+    stats['performance']['input']['objects'] = user_sketches.objects
+    stats['performance']['input']['authors'] = user_sketches.nauthors
+    stats['estimates'] = user_sketches.estimates()
+
+    name = 'user-stats'
+    if args.dry_run:
+        stats['sketches'] = user_sketches.to_dict(pages=False)
+    else:
+        varname = '{basename}.{name}'.format(basename=basename, name=name)
+        if isinstance(dump, SketchFile):
+            sketch_filename = dump.path
+        else:
+            sketch_filename = str(args.output_dir_path /
+                                  (varname + SKETCH_SUFFIX))
+            fu.register_output(sketch_filename)
+            with open(sketch_filename, 'wt', encoding='utf-8') as outfile:
+                json.dump(user_sketches.to_dict(), outfile)
+        # the stats (also recorded in the manifest) refer to the sketch
+        # file instead of embedding the sketches
+        stats['sketches'] = {'path': os.path.abspath(sketch_filename)}
+
+        pages_filename = str(args.output_dir_path / (varname + '.pages.csv'))
+        with fu.output_writer(
+                path=pages_filename,
+                compression=args.output_compression) as pages_output:
+            pages_output.write('pageId,actions,participants\n')
+            for pageid, count, participants in user_sketches.top_pages():
+                pages_output.write('{},{},{}\n'.format(pageid,
+                                                       count,
+                                                       participants))
+
+    stats['performance']['end_time'] = datetime.datetime.utcnow()
+
+    if not args.dry_run:
+        stats_filename = str(args.output_dir_path / (varname + '.stats.xml'))
+        with fu.output_writer(
+                path=stats_filename,
+                compression=args.output_compression) as stats_output:
+            dumper.render_template(
+                stats_template,
+                stats_output,
+                stats=stats,
+            )
+
+    return {name: stats}
@@ -0,0 +1,377 @@
+"""Mergeable sketches with bounded memory.
+
+  * HyperLogLog estimates the number of distinct values, with a relative
+    standard error of about 1.04/sqrt(2^precision);
+  * CountMinSketch estimates the frequency of each value, overestimating it
+    by at most epsilon times the total count with probability 1 - delta;
+  * SpaceSaving keeps the k most frequent values (heavy hitters), with an
+    upper bound on the error of each count;
+  * BloomFilter tells whether a value may have been added before, with a
+    given false positive rate and no false negatives.
+
+Values are hashed with 128-bit BLAKE2b, whose halves are used as two
+independent 64-bit hashes. Sketches built with the same parameters can be
+merged, also when they were built by separate runs: to_dict returns a
+JSON-serializable dictionary and from_dict loads it back.
+"""
+import base64
+import collections
+import hashlib
+import heapq
+import math
+import zlib
+
+from typing import Any, Iterable, List, Mapping, Tuple
+
+import numpy as np
+
+
+def hash_values(values: Iterable[str]) -> np.ndarray:
+    """Return the two 64-bit hashes of each value, as an array of shape
+       (number of values, 2)."""
+    digests = b''.join(hashlib.blake2b(value.encode('utf-8'),
+                                       digest_size=16).digest()
+                       for value in values)
+    return np.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+
+
+def _encode_array(values: np.ndarray) -> str:
+    return base64.b64encode(zlib.compress(values.tobytes())).decode('ascii')
+
+
+def _decode_array(data: str, dtype: Any, shape: Tuple[int, ...]) -> np.ndarray:
+    return (np.frombuffer(zlib.decompress(base64.b64decode(data)),
+                          dtype=dtype)
+            .reshape(shape)
+            .copy())
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    """Return the number of bits of 64-bit unsigned integers."""
+    def bit_length32(half: np.ndarray) -> np.ndarray:
+        # values below 2^53 are converted exactly to float64
+        _, exponent = np.frexp(half.astype(np.float64))
+        return np.where(half > 0, exponent, 0)
+
+    high = values >> np.uint64(32)
+    low = values & np.uint64(0xffffffff)
+    return np.where(high > 0, 32 + bit_length32(high), bit_length32(low))
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct values."""
+
+    def __init__(self, precision: int=14):
+        assert (4 <= precision <= 18), "Precision must be in [4, 18]"
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @classmethod
+    def from_error(cls, error: float) -> 'HyperLogLog':
+        """Return a sketch with a relative standard error of at most
+           error."""
+        precision = math.ceil(2 * math.log2(1.04 / error))
+        return cls(min(max(precision, 4), 18))
+
+    @property
+    def error(self) -> float:
+        """Relative standard error of the estimate."""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add_hashes(self, hashes: np.ndarray) -> None:
+        """Add the values with the given 64-bit hashes."""
+        shift = np.uint64(64 - self.precision)
+        indices = (hashes >> shift).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.precision)) - 1)
+        ranks = (64 - self.precision) - _bit_length(rest) + 1
+        np.maximum.at(self.registers, indices, ranks.astype(np.uint8))
+
+    def add_hash(self, hash_: int) -> None:
+        """Add the value with the given 64-bit hash."""
+        bits = 64 - self.precision
+        idx = hash_ >> bits
+        rank = bits - (hash_ & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def count(self) -> float:
+        """Return the estimated number of distinct values."""
+        nregisters = len(self.registers)
+        if nregisters >= 128:
+            alpha = 0.7213 / (1 + 1.079 / nregisters)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[nregisters]
+
+        estimate = (alpha * nregisters * nregisters
+                    / np.sum(np.exp2(-self.registers.astype(np.float64))))
+
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * nregisters and zeros > 0:
+            # linear counting for small cardinalities
+            estimate = nregisters * math.log(nregisters / zeros)
+
+        return float(estimate)
+
+    def merge(self, other: 'HyperLogLog') -> None:
+        """Merge another sketch with the same precision into this one."""
+        assert (self.precision == other.precision), \
+               "Can not merge sketches with different precision"
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def to_dict(self) -> Mapping:
+        return {
+            'type': 'hyperloglog',
+            'precision': self.precision,
+            'registers': _encode_array(self.registers),
+        }
+
+    @classmethod
+    def from_dict(cls, dct: Mapping) -> 'HyperLogLog':
+        sketch = cls(dct['precision'])
+        sketch.registers = _decode_array(dct['registers'],
+                                         np.uint8,
+                                         sketch.registers.shape)
+        return sketch
+
+
+class CountMinSketch(object):
+    """Estimate the frequency of values."""
+
+    def __init__(self, width: int, depth: int):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    @classmethod
+    def from_error(cls, epsilon: float, delta: float) -> 'CountMinSketch':
+        """Return a sketch overestimating each frequency by at most epsilon
+           times the total count with probability 1 - delta."""
+        return cls(width=math.ceil(math.e / epsilon),
+                   depth=math.ceil(math.log(1 / delta)))
+
+    def _columns(self, hashes: np.ndarray) -> np.ndarray:
+        # double hashing: the i-th row uses h1 + i*h2, wrapping at 2^64
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        with np.errstate(over='ignore'):
+            combined = hashes[None, :, 0] + rows * hashes[None, :, 1]
+        return (combined % np.uint64(self.width)).astype(np.int64)
+
+    def add_hashes(self, hashes: np.ndarray, counts: np.ndarray) -> None:
+        """Add counts to the values with the given pairs of hashes."""
+        columns = self._columns(hashes)
+        rows = np.broadcast_to(np.arange(self.depth)[:, None], columns.shape)
+        np.add.at(self.table,
+                  (rows, columns),
+                  np.broadcast_to(counts, columns.shape))
+        self.total += int(np.sum(counts))
+
+    def estimate_hashes(self, hashes: np.ndarray) -> np.ndarray:
+        """Return the estimated frequency of the values with the given pairs
+           of hashes."""
+        columns = self._columns(hashes)
+        rows = np.arange(self.depth)[:, None]
+        return self.table[rows, columns].min(axis=0)
+
+    def estimate(self, value: str) -> int:
+        """Return the estimated frequency of a value."""
+        return int(self.estimate_hashes(hash_values([value]))[0])
+
+    def merge(self, other: 'CountMinSketch') -> None:
+        """Merge another sketch with the same dimensions into this one."""
+        assert (self.width == other.width and self.depth == other.depth), \
+               "Can not merge sketches with different dimensions"
+        self.table += other.table
+        self.total += other.total
+
+    def to_dict(self) -> Mapping:
+        return {
+            'type': 'count-min',
+            'width': self.width,
+            'depth': self.depth,
+            'total': self.total,
+            'table': _encode_array(self.table),
+        }
+
+    @classmethod
+    def from_dict(cls, dct: Mapping) -> 'CountMinSketch':
+        sketch = cls(dct['width'], dct['depth'])
+        sketch.total = dct['total']
+        sketch.table = _decode_array(dct['table'],
+                                     np.int64,
+                                     sketch.table.shape)
+        return sketch
+
+
+class SpaceSaving(object):
+    """Keep the k most frequent values.
+
+       Each kept value has a count, which overestimates its frequency by at
+       most its error.
+    """
+
+    def __init__(self, k: int):
+        assert (k > 0), "k must be positive"
+        self.k = k
+        self.counts = dict()
+        self.errors = dict()
+        # (count, value) entries, some of them out of date
+        self._heap = []
+
+    def _push(self, value: str) -> None:
+        heapq.heappush(self._heap, (self.counts[value], value))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(count, value)
+                          for value, count in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self) -> Tuple[int, str]:
+        while True:
+            count, value = heapq.heappop(self._heap)
+            if self.counts.get(value) == count:
+                return count, value
+
+    def add(self, value: str, count: int=1) -> None:
+        """Add count occurrences of value."""
+        if value in self.counts:
+            self.counts[value] += count
+        elif len(self.counts) < self.k:
+            self.counts[value] = count
+            self.errors[value] = 0
+        else:
+            min_count, min_value = self._pop_min()
+            del self.counts[min_value]
+            del self.errors[min_value]
+            self.counts[value] = min_count + count
+            self.errors[value] = min_count
+        self._push(value)
+
+    def add_many(self, values: Iterable[str]) -> None:
+        """Add the occurrences of the values."""
+        for value, count in collections.Counter(values).items():
+            self.add(value, count)
+
+    def top(self, k: int=None) -> List[Tuple[str, int, int]]:
+        """Return the (value, count, error) triples of the k most frequent
+           values, by decreasing count."""
+        items = sorted(self.counts.items(), key=lambda item: (-item[1],
+                                                               item[0]))
+        return [(value, count, self.errors[value])
+                for value, count in items[:k or self.k]]
+
+    def merge(self, other: 'SpaceSaving') -> None:
+        """Merge another sketch into this one, keeping the k values with the
+           largest summed counts."""
+        counts = collections.Counter(self.counts)
+        counts.update(other.counts)
+        errors = collections.Counter(self.errors)
+        errors.update(other.errors)
+
+        top = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        self.counts = dict(top[:self.k])
+        self.errors = {value: errors[value] for value in self.counts}
+        self._heap = [(count, value) for value, count in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def to_dict(self) -> Mapping:
+        return {
+            'type': 'space-saving',
+            'k': self.k,
+            'items': [[value, count, error]
+                      for value, count, error in self.top()],
+        }
+
+    @classmethod
+    def from_dict(cls, dct: Mapping) -> 'SpaceSaving':
+        sketch = cls(dct['k'])
+        for value, count, error in dct['items']:
+            sketch.counts[value] = count
+            sketch.errors[value] = error
+        sketch._heap = [(count, value)
+                        for value, count in sketch.counts.items()]
+        heapq.heapify(sketch._heap)
+        return sketch
+
+
+class BloomFilter(object):
+    """Set membership with false positives."""
+
+    def __init__(self, nbits: int, nhashes: int):
+        assert (nbits > 0 and nhashes > 0), \
+               "The number of bits and hashes must be positive"
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.bits = np.zeros((nbits + 7) // 8, dtype=np.uint8)
+
+    @classmethod
+    def from_error(cls, capacity: int, error: float) -> 'BloomFilter':
+        """Return a filter with a false positive rate of at most error after
+           capacity values are added."""
+        nbits = math.ceil(-capacity * math.log(error) / math.log(2) ** 2)
+        nhashes = max(1, round(nbits / capacity * math.log(2)))
+        return cls(nbits, nhashes)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the bits of the filter."""
+        return self.bits.nbytes
+
+    def _positions(self, hashes: np.ndarray) -> np.ndarray:
+        # double hashing: the i-th bit is h1 + i*h2, wrapping at 2^64
+        rows = np.arange(self.nhashes, dtype=np.uint64)[None, :]
+        with np.errstate(over='ignore'):
+            combined = hashes[:, 0, None] + rows * hashes[:, 1, None]
+        return combined % np.uint64(self.nbits)
+
+    def add_hashes(self, hashes: np.ndarray) -> np.ndarray:
+        """Add the values with the given pairs of hashes, returning for
+           each one whether it may have been added before, also earlier in
+           the same call."""
+        positions = self._positions(hashes)
+        indices = (positions >> np.uint64(3)).astype(np.int64)
+        masks = (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8))
+
+        seen = np.all(self.bits[indices] & masks, axis=1)
+        # values repeated in the call, after their first occurrence
+        _, first = np.unique(hashes, axis=0, return_index=True)
+        repeated = np.ones(len(hashes), dtype=bool)
+        repeated[first] = False
+
+        np.bitwise_or.at(self.bits, indices.ravel(), masks.ravel())
+        return seen | repeated
+
+    def merge(self, other: 'BloomFilter') -> None:
+        """Merge another filter with the same dimensions into this one."""
+        assert (self.nbits == other.nbits
+                and self.nhashes == other.nhashes), \
+               "Can not merge filters with different dimensions"
+        np.bitwise_or(self.bits, other.bits, out=self.bits)
+
+    def to_dict(self) -> Mapping:
+        return {
+            'type': 'bloom',
+            'nbits': self.nbits,
+            'nhashes': self.nhashes,
+            'bits': _encode_array(self.bits),
+        }
+
+    @classmethod
+    def from_dict(cls, dct: Mapping) -> 'BloomFilter':
+        sketch = cls(dct['nbits'], dct['nhashes'])
+        sketch.bits = _decode_array(dct['bits'],
+                                    np.uint8,
+                                    sketch.bits.shape)
+        return sketch
+
+
+SKETCH_TYPES = {
+    'hyperloglog': HyperLogLog,
+    'count-min': CountMinSketch,
+    'space-saving': SpaceSaving,
+    'bloom': BloomFilter,
+}
+
+
+def from_dict(dct: Mapping) -> Any:
+    """Load a sketch serialized with to_dict."""
+    return SKETCH_TYPES[dct['type']].from_dict(dct)
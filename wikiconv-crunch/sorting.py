@@ -0,0 +1,151 @@
+"""External merge sort with a bounded memory budget."""
+import heapq
+import itertools
+import pickle
+import sys
+import tempfile
+
+from operator import itemgetter
+from typing import Any, Callable, Iterator, IO, Optional
+
+# estimated memory used by each item besides its payload (list slot, tuple
+# and key)
+ITEM_OVERHEAD = 200
+
+# buffer size for reading and writing sorted runs
+RUN_BUFFER_SIZE = 1024*1024
+
+# items are pickled in batches of RUN_BATCH_SIZE, loading each item with its
+# own pickle.load() call is slow for small items
+RUN_BATCH_SIZE = 1000
+
+
+def read_run(run: IO) -> Iterator[tuple]:
+    """Read back the items of a sorted run."""
+    run.seek(0)
+    while True:
+        try:
+            batch = pickle.load(run)
+        except EOFError:
+            break
+        yield from batch
+
+
+class ExternalSorter(object):
+    """Sort (key, payload) items keeping at most about memory_limit bytes in
+       memory.
+
+       When the memory limit is reached the items in memory are sorted and
+       spilled as a run to a temporary file, at the end the runs are merged
+       with a k-way streaming merge. The sort is stable: items with equal
+       keys are returned in the order in which they were added.
+
+       The memory used by each payload is estimated with sizeof.
+
+       The sorter counts the runs of items added in key order: if the items
+       in memory are already sorted they are not sorted again, and if all
+       the items were added in order the spilled runs are read back one
+       after the other instead of being merged (see strategy).
+    """
+
+    def __init__(self,
+                 memory_limit: int,
+                 tmp_dir: Optional[str]=None,
+                 sizeof: Callable[[Any], int]=sys.getsizeof):
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.sizeof = sizeof
+
+        self._items = []
+        self._size = 0
+        self._runs = []
+
+        # number of runs of items added in key order, in total and in memory
+        self.input_runs = 0
+        self._memory_runs = 0
+        self._last_key = None
+
+    def __len__(self):
+        return len(self._items) + sum(nitems for _, nitems in self._runs)
+
+    @property
+    def nruns(self) -> int:
+        """Number of runs spilled to disk."""
+        return len(self._runs)
+
+    @property
+    def strategy(self) -> str:
+        """How the items are sorted: 'skip' if they were added in order and
+           fit in memory, 'sort' if they fit in memory, 'concatenate' if the
+           spilled runs were added in order and 'merge' otherwise."""
+        if not self._runs:
+            return 'skip' if self._memory_runs <= 1 else 'sort'
+        return 'concatenate' if self.input_runs <= 1 else 'merge'
+
+    def add(self, key: Any, payload: Any) -> None:
+        """Add an item to be sorted."""
+        if self._last_key is None or key < self._last_key:
+            self.input_runs += 1
+            self._memory_runs += 1
+        elif not self._items:
+            self._memory_runs = 1
+        self._last_key = key
+
+        self._items.append((key, payload))
+        self._size += self.sizeof(payload) + ITEM_OVERHEAD
+
+        if self._size >= self.memory_limit:
+            self._spill()
+
+    def _spill(self) -> None:
+        """Sort the items in memory and write them to a new run."""
+        if self._memory_runs > 1:
+            self._items.sort(key=itemgetter(0))
+
+        run = tempfile.TemporaryFile(dir=self.tmp_dir,
+                                     buffering=RUN_BUFFER_SIZE)
+        for start in range(0, len(self._items), RUN_BATCH_SIZE):
+            pickle.dump(self._items[start:start + RUN_BATCH_SIZE], run,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        run.flush()
+
+        self._runs.append((run, len(self._items)))
+        self._items = []
+        self._size = 0
+        self._memory_runs = 0
+
+    def sorted(self) -> Iterator[Any]:
+        """Return the payloads sorted by key."""
+        if not self._runs:
+            if self._memory_runs > 1:
+                self._items.sort(key=itemgetter(0))
+            items = self._items
+            self._items = []
+            self._size = 0
+
+            for _, payload in items:
+                yield payload
+            return
+
+        if self._items:
+            self._spill()
+
+        runs = [run for run, _ in self._runs]
+        try:
+            if self.input_runs <= 1:
+                # each run follows the previous one
+                merged = itertools.chain.from_iterable(read_run(run)
+                                                       for run in runs)
+            else:
+                merged = heapq.merge(*[read_run(run) for run in runs],
+                                     key=itemgetter(0))
+            for _, payload in merged:
+                yield payload
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Remove the temporary files of the runs."""
+        for run, _ in self._runs:
+            run.close()
+        self._runs = []
@@ -0,0 +1,224 @@
+"""Deterministic generator of synthetic WikiConv files.
+
+Objects follow the schema of WikiConvElement (see types.py): actions are in
+chronological order, each page has some conversations whose comments reply
+to previous comments of the same conversation, users are drawn from a pool
+with a Zipf-like activity and a share of anonymous users. The same seed and
+parameters always generate the same file.
+
+Usage:
+  python3 -m wikiconv-crunch.synthetic OUTPUT [--records N] [--pages P]
+      [--page-distribution {uniform,zipf}] [--content-words W]
+      [--compression {gzip,bz2}] [--seed S]
+"""
+import argparse
+import itertools
+import json
+import random
+import string
+import time
+
+from typing import Iterator, Mapping, Optional
+
+from . import file_utils as fu
+
+# types of the actions, with their frequency
+ACTION_TYPES = [
+    ('ADDITION', 60),
+    ('CREATION', 15),
+    ('MODIFICATION', 12),
+    ('DELETION', 10),
+    ('RESTORATION', 3),
+]
+
+# first timestamp and average seconds between two actions
+START_EPOCH = 1009843200  # 2002-01-01T00:00:00Z
+MEAN_INTERVAL = 600
+
+NWORDS = 5000
+NUSERS = 100000
+ANONYMOUS_SHARE = 0.2
+
+
+def _words(rnd: random.Random) -> list:
+    return [''.join(rnd.choice(string.ascii_lowercase)
+                    for _ in range(rnd.randint(1, 12)))
+            for _ in range(NWORDS)]
+
+
+def _timestamp(epoch: int) -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+
+
+def generate(
+        records: int,
+        pages: int=1000,
+        page_distribution: str='zipf',
+        content_words: int=60,
+        seed: int=0) -> Iterator[Mapping]:
+    """Yield synthetic WikiConv objects, in chronological order.
+
+       Page IDs are drawn uniformly or with a Zipf-like distribution among
+       pages page IDs, content has on average content_words words.
+    """
+    rnd = random.Random(seed)
+    words = _words(rnd)
+    action_types = [name for name, _ in ACTION_TYPES]
+    type_weights = [weight for _, weight in ACTION_TYPES]
+
+    page_ids = rnd.sample(range(1, 50 * pages + 1), pages)
+    if page_distribution == 'zipf':
+        page_weights = [1 / (rank + 1) for rank in range(pages)]
+    else:
+        page_weights = [1] * pages
+    page_cumweights = list(itertools.accumulate(page_weights))
+    user_cumweights = list(itertools.accumulate(1 / (rank + 1) ** 1.1
+                                                for rank in range(NUSERS)))
+
+    # comments of each conversation, by page
+    conversations = dict()
+    epoch = START_EPOCH
+    rev_id = 100000
+    for num in range(records):
+        page_id = rnd.choices(page_ids, cum_weights=page_cumweights)[0]
+        page_conversations = conversations.setdefault(page_id, [])
+
+        action_type = rnd.choices(action_types, weights=type_weights)[0]
+        if not page_conversations or action_type == 'CREATION':
+            action_type = 'CREATION'
+            conversation = ('{}.{}.0'.format(rev_id, num), [])
+            page_conversations.append(conversation)
+        else:
+            conversation = rnd.choice(page_conversations)
+        conversation_id, comments = conversation
+
+        action_id = '{}.{}.{}'.format(rev_id, num % 1000, num)
+        parent_id = None
+        if action_type != 'CREATION' and comments:
+            parent_id = rnd.choice(comments[-5:])
+        if action_type in ('ADDITION', 'CREATION'):
+            comments.append(action_id)
+
+        ncontent = max(1, int(rnd.expovariate(1 / content_words)))
+        content = ' '.join(rnd.choices(words, k=ncontent))
+
+        if rnd.random() < ANONYMOUS_SHARE:
+            user = {'text': '{}.{}.{}.{}'.format(*(rnd.randint(1, 254)
+                                                   for _ in range(4)))}
+        else:
+            user_id = rnd.choices(range(NUSERS),
+                                  cum_weights=user_cumweights)[0] + 1
+            user = {'id': str(user_id), 'text': 'User{}'.format(user_id)}
+
+        obj = {
+            'id': action_id,
+            'revId': str(rev_id),
+            'type': action_type,
+            'conversationId': conversation_id,
+            'pageTitle': 'Talk:Page {}'.format(page_id),
+            'content': content,
+            'cleanedContent': content,
+            'user': user,
+            'timestamp': _timestamp(epoch),
+            'pageId': str(page_id),
+        }
+        if parent_id is not None:
+            obj['parentId'] = parent_id
+        obj['ancestorId'] = parent_id or action_id
+        obj['authorList'] = [user] if 'id' in user else []
+        if rnd.random() < 0.3:
+            obj['comment'] = ' '.join(rnd.choices(words,
+                                                  k=rnd.randint(1, 8)))
+        obj['score'] = {
+            'toxicity': rnd.betavariate(1, 8),
+            'severeToxicity': rnd.betavariate(1, 40),
+            'profanity': rnd.betavariate(1, 12),
+            'threat': rnd.betavariate(1, 30),
+            'insult': rnd.betavariate(1, 10),
+            'identityAttack': rnd.betavariate(1, 25),
+        }
+        obj['pageNamespace'] = 1
+
+        yield obj
+
+        epoch += int(rnd.expovariate(1 / MEAN_INTERVAL))
+        rev_id += rnd.randint(1, 20)
+
+
+def write_dump(
+        path: str,
+        records: int,
+        compression: Optional[str]=None,
+        **kwargs) -> str:
+    """Write a synthetic file, returning its path (with the extension of
+       the compression). Other arguments are passed to generate."""
+    with fu.output_writer(path, compression) as output:
+        for obj in generate(records, **kwargs):
+            output.write(json.dumps(obj))
+            output.write('\n')
+
+    return fu.compressed_path(path, compression)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='wikiconv-crunch.synthetic',
+        description='Write a synthetic WikiConv file.',
+    )
+    parser.add_argument(
+        'output',
+        metavar='OUTPUT',
+        help='Output file, the extension of the compression is added.',
+    )
+    parser.add_argument(
+        '--records',
+        type=int,
+        default=100000,
+        help='Number of objects [default: 100000].',
+    )
+    parser.add_argument(
+        '--pages',
+        type=int,
+        default=1000,
+        help='Number of distinct pages [default: 1000].',
+    )
+    parser.add_argument(
+        '--page-distribution',
+        choices=['uniform', 'zipf'],
+        default='zipf',
+        help='Distribution of the objects among the pages [default: zipf].',
+    )
+    parser.add_argument(
+        '--content-words',
+        type=int,
+        default=60,
+        help='Average number of words of the content [default: 60].',
+    )
+    parser.add_argument(
+        '--compression',
+        choices={None, 'bz2', 'gzip'},
+        default=None,
+        help='Output compression format [default: no compression].',
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+        help='Seed of the random generator [default: 0].',
+    )
+    args = parser.parse_args()
+
+    path = write_dump(
+        args.output,
+        args.records,
+        compression=args.compression,
+        pages=args.pages,
+        page_distribution=args.page_distribution,
+        content_words=args.content_words,
+        seed=args.seed,
+    )
+    print(path)
+
+
+if __name__ == '__main__':
+    main()
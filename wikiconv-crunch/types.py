@@ -4,8 +4,10 @@ Extract snapshots from list of revisions.
 The output format is csv.
 """
 
-from typing import Mapping
-from datetime import datetime
+import re
+import json
+from typing import Any, Mapping, Optional
+from datetime import datetime, timezone
 
 
 # class WikiConvElement(TypedDict):
@@ -67,6 +69,117 @@ from datetime import datetime
 #     score.identityAttack: float
 #     pageNamespace: int
 
+# A top-level key in a JSON line can only be preceded by "{" or "," (plus
+# whitespace), while a double quote inside a JSON string is always escaped,
+# so a key found in the text of fields such as "content" is rejected.
+# raw_value is only meant for keys that never appear in nested objects.
+RAW_VALUE_PATTERN = r'\s*:\s*(?:"([^"\\]*)"|(-?[0-9][0-9.eE+-]*))'
+RAW_VALUE_RE = re.compile(RAW_VALUE_PATTERN)
+
+
+def raw_value(line: str, key: str) -> Optional[str]:
+    """Extract the value of a top-level scalar key from a raw JSON line,
+       without decoding it.
+
+       Return None if the key is not found or if its value can not be read
+       without a full decoding (e.g. it contains escape sequences).
+    """
+    quoted = '"{}"'.format(key)
+    pos = line.find(quoted)
+    while pos >= 0:
+        # the key must be preceded by "{" or ",", skipping whitespace
+        before = pos - 1
+        while before >= 0 and line[before] in ' \t\r\n':
+            before -= 1
+        if before >= 0 and line[before] in '{,':
+            match = RAW_VALUE_RE.match(line, pos + len(quoted))
+            if match is not None:
+                string, number = match.groups()
+                return string if string is not None else number
+        pos = line.find(quoted, pos + 1)
+
+    return None
+
+
+def raw_has_key(line: str, key: str) -> bool:
+    """Return False if a raw JSON line certainly has no key, without
+       decoding it.
+
+       A double quote inside a JSON string is escaped, so "key" followed by
+       a double quote can only be a key (or a string value equal to key),
+       as long as the key is not written with escape sequences.
+    """
+    return '"{}"'.format(key) in line
+
+
+def raw_pageid(line: str) -> Optional[int]:
+    """Extract the pageId from a raw JSON line, without decoding it."""
+    value = raw_value(line, 'pageId')
+    if value is None:
+        return None
+
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+# "id" is also a key of the nested user and authorList objects, so the ID of
+# the record is read from the raw line only when it is the first key
+RAW_ID_RE = re.compile(r'^\s*{\s*"id"\s*:\s*"([^"\\]*)"')
+
+
+def raw_record_id(line: str) -> Optional[str]:
+    """Extract the id from a raw JSON line, without decoding it, if it is
+       the first key of the object."""
+    match = RAW_ID_RE.match(line)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+# WikiConv timestamps are in UTC, in the fixed-width format
+# 2007-10-31T11:54:56Z. Strings in this format sort in the same order as the
+# times they represent, so they are kept as they are and parsed only when
+# needed.
+TIMESTAMP_LENGTH = len('2007-10-31T11:54:56Z')
+
+
+def _is_fixed_width(timestamp: str) -> bool:
+    return len(timestamp) == TIMESTAMP_LENGTH and timestamp[-1] == 'Z'
+
+
+def parse_timestamp(timestamp: str) -> datetime:
+    """Parse an ISO 8601 timestamp."""
+    # How do I parse an ISO 8601-formatted date?
+    # https://stackoverflow.com/a/62769371/2377454
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+
+def timestamp_key(timestamp: str) -> str:
+    """Return a string that sorts in the same order as the timestamps."""
+    if _is_fixed_width(timestamp):
+        return timestamp
+
+    return (parse_timestamp(timestamp)
+            .astimezone(timezone.utc)
+            .strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+
+def isoformat_timestamp(timestamp: str) -> str:
+    """Return the timestamp as formatted by datetime.isoformat, e.g.
+       2007-10-31T11:54:56+00:00, without parsing it when possible."""
+    if _is_fixed_width(timestamp):
+        return timestamp[:-1] + '+00:00'
+
+    return parse_timestamp(timestamp).isoformat()
+
+
+def timestamp_epoch(timestamp: str) -> int:
+    """Return the timestamp as seconds since the epoch."""
+    return int(parse_timestamp(timestamp).timestamp())
+
+
 def __parse_user(userdct: Mapping) -> Mapping:
     if "id" in userdct:
         return {"id": int(userdct["id"]),
@@ -93,11 +206,8 @@ def cast_json(dct: Mapping) -> Mapping:
            "content": dct["content"],
            "cleanedContent": dct["cleanedContent"],
            "user": __parse_user(dct.get("user", {})),
-           # How do I parse an ISO 8601-formatted date?
-           # https://stackoverflow.com/a/62769371/2377454
-           "timestamp": datetime.fromisoformat(
-                            dct["timestamp"].replace('Z', '+00:00')
-                            ),
+           # timestamps are kept as strings, see parse_timestamp
+           "timestamp": dct["timestamp"],
            "pageId": int(dct["pageId"]),
            "parentId": dct.get("parentId", None),
            "ancestorId": dct["ancestorId"],
@@ -116,3 +226,139 @@ def cast_json(dct: Mapping) -> Mapping:
            }
 
     return res
+
+
+SCORE_FIELDS = (
+    'toxicity',
+    'severeToxicity',
+    'profanity',
+    'threat',
+    'insult',
+    'identityAttack',
+)
+
+
+def _compact_user(userdct: Mapping) -> Any:
+    # users and authors with an id are stored as (id, text) tuples, the
+    # others are kept as they are
+    if "id" in userdct:
+        return (int(userdct["id"]), userdct["text"])
+    else:
+        return userdct
+
+
+def _expand_user(user: Any) -> Mapping:
+    if isinstance(user, tuple):
+        return {"id": user[0], "text": user[1]}
+    else:
+        return user
+
+
+class WikiConvRecord(object):
+    """Compact WikiConv object, with the fields of WikiConvElement.
+
+       user and authorList entries are stored as (id, text) tuples and the
+       scores as attributes, so a record uses a fraction of the memory of
+       the dict returned by cast_json. It serializes to the same JSON and
+       supports read access by key, e.g. record['user']['id'].
+    """
+    __slots__ = (
+        'id',
+        'revId',
+        'type',
+        'conversationId',
+        'pageTitle',
+        'content',
+        'cleanedContent',
+        'user',
+        'timestamp',
+        'pageId',
+        'parentId',
+        'ancestorId',
+        'authorList',
+        'comment',
+    ) + SCORE_FIELDS + (
+        'pageNamespace',
+    )
+
+    def __getitem__(self, key: str) -> Any:
+        if key == 'user':
+            return _expand_user(self.user)
+        elif key == 'authorList':
+            return [_expand_user(author) for author in self.authorList]
+        elif key == 'score':
+            return {field: getattr(self, field) for field in SCORE_FIELDS}
+        elif key in SCORE_FIELDS:
+            raise KeyError(key)
+
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def to_dict(self) -> Mapping:
+        """Return the record as the dict returned by cast_json."""
+        return {"id": self.id,
+                "revId": self.revId,
+                "type": self.type,
+                "conversationId": self.conversationId,
+                "pageTitle": self.pageTitle,
+                "content": self.content,
+                "cleanedContent": self.cleanedContent,
+                "user": _expand_user(self.user),
+                "timestamp": self.timestamp,
+                "pageId": self.pageId,
+                "parentId": self.parentId,
+                "ancestorId": self.ancestorId,
+                "authorList": [_expand_user(author)
+                               for author in self.authorList],
+                "comment": self.comment,
+                "score": {
+                   "toxicity": self.toxicity,
+                   "severeToxicity": self.severeToxicity,
+                   "profanity": self.profanity,
+                   "threat": self.threat,
+                   "insult": self.insult,
+                   "identityAttack": self.identityAttack,
+                   },
+                "pageNamespace": self.pageNamespace
+                }
+
+    def to_json(self) -> str:
+        """Serialize the record as the dict returned by cast_json, with the
+           timestamp in the format of datetime.isoformat."""
+        dct = self.to_dict()
+        dct["timestamp"] = isoformat_timestamp(self.timestamp)
+        return json.dumps(dct)
+
+
+def cast_record(dct: Mapping) -> WikiConvRecord:
+    """Same as cast_json, returning a WikiConvRecord."""
+    rec = WikiConvRecord()
+    rec.id = dct["id"]
+    rec.revId = int(dct["revId"])
+    rec.type = dct["type"]
+    rec.conversationId = dct["conversationId"]
+    rec.pageTitle = dct["pageTitle"]
+    rec.content = dct["content"]
+    rec.cleanedContent = dct["cleanedContent"]
+    rec.user = _compact_user(dct.get("user", {}))
+    rec.timestamp = dct["timestamp"]
+    rec.pageId = int(dct["pageId"])
+    rec.parentId = dct.get("parentId", None)
+    rec.ancestorId = dct["ancestorId"]
+    rec.authorList = tuple(_compact_user(author)
+                           for author in dct["authorList"])
+    rec.comment = dct.get("comment", None)
+
+    score = dct["score"]
+    rec.toxicity = float(score["toxicity"])
+    rec.severeToxicity = float(score["severeToxicity"])
+    rec.profanity = float(score["profanity"])
+    rec.threat = float(score["threat"])
+    rec.insult = float(score["insult"])
+    rec.identityAttack = float(score["identityAttack"])
+
+    rec.pageNamespace = int(dct["pageNamespace"])
+
+    return rec
@@ -1,13 +1,16 @@
 """Various utilities."""
 
+import copy
+import datetime
 import functools
 import itertools
+import numbers
 import sys
 
 import more_itertools
 import regex as re
-from typing import (Generic, Iterable, List, NamedTuple, Optional, T, Tuple,
-                    TypeVar)
+from typing import (Generic, Iterable, List, Mapping, NamedTuple, Optional, T,
+                    Tuple, TypeVar)
 
 
 class Diff(NamedTuple("Diff", [("action", str), ("data", T)]), Generic[T]):
@@ -132,3 +135,40 @@ def normalize_wikititle(title: str) -> str:
 
     title = title.replace('_', ' ')
     return ' '.join(title.split())
+
+
+def merge_stats(first: Mapping, second: Mapping) -> Mapping:
+    """Merge two stats dictionaries with the same structure.
+
+       Counters are summed, for start times the earliest one is kept, for
+       end times and peak values the latest (largest) one, nested
+       dictionaries are merged recursively. Other values are kept if they
+       are equal in both dictionaries, otherwise they are joined in a
+       comma-separated string.
+    """
+    res = copy.deepcopy(first)
+    for key, value in second.items():
+        current = res.get(key)
+        if current is None:
+            res[key] = copy.deepcopy(value)
+        elif value is None:
+            continue
+        elif isinstance(current, Mapping):
+            res[key] = merge_stats(current, value)
+        elif key.startswith('peak_'):
+            res[key] = max(current, value)
+        elif isinstance(current, datetime.datetime):
+            if key.endswith('end_time'):
+                res[key] = max(current, value)
+            else:
+                res[key] = min(current, value)
+        elif (isinstance(current, numbers.Number)
+              and not isinstance(current, bool)):
+            res[key] = current + value
+        elif current != value:
+            values = str(current).split(',')
+            if str(value) not in values:
+                values.append(str(value))
+            res[key] = ','.join(values)
+
+    return res